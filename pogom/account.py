@@ -2,16 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import math
+import os
+import json
 import time
 import random
 from threading import Lock
 from timeit import default_timer
+from queue import Queue
 
 from pgoapi import PGoApi
 from pgoapi.exceptions import AuthException, BannedAccountException
 
 from .fakePogoApi import FakePogoApi
-from .utils import generate_device_info, equi_rect_distance
+from .utils import (generate_device_info, equi_rect_distance,
+                    spawnpoint_id_from_db)
 from .proxy import get_new_proxy
 from .transform import jitter_location, get_new_coords, calculate_bearing
 
@@ -22,6 +27,83 @@ class TooManyLoginAttempts(Exception):
     pass
 
 
+class LoginAssetCache(object):
+    """Asset digest and item template versions downloaded during login.
+
+    Every account on the same API version gets the same asset digest and
+    item templates. Once a login has paged through them, their timestamps
+    are stored on disk, and later logins (also after a restart) skip the
+    downloads until the server announces newer ones.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.lock = Lock()
+        self.versions = {}
+        self.stats = {'downloaded': 0, 'skipped': 0}
+
+    def load(self, path):
+        self.path = path
+        if not os.path.isfile(path):
+            return
+
+        try:
+            with open(path, 'r') as f:
+                self.versions = json.load(f)
+            log.info('Loaded login asset cache for API versions %s.',
+                     ', '.join(self.versions.keys()))
+        except (IOError, ValueError) as e:
+            log.warning('Ignoring unreadable login asset cache %s: %s',
+                        path, repr(e))
+
+    # Whether the asset digest or item templates ('asset_time' or
+    # 'template_time') of this API version are already downloaded.
+    def is_current(self, api_version, name, timestamp):
+        if not self.path:
+            return False
+
+        with self.lock:
+            cached = self.versions.get(api_version, {}).get(name, 0)
+            if cached >= timestamp:
+                self.stats['skipped'] += 1
+                return True
+
+        return False
+
+    def update(self, api_version, name, timestamp, pages):
+        if not self.path:
+            return
+
+        with self.lock:
+            self.stats['downloaded'] += 1
+            version = self.versions.setdefault(api_version, {})
+            if version.get(name, 0) >= timestamp:
+                return
+            version[name] = timestamp
+            version[name.replace('_time', '_pages')] = pages
+
+            # Write to a temporary file first, a crash halfway through
+            # must not leave a broken cache behind.
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.versions, f, indent=2, sort_keys=True)
+                # Windows can't rename over an existing file.
+                if os.name == 'nt' and os.path.isfile(self.path):
+                    os.remove(self.path)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                log.warning('Unable to write login asset cache %s: %s',
+                            self.path, repr(e))
+
+    def get_stats_message(self):
+        return 'Login assets: {} downloaded, {} skipped from cache.'.format(
+            self.stats['downloaded'], self.stats['skipped'])
+
+
+login_assets = LoginAssetCache()
+
+
 # Create the API object that'll be used to scan.
 def setup_api(args, status, account):
     # Create the API instance this will use.
@@ -155,7 +237,9 @@ def app_login(args, account, api, position):
     config = account['remote_config']
 
     if not args.no_login_asset_download and (
-            config['asset_time'] > old_config.get('asset_time', 0)):
+            config['asset_time'] > old_config.get('asset_time', 0)) and (
+            not login_assets.is_current(args.api_version, 'asset_time',
+                                        config['asset_time'])):
         req_count = 0
         i = random.randint(0, 3)
         result = 2
@@ -181,10 +265,15 @@ def app_login(args, account, api, position):
                 except KeyError:
                     break
         log.debug('Completed %d requests to get asset digest.', req_count)
+        if result == 1:
+            login_assets.update(args.api_version, 'asset_time',
+                                config['asset_time'], req_count)
 
     # 5 - Download Item Templates request.
     if not args.no_login_asset_download and (
-            config['template_time'] > old_config.get('template_time', 0)):
+            config['template_time'] > old_config.get('template_time', 0)) and (
+            not login_assets.is_current(args.api_version, 'template_time',
+                                        config['template_time'])):
         req_count = 0
         i = random.randint(0, 3)
         result = 2
@@ -210,6 +299,9 @@ def app_login(args, account, api, position):
                     break
         log.debug('Completed %d requests to download item templates.',
                   req_count)
+        if result == 1:
+            login_assets.update(args.api_version, 'template_time',
+                                config['template_time'], req_count)
 
     # Check tutorial completion.
     if not all(x in account['tutorials'] for x in (0, 1, 3, 4, 7)):
@@ -806,7 +898,7 @@ def randomize_throw(excellent=0.05, great=0.5, nice=0.3, curveball=0.8):
 
 def catch_pokemon(status, api, account, encounter_id, pokemon):
     pokemon_id = pokemon['pokemon_id']
-    spawnpoint_id = pokemon['spawnpoint_id']
+    spawnpoint_id = spawnpoint_id_from_db(pokemon['spawnpoint_id'])
 
     attempts = 0
     max_attempts = random.randint(3, 5)
@@ -1401,6 +1493,43 @@ def request_use_item_egg_incubator(api, account, incubator_id, egg_id):
     return False
 
 
+class AccountQueue(Queue):
+    """Queue of free accounts that can hand out the closest account.
+
+    Search workers take the free account whose last location is closest to
+    where they're going to scan, so they don't have to wait for the speed
+    limit after switching accounts. Accounts without a known location
+    start at the worker's location and are as good as it gets.
+    """
+
+    def get_closest(self, location):
+        with self.not_empty:
+            while not self._qsize():
+                self.not_empty.wait()
+
+            best_index = 0
+            best_distance = None
+            for i, account in enumerate(self.queue):
+                last_location = account.get('last_location')
+                if not last_location:
+                    best_index = i
+                    best_distance = 0
+                    break
+
+                distance = equi_rect_distance(last_location, location)
+                if best_distance is None or distance < best_distance:
+                    best_index = i
+                    best_distance = distance
+
+            account = self.queue[best_index]
+            del self.queue[best_index]
+            self.not_full.notify()
+
+        log.debug('Dispatched account %s, %.2fkm away from %s.',
+                  account['username'], best_distance or 0, location)
+        return account
+
+
 # The AccountSet returns a scheduler that cycles through different
 # sets of accounts (e.g. L30). Each set is defined at runtime, and is
 # (currently) used to separate regular accounts from L30 accounts.
@@ -1412,9 +1541,21 @@ def request_use_item_egg_incubator(api, account, incubator_id, egg_id):
 # until we have a proper account manager.
 class AccountSet(object):
 
+    # Free accounts are bucketed by the grid cell of their last location,
+    # cell_size degrees wide, so next() only has to look at the cells that
+    # can hold a cooled down account close to the location.
+    cell_size = 0.01
+
     def __init__(self, kph):
         self.sets = {}
 
+        # Free accounts per set: accounts that haven't scanned yet, and
+        # the others bucketed by grid cell. Usage stats per set.
+        self.unscanned = {}
+        self.buckets = {}
+        self.free = {}
+        self.stats = {}
+
         # Scanning limits.
         self.kph = kph
 
@@ -1426,7 +1567,23 @@ class AccountSet(object):
         if name in self.sets:
             raise Exception('Account set ' + name + ' is being created twice.')
 
+        for account in values:
+            account['set_name'] = name
+
         self.sets[name] = values
+        self.unscanned[name] = []
+        self.buckets[name] = {}
+        self.free[name] = 0
+        self.stats[name] = {
+            'requests': 0,
+            'served': 0,
+            'cooldowns': 0,
+            'exhausted': 0,
+            'distance': 0.0
+        }
+
+        for account in values:
+            self._add_free(account)
 
     # Release an account back to the pool after it was used.
     def release(self, account):
@@ -1434,55 +1591,184 @@ class AccountSet(object):
             log.error('Released account %s back to the AccountSet,'
                       + " but it wasn't locked.",
                       account['username'])
-        else:
-            account['in_use'] = False
+            return
+
+        with self.next_lock:
+            if account['in_use']:
+                account['in_use'] = False
+                if not account.get('failed', False):
+                    self._add_free(account)
 
-    # Get next account that is ready to be used for scanning.
+    # Mark an account as failed. It leaves the pool for good.
+    def fail(self, account):
+        with self.next_lock:
+            account['failed'] = True
+            if not account.get('in_use', False):
+                self._remove_free(account)
+
+    # Get next account that is ready to be used for scanning. Returns a tuple
+    # (account, wait): the closest free account that has cooled down for
+    # coords_to_scan, or (None, seconds) until the first one has. Returns
+    # (None, None) when there are no usable accounts left in the set.
     def next(self, set_name, coords_to_scan):
         # Yay for thread safety.
         with self.next_lock:
             # Readability.
-            account_set = self.sets[set_name]
+            buckets = self.buckets[set_name]
+            unscanned = self.unscanned[set_name]
+            stats = self.stats[set_name]
+            stats['requests'] += 1
 
-            # Loop all accounts for a good one.
             now = default_timer()
             max_speed_kmph = self.kph
 
-            for i in range(len(account_set)):
-                account = account_set[i]
-
-                # Make sure it's not in use.
-                if account.get('in_use', False):
-                    continue
-
-                # Make sure the account hasn't failed.
-                if account.get('failed', False):
+            # Lower bounds of the distance to and the wait for the accounts
+            # in each cell: the closest point of the cell, and the account
+            # that scanned longest ago.
+            bounds = []
+            for cell, bucket in buckets.iteritems():
+                distance_km = self._cell_distance(cell, coords_to_scan)
+                wait = (distance_km / max_speed_kmph * 3600
+                        - (now - bucket['oldest']))
+                bounds.append((distance_km, wait, cell))
+
+            best = None
+            best_distance = None
+
+            # Closest account that has cooled down. Cells are visited from
+            # the closest one, until no cell can hold a closer account.
+            for distance_km, wait, cell in sorted(bounds):
+                if wait > 0:
                     continue
+                if best is not None and distance_km >= best_distance:
+                    break
+                for account in buckets[cell]['accounts']:
+                    distance = equi_rect_distance(account['last_coords'],
+                                                  coords_to_scan)
+                    seconds_passed = now - account['last_scanned']
+                    if distance / max_speed_kmph * 3600 > seconds_passed:
+                        continue
+                    if best is None or distance < best_distance:
+                        best = account
+                        best_distance = distance
+
+            # Accounts that haven't scanned yet can go anywhere, but we'd
+            # rather reuse an account that's close by.
+            if best is None and unscanned:
+                best = unscanned[-1]
+                best_distance = float('inf')
+
+            if best is None:
+                # Time until the first account has cooled down. Cells are
+                # visited from the shortest wait, until no cell can hold a
+                # shorter one.
+                min_wait = None
+                for distance_km, wait, cell in sorted(
+                        bounds, key=lambda b: b[1]):
+                    if min_wait is not None and wait >= min_wait:
+                        break
+                    for account in buckets[cell]['accounts']:
+                        distance = equi_rect_distance(
+                            account['last_coords'], coords_to_scan)
+                        account_wait = (distance / max_speed_kmph * 3600
+                                        - (now - account['last_scanned']))
+                        if min_wait is None or account_wait < min_wait:
+                            min_wait = account_wait
+
+                if min_wait is None:
+                    stats['exhausted'] += 1
+                else:
+                    stats['cooldowns'] += 1
+                return None, min_wait
+
+            # We've found an account that's ready.
+            self._remove_free(best)
+
+            stats['served'] += 1
+            if best_distance != float('inf'):
+                stats['distance'] += best_distance
+
+            best['last_scanned'] = now
+            best['last_coords'] = coords_to_scan
+            best['in_use'] = True
+
+            return best, None
+
+    def get_stats_message(self, set_name):
+        with self.next_lock:
+            stats = dict(self.stats[set_name])
+            total = len(self.sets[set_name])
+            free = self.free[set_name]
+            failed = len([a for a in self.sets[set_name]
+                          if a.get('failed', False)])
+        in_use = total - free - failed
+
+        return ('L{} accounts: {} in use, {} free, {} failed ({:.0f}% ' +
+                'utilization) | Requests: {}, served: {} (avg {:.2f}km ' +
+                'away), cooling down: {}, none left: {}').format(
+                    set_name, in_use, free, failed,
+                    100.0 * in_use / max(1, total - failed),
+                    stats['requests'], stats['served'],
+                    stats['distance'] / max(1, stats['served']),
+                    stats['cooldowns'], stats['exhausted'])
+
+    # Grid cell of a location.
+    def _cell(self, coords):
+        return (int(math.floor(coords[0] / self.cell_size)),
+                int(math.floor(coords[1] / self.cell_size)))
+
+    # Distance from coords to the closest point of a grid cell.
+    def _cell_distance(self, cell, coords):
+        lat = min(max(coords[0], cell[0] * self.cell_size),
+                  (cell[0] + 1) * self.cell_size)
+        lng = min(max(coords[1], cell[1] * self.cell_size),
+                  (cell[1] + 1) * self.cell_size)
+        return equi_rect_distance((lat, lng), coords)
+
+    # Add an account to the free accounts of its set. Needs next_lock.
+    def _add_free(self, account):
+        name = account['set_name']
+        self.free[name] += 1
+
+        last_scanned = account.get('last_scanned', False)
+        if not last_scanned:
+            self.unscanned[name].append(account)
+            return
 
-                # Check if we're below speed limit for account.
-                last_scanned = account.get('last_scanned', False)
-
-                if last_scanned:
-                    seconds_passed = now - last_scanned
-                    old_coords = account.get('last_coords', coords_to_scan)
-
-                    distance_km = equi_rect_distance(
-                        old_coords,
-                        coords_to_scan)
-                    cooldown_time_sec = distance_km / max_speed_kmph * 3600
+        cell = self._cell(account['last_coords'])
+        bucket = self.buckets[name].setdefault(
+            cell, {'accounts': [], 'oldest': last_scanned})
+        bucket['accounts'].append(account)
+        bucket['oldest'] = min(bucket['oldest'], last_scanned)
 
-                    # Not enough time has passed for this one.
-                    if seconds_passed < cooldown_time_sec:
-                        continue
+    # Remove an account from the free accounts of its set, if it's there.
+    # Needs next_lock.
+    def _remove_free(self, account):
+        name = account['set_name']
 
-                # We've found an account that's ready.
-                account['last_scanned'] = now
-                account['last_coords'] = coords_to_scan
-                account['in_use'] = True
+        last_scanned = account.get('last_scanned', False)
+        if not last_scanned:
+            accounts = self.unscanned[name]
+        else:
+            cell = self._cell(account['last_coords'])
+            bucket = self.buckets[name].get(cell)
+            if bucket is None:
+                return
+            accounts = bucket['accounts']
+
+        for i, free_account in enumerate(accounts):
+            if free_account is account:
+                break
+        else:
+            return
 
-                return account
+        # The order doesn't matter, swap it out.
+        accounts[i] = accounts[-1]
+        accounts.pop()
+        self.free[name] -= 1
 
-        # TODO: Instead of returning False, return the amount of min. seconds
-        # the instance needs to wait until the first account becomes available,
-        # so it doesn't need to keep asking if we know we need to wait.
-        return False
+        if last_scanned:
+            if accounts:
+                bucket['oldest'] = min(a['last_scanned'] for a in accounts)
+            else:
+                del self.buckets[name][cell]
@@ -19,6 +19,7 @@ from . import config
 from .models import (Pokemon, Gym, Pokestop, ScannedLocation,
                      MainWorker, WorkerStatus, Token, HashKeys)
 from .utils import now, dottedQuadToNum, get_blacklist
+from .captcha import captcha_tokens
 log = logging.getLogger(__name__)
 compress = Compress()
 
@@ -83,8 +84,12 @@ class Pogom(Flask):
         response = 'error'
         if request.form:
             token = request.form.get('token')
-            query = Token.insert(token=token, last_updated=datetime.utcnow())
-            query.execute()
+            # Hand the token to a captcha'd account of this process, or
+            # store it for other instances.
+            if not captcha_tokens.offer(token):
+                query = Token.insert(token=token,
+                                     last_updated=datetime.utcnow())
+                query.execute()
             response = 'ok'
         r = make_response(response)
         r.headers.add('Access-Control-Allow-Origin', '*')
@@ -3,11 +3,11 @@
 
 '''
  - Captcha Overseer:
-   - Tracks incoming new captcha tokens
+   - Tracks incoming new captcha tokens (in-process first, then database)
    - Monitors the captcha'd accounts queue
-   - Launches captcha_solver threads
+   - Hands captcha'd accounts and their tokens to the solver pool
  - Captcha Solver Threads each:
-   - Have a unique captcha token
+   - Take the next captcha'd account (and token) from the pool queue
    - Attempts to verifyChallenge
    - Puts account back in active queue
    - Pushes webhook messages with captcha status
@@ -18,7 +18,9 @@ import time
 import requests
 
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Event, Lock
+from queue import Queue
+from collections import deque
 
 import models
 from .transform import jitter_location
@@ -29,44 +31,153 @@ from .utils import now
 log = logging.getLogger(__name__)
 
 
+class CaptchaTokens(object):
+    """Manual captcha tokens passed from the web server to the overseer.
+
+    When the web server runs in the scanning process, submitted tokens go
+    straight to the captcha overseer instead of through the Token table.
+    Tokens are only taken while captcha'd accounts of this process are
+    waiting for one and a solver is free to use it, the rest still go to
+    the database for other instances (or a scanner running with -ns) to
+    pick up.
+    """
+
+    # Tokens older than this are not accepted by the servers anymore.
+    max_age = 30
+
+    def __init__(self):
+        self.tokens = deque()
+        self.lock = Lock()
+        self.event = Event()
+        self.waiting = 0
+
+    # Number of tokens the overseer can hand out to solvers right away.
+    def set_waiting(self, waiting):
+        with self.lock:
+            self.waiting = waiting
+
+    # Returns False when the token should be stored in the database.
+    def offer(self, token):
+        with self.lock:
+            if len(self.tokens) >= self.waiting:
+                return False
+            self.tokens.append((now(), token))
+
+        self.wake()
+        return True
+
+    def get_valid(self, limit):
+        tokens = []
+        with self.lock:
+            while self.tokens and len(tokens) < limit:
+                submitted, token = self.tokens.popleft()
+                if submitted > now() - self.max_age:
+                    tokens.append(token)
+            self.waiting = max(0, self.waiting - len(tokens))
+
+        return tokens
+
+    # Make the overseer run right away.
+    def wake(self):
+        self.event.set()
+
+
+captcha_tokens = CaptchaTokens()
+
+
+class CaptchaSolvers(object):
+    """Queue of captcha'd accounts for a fixed pool of solver threads.
+
+    Keeps track of how many solvers are idle, so the overseer doesn't take
+    tokens it can't use before they expire, and of the time accounts spend
+    waiting for their captcha to be solved.
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = Lock()
+        # Solvers waiting for a captcha and captchas not picked up yet.
+        # Both are counted under the lock, queue.qsize() lags behind.
+        self.idle = 0
+        self.queued = 0
+        self.stats = {
+            'solved': 0,
+            'failed': 0,
+            'hold_secs': 0.0,
+            'max_hold_secs': 0.0
+        }
+
+    # Number of captchas that can be picked up by a solver right away.
+    def available(self):
+        with self.lock:
+            return self.idle - self.queued
+
+    def put(self, captcha, token=None):
+        with self.lock:
+            self.queued += 1
+        self.queue.put((captcha, token))
+
+    def get(self):
+        with self.lock:
+            self.idle += 1
+        job = self.queue.get()
+        with self.lock:
+            self.idle -= 1
+            self.queued -= 1
+
+        return job
+
+    def done(self, solved, hold_time):
+        with self.lock:
+            self.stats['solved' if solved else 'failed'] += 1
+            self.stats['hold_secs'] += hold_time
+            self.stats['max_hold_secs'] = max(self.stats['max_hold_secs'],
+                                              hold_time)
+
+    def get_stats_message(self, account_captchas):
+        with self.lock:
+            finished = self.stats['solved'] + self.stats['failed']
+            return ('Captchas: {} waiting for a token, {} queued for a ' +
+                    'solver. Solved {}, failed {}, accounts held {:.1f}s ' +
+                    'on average ({:.1f}s max).').format(
+                        len(account_captchas), self.queue.qsize(),
+                        self.stats['solved'], self.stats['failed'],
+                        self.stats['hold_secs'] / max(finished, 1),
+                        self.stats['max_hold_secs'])
+
+
 def captcha_overseer_thread(args, account_queue, account_captchas,
-                            key_scheduler, wh_queue):
-    solverId = 0
+                            key_scheduler, wh_queue, solvers):
+    log.info('Starting %d captcha solver threads...', args.captcha_solvers)
+    for i in range(args.captcha_solvers):
+        t = Thread(target=captcha_solver_thread,
+                   name='captcha-solver-{}'.format(i),
+                   args=(args, account_queue, account_captchas, key_scheduler,
+                         wh_queue, solvers))
+        t.daemon = True
+        t.start()
+
     while True:
-        # Run once every 15 seconds.
-        sleep_timer = 15
+        # Tokens submitted from now on wake us up for the next run.
+        captcha_tokens.event.clear()
+        tokens_needed = min(len(account_captchas), solvers.available())
+        captcha_tokens.set_waiting(tokens_needed)
 
-        tokens_needed = len(account_captchas)
         if tokens_needed > 0:
-            tokens = models.Token.get_valid(tokens_needed)
-            tokens_available = len(tokens)
-            solvers = min(tokens_needed, tokens_available)
+            # Tokens submitted to this process first, the database only
+            # holds tokens submitted to other instances.
+            tokens = captcha_tokens.get_valid(tokens_needed)
+            if len(tokens) < tokens_needed:
+                tokens += models.Token.get_valid(tokens_needed - len(tokens))
+                models.release_db_connection()
             log.debug('Captcha overseer running. Captchas: %d - Tokens: %d',
-                      tokens_needed, tokens_available)
-            for i in range(0, solvers):
-                hash_key = None
-                if args.hash_key:
-                    hash_key = key_scheduler.next()
-
-                t = Thread(target=captcha_solver_thread,
-                           name='captcha-solver-{}'.format(solverId),
-                           args=(args, account_queue, account_captchas,
-                                 hash_key, wh_queue, tokens[i]))
-                t.daemon = True
-                t.start()
-
-                solverId += 1
-                if solverId > 999:
-                    solverId = 0
-                # Wait a bit before launching next thread
-                time.sleep(1)
-
-            # Adjust captcha-overseer sleep timer
-            sleep_timer -= 1 * solvers
+                      len(account_captchas), len(tokens))
+            for token in tokens:
+                solvers.put(account_captchas.popleft(), token)
 
             # Hybrid mode
             if args.captcha_key and args.manual_captcha_timeout > 0:
-                tokens_remaining = tokens_needed - tokens_available
+                tokens_remaining = tokens_needed - len(tokens)
                 # Safety guard
                 tokens_remaining = min(tokens_remaining, 5)
                 for i in range(0, tokens_remaining):
@@ -79,37 +190,55 @@ def captcha_overseer_thread(args, account_queue, account_captchas,
                                   'and reached the %ds timeout.',
                                   account['username'], hold_time,
                                   args.manual_captcha_timeout)
-                        if args.hash_key:
-                            hash_key = key_scheduler.next()
-
-                        t = Thread(target=captcha_solver_thread,
-                                   name='captcha-solver-{}'.format(solverId),
-                                   args=(args, account_queue, account_captchas,
-                                         hash_key, wh_queue))
-                        t.daemon = True
-                        t.start()
-
-                        solverId += 1
-                        if solverId > 999:
-                            solverId = 0
-                        # Wait a bit before launching next thread
-                        time.sleep(1)
+                        solvers.put(account_captchas.popleft())
                     else:
                         break
 
-        time.sleep(sleep_timer)
+            # Tokens used up what the solvers can take for now.
+            captcha_tokens.set_waiting(
+                min(len(account_captchas), solvers.available()))
 
+        # Run again once a token is submitted or an account is captcha'd,
+        # or after 15 seconds.
+        captcha_tokens.event.wait(15)
 
-def captcha_solver_thread(args, account_queue, account_captchas, hash_key,
-                          wh_queue, token=None):
-    status, account, captcha_url = account_captchas.popleft()
+
+def captcha_solver_thread(args, account_queue, account_captchas,
+                          key_scheduler, wh_queue, solvers):
+    while True:
+        captcha, token = solvers.get()
+        status, account, captcha_url = captcha
+
+        hash_key = None
+        if args.hash_key:
+            hash_key = key_scheduler.next()
+
+        try:
+            solved = solve_captcha(args, account_queue, account_captchas,
+                                   hash_key, wh_queue, captcha, token)
+            hold_time = (datetime.utcnow() -
+                         account['last_active']).total_seconds()
+            solvers.done(solved, hold_time)
+        except Exception as e:
+            log.exception('Exception while solving captcha for account ' +
+                          '%s: %s', account['username'], repr(e))
+            account_captchas.append(captcha)
+
+        # Make sure status is updated
+        time.sleep(1)
+
+
+# Return True if the account's captcha was solved.
+def solve_captcha(args, account_queue, account_captchas, hash_key, wh_queue,
+                  captcha, token=None):
+    status, account, captcha_url = captcha
 
     status['message'] = 'Waking up account {} to verify captcha token.'.format(
                          account['username'])
     log.info(status['message'])
 
     # Create the API instance this will use.
-    api = setup_api(args, status)
+    api = setup_api(args, status, account)
 
     location = account['last_location']
     if not args.no_jitter:
@@ -140,7 +269,8 @@ def captcha_solver_thread(args, account_queue, account_captchas, hash_key,
     hold_time = (datetime.utcnow() - last_active).total_seconds()
     wh_message['time'] = int(hold_time)
 
-    if 'success' in response['responses']['VERIFY_CHALLENGE']:
+    solved = 'success' in response['responses']['VERIFY_CHALLENGE']
+    if solved:
         status['message'] = (
             "Account {} successfully uncaptcha'd, returning to " +
             'active duty.').format(account['username'])
@@ -152,13 +282,13 @@ def captcha_solver_thread(args, account_queue, account_captchas, hash_key,
             'Account {} failed verifyChallenge, putting back ' +
             'in captcha queue.').format(account['username'])
         log.warning(status['message'])
-        account_captchas.append((status, account, captcha_url))
+        account_captchas.append(captcha)
         wh_message['status'] = 'failure'
 
     if args.webhooks:
         wh_queue.put(('captcha', wh_message))
-    # Make sure status is updated
-    time.sleep(1)
+
+    return solved
 
 
 def handle_captcha(args, status, api, account, account_failures,
@@ -203,6 +333,7 @@ def handle_captcha(args, status, api, account, account_failures,
                                         account['username'])
                 log.warning(status['message'])
                 account_captchas.append((status, account, captcha_url))
+                captcha_tokens.wake()
                 if args.webhooks:
                     wh_message = {'status_name': args.status_name,
                                   'status': 'encounter',
@@ -10,26 +10,35 @@ import gc
 import time
 import geopy
 import math
+import heapq
+import json
+from threading import (Lock, Event, Thread, Condition, local,
+                       current_thread)
+from functools import wraps
 from peewee import (InsertQuery, Check, CompositeKey, ForeignKeyField,
                     SmallIntegerField, IntegerField, CharField, DoubleField,
                     BooleanField, DateTimeField, fn, DeleteQuery, FloatField,
-                    SQL, TextField, JOIN, OperationalError)
+                    SQL, TextField, BigIntegerField, JOIN,
+                    OperationalError)
 from playhouse.flask_utils import FlaskDB
-from playhouse.pool import PooledMySQLDatabase
+from playhouse.pool import PooledMySQLDatabase, PooledSqliteExtDatabase
 from playhouse.shortcuts import RetryOperationalError, case
 from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
-from playhouse.sqlite_ext import SqliteExtDatabase
 from datetime import datetime, timedelta
 from base64 import b64encode
-from cachetools import TTLCache
-from cachetools import cached
+from cachetools import TTLCache, LRUCache
 from timeit import default_timer
 
 from . import config
 from .utils import (get_pokemon_name, get_pokemon_rarity, get_pokemon_types,
-                    get_args, cellid, in_radius, date_secs, clock_between,
-                    get_move_name, get_move_damage, get_move_energy,
-                    get_move_type)
+                    get_args, cellid, in_radius, date_secs, hour_floor,
+                    clock_between, get_move_name, get_move_damage,
+                    get_move_energy, get_move_type, hour_mask_range,
+                    hour_mask_next, hour_mask_gaps, hour_mask_to_db,
+                    hour_mask_from_db, s2_cell_id, s2_cell_ranges,
+                    encounter_id_to_db, encounter_id_from_db,
+                    encounter_id_from_base64, spawnpoint_id_to_db,
+                    spawnpoint_id_from_db)
 from .transform import transform_from_wgs_to_gcj, get_new_coords
 from .customLog import printPokemon
 
@@ -37,12 +46,337 @@ log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
-cache = TTLCache(maxsize=100, ttl=60 * 5)
 
-db_schema_version = 19
+# Last known state of the forts we've stored, so parse_map can skip
+# unchanged forts without going to the database. Entries expire, so forts
+# are still written every now and then (which updates Gym.last_scanned).
+known_pokestops = TTLCache(maxsize=100000, ttl=60 * 60)
+known_gyms = TTLCache(maxsize=50000, ttl=60 * 10)
+known_forts_lock = Lock()
+
+
+class KnownPokemon(object):
+    """(encounter_id, spawnpoint_id) pairs of Pokemon that are stored.
+
+    Every pair is kept until its Pokemon disappears, so workers scanning
+    overlapping cells can tell a Pokemon is already stored (or encountered)
+    without querying the database. Expired pairs are pruned from a heap
+    ordered by disappear time.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.expires = {}
+        self.heap = []
+
+    def add(self, encounter_id, spawnpoint_id, disappear_time):
+        key = (encounter_id, spawnpoint_id)
+        expire = calendar.timegm(disappear_time.timetuple())
+        with self.lock:
+            if self.expires.get(key, 0) < expire:
+                self.expires[key] = expire
+                heapq.heappush(self.heap, (expire, key))
+
+    def contains(self, encounter_id, spawnpoint_id, now_date):
+        now_secs = calendar.timegm(now_date.timetuple())
+        with self.lock:
+            self._prune(now_secs)
+            return self.expires.get(
+                (encounter_id, spawnpoint_id), 0) >= now_secs
+
+    def _prune(self, now_secs):
+        while self.heap and self.heap[0][0] < now_secs:
+            expire, key = heapq.heappop(self.heap)
+            # Only drop it if it wasn't extended in the meantime.
+            if self.expires.get(key) == expire:
+                del self.expires[key]
+
+
+known_pokemon = KnownPokemon()
+
+
+class SpawnpointSummaries(object):
+    """Newest sightings summaries of the spawnpoints scanned by this process.
+
+    Workers scanning overlapping cells can read a spawnpoint before the db
+    updater has stored another worker's sighting of it. The summary fields
+    are only changed through update(), one spawnpoint at a time and starting
+    from the newest copy in this process, so no sighting is overwritten.
+    Copies are kept until their update has surely been stored.
+
+    Spawnpoints are locked through a fixed array of locks picked by id, so
+    workers only wait for each other on the same (or a colliding) id.
+    """
+
+    fields = ('summary', 'seen_mask', 'unseen_mask')
+
+    def __init__(self, stripes=64):
+        self.lock = Lock()
+        self.stripes = [Lock() for _ in range(stripes)]
+        self.latest = TTLCache(maxsize=10000, ttl=15 * 60)
+
+    # Run change(sp) on the spawnpoint dict with its newest summary fields.
+    # prepare(sp) runs first without holding the spawnpoint's lock, for
+    # slow work such as database queries. Fields it sets are replaced by
+    # any newer copy stored in the meantime.
+    def update(self, sp, change, prepare=None):
+        if prepare is not None:
+            self._load(sp)
+            prepare(sp)
+
+        with self.stripes[hash(sp['id']) % len(self.stripes)]:
+            self._load(sp)
+            result = change(sp)
+            copy = dict((f, sp[f]) for f in self.fields
+                        if sp.get(f) is not None)
+            with self.lock:
+                self.latest[sp['id']] = copy
+
+        return result
+
+    def _load(self, sp):
+        with self.lock:
+            sp.update(self.latest.get(sp['id'], {}))
+
+
+spawnpoint_summaries = SpawnpointSummaries()
+
+# Counters for the prefetch, diff and emit stages of parse_map.
+parse_stats = {
+    'scans': 0,
+    'prefetch_queries': 0,
+    'prefetch_secs': 0.0,
+    'parse_secs': 0.0,
+    'pokemon_skipped': 0,
+    'pokestops_skipped': 0,
+    'pokemon_cached': 0,
+    'pokestops_cached': 0,
+    'gyms_skipped': 0,
+    'pokemon_emitted': 0,
+    'pokestops_emitted': 0,
+    'gyms_emitted': 0
+}
+parse_stats_lock = Lock()
+
+
+class StatsCache(object):
+    """Thread-safe cache for the results of the statistics queries.
+
+    Only one thread runs a query at a time: concurrent misses for the same
+    key wait for the running query instead of starting their own. Results
+    are kept longer for longer periods, and a result that is about to
+    expire is refreshed in the background while the old one is served.
+    """
+
+    def __init__(self, max_ttl, min_ttl=60, refresh=0.2, maxsize=1000):
+        self.max_ttl = max_ttl
+        self.min_ttl = min(min_ttl, max_ttl)
+        self.refresh = refresh
+        self.lock = Lock()
+        self.query_lock = Lock()
+        # key: (value, expires, refresh_at).
+        self.entries = LRUCache(maxsize=maxsize)
+        # key: Event set when the running query finishes.
+        self.running = {}
+
+    # Cache 5 minutes for every day of the period, an all time period (None)
+    # for max_ttl.
+    def ttl(self, timediff):
+        if not timediff:
+            return self.max_ttl
+
+        ttl = timediff.total_seconds() / 288
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    def cached(self, f):
+        def wrapper(cls, *args):
+            return self.get((f.__name__,) + args, f, cls, args)
+
+        return wrapper
+
+    def get(self, key, f, cls, args):
+        while True:
+            now = default_timer()
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[1] > now:
+                    value, expires, refresh_at = entry
+                    if refresh_at <= now and key not in self.running:
+                        self.running[key] = Event()
+                        t = Thread(target=self._refresh,
+                                   name='stats-cache-refresh',
+                                   args=(key, f, cls, args))
+                        t.daemon = True
+                        t.start()
+                    return value
+
+                done = self.running.get(key)
+                if done is None:
+                    done = self.running[key] = Event()
+                    break
+
+            # Someone else is running this query, use its result.
+            done.wait()
+
+        return self._load(key, f, cls, args)
+
+    def _refresh(self, key, f, cls, args):
+        try:
+            self._load(key, f, cls, args)
+        except Exception:
+            # Already logged, keep serving the old result until it expires.
+            pass
+        finally:
+            # The thread ends here, return its connection to the pool.
+            release_db_connection()
+
+    def _load(self, key, f, cls, args):
+        try:
+            with self.query_lock:
+                value = f(cls, *args)
+
+            # The period is always the last argument.
+            ttl = self.ttl(args[-1])
+            now = default_timer()
+            with self.lock:
+                self.entries[key] = (value, now + ttl,
+                                     now + ttl * (1 - self.refresh))
+            return value
+        except Exception as e:
+            log.exception('Error loading statistics for %s: %s.', key[0], e)
+            raise
+        finally:
+            with self.lock:
+                self.running.pop(key).set()
+
+
+stats_cache = StatsCache(args.stats_cache_ttl)
+
+db_schema_version = 23
+
+
+# Connection pool that makes threads wait for a free connection instead of
+# failing right away when all connections are in use, and keeps statistics on
+# the waits and on the age of its connections. Connections of threads that
+# ended without closing theirs are taken back while waiting. Mixed into the
+# peewee pools.
+class MonitoredPool(object):
+
+    def __init__(self, *args, **kwargs):
+        self.checkout_timeout = kwargs.pop('checkout_timeout', 30)
+        super(MonitoredPool, self).__init__(*args, **kwargs)
+        self.checkout = Condition()
+        # thread: connection checked out by it.
+        self.holders = {}
+        self.stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_secs': 0.0,
+            'max_wait_secs': 0.0,
+            'exhausted': 0,
+            'reclaimed': 0
+        }
+
+    def connect(self):
+        thread = current_thread()
+        with self.checkout:
+            # Connecting again without closing first keeps the checkout.
+            if thread not in self.holders:
+                self.wait_for_connection(thread)
+
+        try:
+            super(MonitoredPool, self).connect()
+        except Exception:
+            self.release()
+            raise
+
+        with self.checkout:
+            self.holders[thread] = self.get_conn()
+
+    # Wait until a connection is free, with the checkout lock held.
+    def wait_for_connection(self, thread):
+        start = default_timer()
+        while len(self.holders) >= self.max_connections:
+            if self.reclaim():
+                continue
+            remaining = start + self.checkout_timeout - default_timer()
+            if remaining <= 0:
+                self.stats['exhausted'] += 1
+                log.warning('All %d connections of the %s pool have been ' +
+                            'in use for %d seconds.', self.max_connections,
+                            self.database, self.checkout_timeout)
+                raise ValueError('Exceeded maximum connections.')
+            # Ended threads don't notify, check on them every second.
+            self.checkout.wait(min(remaining, 1))
+
+        self.holders[thread] = None
+        wait = default_timer() - start
+        self.stats['checkouts'] += 1
+        if wait > 0.001:
+            self.stats['waits'] += 1
+            self.stats['wait_secs'] += wait
+            self.stats['max_wait_secs'] = max(self.stats['max_wait_secs'],
+                                              wait)
+
+    def close(self):
+        try:
+            super(MonitoredPool, self).close()
+        finally:
+            self.release()
+
+    def release(self):
+        with self.checkout:
+            if self.holders.pop(current_thread(), False) is not False:
+                self.checkout.notify()
+
+    # Close the connections of threads that ended without closing them.
+    # Returns the number of connections taken back.
+    def reclaim(self):
+        ended = [t for t in self.holders if not t.is_alive()]
+        for thread in ended:
+            conn = self.holders.pop(thread)
+            if conn is None:
+                continue
+            with self._conn_lock:
+                self._in_use.pop(self.conn_key(conn), None)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        if ended:
+            self.stats['reclaimed'] += len(ended)
+            log.warning('Took back %d connections of the %s pool from ' +
+                        'threads that ended without closing them.',
+                        len(ended), self.database)
+
+        return len(ended)
+
+    def get_stats_message(self):
+        now = time.time()
+        with self.checkout:
+            stats = dict(self.stats)
+            in_use = len(self.holders)
+        # Both keep the time the connection was opened.
+        opened = (list(self._in_use.values()) +
+                  [ts for ts, conn in list(self._connections)])
+        oldest = now - min(opened) if opened else 0
+
+        return ('{}/{} connections in use, {} open (oldest {:.0f}s) | ' +
+                '{} checkouts, {} waited ({:.0f}ms avg, {:.1f}s max), ' +
+                '{} exhausted, {} reclaimed').format(
+                    in_use, self.max_connections, len(opened), oldest,
+                    stats['checkouts'], stats['waits'],
+                    1000 * stats['wait_secs'] / max(1, stats['waits']),
+                    stats['max_wait_secs'], stats['exhausted'],
+                    stats['reclaimed'])
+
+
+class MyRetryDB(RetryOperationalError, MonitoredPool, PooledMySQLDatabase):
+    pass
 
 
-class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
+class MySqliteDB(MonitoredPool, PooledSqliteExtDatabase):
     pass
 
 
@@ -53,13 +387,22 @@ class Utf8mb4CharField(CharField):
         super(CharField, self).__init__(*args, **kwargs)
 
 
+# Connection pool of the read replica, if one is configured.
+replica_db = None
+replica_reads = local()
+
+
 def init_database(app):
+    global replica_db
+
+    # One connection for each db updater thread, the scheduler and the db
+    # cleaner, which keep theirs, and a number shared by the web server and
+    # the search workers, which return them after each request or scan.
+    connections = args.db_threads + 2 + args.db_max_connections
+
     if args.db_type == 'mysql':
-        log.info('Connecting to MySQL database on %s:%i...',
-                 args.db_host, args.db_port)
-        connections = args.db_max_connections
-        if hasattr(args, 'accounts'):
-            connections *= len(args.accounts)
+        log.info('Connecting to MySQL database on %s:%i with up to %d ' +
+                 'connections...', args.db_host, args.db_port, connections)
         db = MyRetryDB(
             args.db_name,
             user=args.db_user,
@@ -67,16 +410,41 @@ def init_database(app):
             host=args.db_host,
             port=args.db_port,
             max_connections=connections,
-            stale_timeout=300,
+            stale_timeout=args.db_stale_timeout,
+            checkout_timeout=args.db_checkout_timeout,
             charset='utf8mb4')
+
+        if args.db_replica_host:
+            log.info('Reading map data from MySQL replica on %s:%i.',
+                     args.db_replica_host, args.db_replica_port)
+            replica_db = MyRetryDB(
+                args.db_name,
+                user=args.db_user,
+                password=args.db_pass,
+                host=args.db_replica_host,
+                port=args.db_replica_port,
+                max_connections=args.db_replica_max_connections,
+                stale_timeout=args.db_stale_timeout,
+                checkout_timeout=args.db_checkout_timeout,
+                charset='utf8mb4')
     else:
         log.info('Connecting to local SQLite database')
-        db = SqliteExtDatabase(args.db,
-                               pragmas=(
-                                   ('journal_mode', 'WAL'),
-                                   ('mmap_size', 1024 * 1024 * 32),
-                                   ('cache_size', 10000),
-                                   ('journal_size_limit', 1024 * 1024 * 4),))
+        # SQLite only allows one writer at a time, so there's a single db
+        # updater thread (see get_args()). The connections are shared between
+        # threads, for reading.
+        db = MySqliteDB(args.db,
+                        max_connections=connections,
+                        stale_timeout=args.db_stale_timeout,
+                        checkout_timeout=args.db_checkout_timeout,
+                        check_same_thread=False,
+                        pragmas=(
+                            ('journal_mode', 'WAL'),
+                            ('mmap_size', 1024 * 1024 * 32),
+                            ('cache_size', 10000),
+                            ('journal_size_limit', 1024 * 1024 * 4),
+                            # Fire the delete triggers that keep the
+                            # spatial indexes up to date on REPLACE.
+                            ('recursive_triggers', 'on'),))
 
     app.config['DATABASE'] = db
     flaskDb.init_app(app)
@@ -84,9 +452,81 @@ def init_database(app):
     return db
 
 
+# Tables with a spatial index on their coordinates that can be used by
+# in_box(), set up by create_spatial_indexes().
+spatial_tables = set()
+
+
+# Condition for rows of model within a box, using the spatial index of the
+# table if it has one, or else the S2 cells covering the box if the table
+# has an s2_cell column. The indexes only narrow down the rows to check, the
+# exact coordinates are still compared.
+def in_box(model, swLat, swLng, neLat, neLng):
+    condition = ((model.latitude >= swLat) & (model.longitude >= swLng) &
+                 (model.latitude <= neLat) & (model.longitude <= neLng))
+
+    # The map passes the coordinates as strings.
+    swLat, swLng, neLat, neLng = map(float, (swLat, swLng, neLat, neLng))
+
+    if model not in spatial_tables:
+        if 's2_cell' not in model._meta.fields:
+            return condition
+
+        cells = None
+        for low, high in s2_cell_ranges(swLat, swLng, neLat, neLng):
+            cell = model.s2_cell.between(low, high)
+            cells = cell if cells is None else cells | cell
+        return condition & cells
+
+    if args.db_type == 'mysql':
+        return condition & SQL(
+            'MBRContains(LineString(Point(%s, %s), Point(%s, %s)), '
+            'location)', swLng, swLat, neLng, neLat)
+
+    return condition & SQL(
+        'rowid IN (SELECT id FROM {}_rtree WHERE max_lat >= ? AND '
+        'min_lat <= ? AND max_lng >= ? AND min_lng <= ?)'.format(
+            model._meta.db_table), swLat, neLat, swLng, neLng)
+
+
+# Run the queries of a model read method on the read replica, if there is
+# one. Only selects are routed, writes always go to the primary database.
+def read_replica(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if replica_db is None or getattr(replica_reads, 'active', False):
+            return f(*args, **kwargs)
+
+        replica_reads.active = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            replica_reads.active = False
+            # Return the connection to the pool.
+            if not replica_db.is_closed():
+                replica_db.close()
+
+    return wrapper
+
+
+# Return the database connection of the current thread to the pool, for
+# threads that only need one now and then.
+def release_db_connection():
+    if not flaskDb.database.is_closed():
+        flaskDb.database.close()
+
+
 class BaseModel(flaskDb.Model):
 
     @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        if getattr(replica_reads, 'active', False):
+            query.database = replica_db
+        return query
+
+    @classmethod
+    @read_replica
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
         if args.china:
@@ -100,11 +540,12 @@ class BaseModel(flaskDb.Model):
 class Pokemon(BaseModel):
     # We are base64 encoding the ids delivered by the api
     # because they are too big for sqlite to handle.
-    encounter_id = Utf8mb4CharField(primary_key=True, max_length=50)
-    spawnpoint_id = Utf8mb4CharField(index=True)
+    encounter_id = BigIntegerField(primary_key=True)
+    spawnpoint_id = BigIntegerField(index=True)
     pokemon_id = SmallIntegerField(index=True)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell = BigIntegerField(null=True, index=True)
     disappear_time = DateTimeField(index=True)
     individual_attack = SmallIntegerField(null=True)
     individual_defense = SmallIntegerField(null=True)
@@ -124,6 +565,7 @@ class Pokemon(BaseModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
+    @read_replica
     def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                    oSwLng=None, oNeLat=None, oNeLng=None):
         now_date = datetime.utcnow()
@@ -138,20 +580,14 @@ class Pokemon(BaseModel):
                      .where(((Pokemon.last_modified >
                               datetime.utcfromtimestamp(timestamp / 1000)) &
                              (Pokemon.disappear_time > now_date)) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
+                            in_box(Pokemon, swLat, swLng, neLat, neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send Pokemon in view but exclude those within old boundaries.
             # Only send newly uncovered Pokemon.
             query = (query
                      .where(((Pokemon.disappear_time > now_date) &
-                             (((Pokemon.latitude >= swLat) &
-                               (Pokemon.longitude >= swLng) &
-                               (Pokemon.latitude <= neLat) &
-                               (Pokemon.longitude <= neLng))) &
+                             in_box(Pokemon, swLat, swLng, neLat, neLng) &
                              ~((Pokemon.disappear_time > now_date) &
                                (Pokemon.latitude >= oSwLat) &
                                (Pokemon.longitude >= oSwLng) &
@@ -164,10 +600,7 @@ class Pokemon(BaseModel):
                      # Add 1 hour buffer to include spawnpoints that persist
                      # after tth, like shsh.
                      .where((Pokemon.disappear_time > now_date) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))))
+                            in_box(Pokemon, swLat, swLng, neLat, neLng))
                      .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -177,6 +610,8 @@ class Pokemon(BaseModel):
         pokemon = []
         for p in list(query):
 
+            p['encounter_id'] = encounter_id_from_db(p['encounter_id'])
+            p['spawnpoint_id'] = spawnpoint_id_from_db(p['spawnpoint_id'])
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
             p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
@@ -191,6 +626,7 @@ class Pokemon(BaseModel):
         return pokemon
 
     @staticmethod
+    @read_replica
     def get_active_by_id(ids, swLat, swLng, neLat, neLng):
         if not (swLat and swLng and neLat and neLng):
             query = (Pokemon
@@ -203,10 +639,7 @@ class Pokemon(BaseModel):
                      .select()
                      .where((Pokemon.pokemon_id << ids) &
                             (Pokemon.disappear_time > datetime.utcnow()) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
+                            in_box(Pokemon, swLat, swLng, neLat, neLng))
                      .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -215,6 +648,8 @@ class Pokemon(BaseModel):
 
         pokemon = []
         for p in query:
+            p['encounter_id'] = encounter_id_from_db(p['encounter_id'])
+            p['spawnpoint_id'] = spawnpoint_id_from_db(p['spawnpoint_id'])
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
             p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
@@ -228,11 +663,34 @@ class Pokemon(BaseModel):
 
         return pokemon
 
+    # Split a stats period into the part read from the hourly rollups and
+    # the part still read from the Pokemon table: the start of the period up
+    # to the first full hour, and everything not rolled up yet. Returns the
+    # condition on Pokemon and the rolled up (from, to) hours, or None.
     @classmethod
-    @cached(cache)
-    def get_seen(cls, timediff):
+    def get_stats_ranges(cls, timediff):
+        since = datetime.utcfromtimestamp(0)
         if timediff:
-            timediff = datetime.utcnow() - timediff
+            since = datetime.utcnow() - timediff
+
+        rolled_from = hour_floor(since)
+        if rolled_from < since:
+            rolled_from += timedelta(hours=1)
+        rolled_to = PokemonHourlyStats.get_rolled_up_until()
+
+        if not rolled_to or rolled_to <= rolled_from:
+            return cls.disappear_time > since, None
+
+        raw = ((cls.disappear_time > since) &
+               ((cls.disappear_time < rolled_from) |
+                (cls.disappear_time >= rolled_to)))
+        return raw, (rolled_from, rolled_to)
+
+    @classmethod
+    @stats_cache.cached
+    @read_replica
+    def get_seen(cls, timediff):
+        raw, rolled = cls.get_stats_ranges(timediff)
         pokemon_count_query = (Pokemon
                                .select(Pokemon.pokemon_id,
                                        fn.COUNT(Pokemon.pokemon_id).alias(
@@ -240,7 +698,7 @@ class Pokemon(BaseModel):
                                        fn.MAX(Pokemon.disappear_time).alias(
                                            'lastappeared')
                                        )
-                               .where(Pokemon.disappear_time > timediff)
+                               .where(raw)
                                .group_by(Pokemon.pokemon_id)
                                .alias('counttable')
                                )
@@ -259,13 +717,27 @@ class Pokemon(BaseModel):
                  .dicts()
                  )
 
+        seen = {}
+        if rolled:
+            seen = PokemonHourlyStats.get_seen(*rolled)
+
         # Performance:  disable the garbage collector prior to creating a
         # (potentially) large dict with append().
         gc.disable()
 
+        for p in query:
+            rolled_up = seen.get(p['pokemon_id'])
+            if rolled_up:
+                p['count'] += rolled_up['count']
+                if rolled_up['disappear_time'] > p['disappear_time']:
+                    p.update(latitude=rolled_up['latitude'],
+                             longitude=rolled_up['longitude'],
+                             disappear_time=rolled_up['disappear_time'])
+            seen[p['pokemon_id']] = p
+
         pokemon = []
         total = 0
-        for p in query:
+        for p in seen.values():
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             pokemon.append(p)
             total += p['count']
@@ -276,30 +748,45 @@ class Pokemon(BaseModel):
         return {'pokemon': pokemon, 'total': total}
 
     @classmethod
+    @stats_cache.cached
+    @read_replica
     def get_appearances(cls, pokemon_id, timediff):
         '''
         :param pokemon_id: id of Pokemon that we need appearances for
         :param timediff: limiting period of the selection
         :return: list of Pokemon appearances over a selected period
         '''
-        if timediff:
-            timediff = datetime.utcnow() - timediff
+        raw, rolled = cls.get_stats_ranges(timediff)
         query = (Pokemon
                  .select(Pokemon.latitude, Pokemon.longitude,
                          Pokemon.pokemon_id,
                          fn.Count(Pokemon.spawnpoint_id).alias('count'),
                          Pokemon.spawnpoint_id)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
+                 .where((Pokemon.pokemon_id == pokemon_id) & raw)
                  .group_by(Pokemon.latitude, Pokemon.longitude,
                            Pokemon.pokemon_id, Pokemon.spawnpoint_id)
                  .dicts()
                  )
 
-        return list(query)
+        appearances = {}
+        if rolled:
+            appearances = SpawnpointHourlyStats.get_appearances(
+                pokemon_id, *rolled)
+
+        for p in query:
+            key = (p['spawnpoint_id'], p['latitude'], p['longitude'])
+            if key in appearances:
+                p['count'] += appearances[key]['count']
+            appearances[key] = p
+
+        for p in appearances.values():
+            p['spawnpoint_id'] = spawnpoint_id_from_db(p['spawnpoint_id'])
+
+        return appearances.values()
 
     @classmethod
+    @stats_cache.cached
+    @read_replica
     def get_appearances_times_by_spawnpoint(cls, pokemon_id,
                                             spawnpoint_id, timediff):
         '''
@@ -308,25 +795,29 @@ class Pokemon(BaseModel):
         :param timediff: limiting period of the selection.
         :return: list of time appearances over a selected period.
         '''
-        if timediff:
-            timediff = datetime.utcnow() - timediff
+        spawnpoint_id = spawnpoint_id_to_db(spawnpoint_id)
+        raw, rolled = cls.get_stats_ranges(timediff)
         query = (Pokemon
                  .select(Pokemon.disappear_time)
                  .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.spawnpoint_id == spawnpoint_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
+                        (Pokemon.spawnpoint_id == spawnpoint_id) & raw)
                  .order_by(Pokemon.disappear_time.asc())
                  .tuples()
                  )
 
-        return list(itertools.chain(*query))
+        times = []
+        if rolled:
+            times = SpawnpointHourlyStats.get_appearances_times(
+                pokemon_id, spawnpoint_id, *rolled)
+
+        return sorted(times + list(itertools.chain(*query)))
 
     @classmethod
     def get_spawn_time(cls, disappear_time):
         return (disappear_time + 2700) % 3600
 
     @classmethod
+    @read_replica
     def get_spawnpoints(cls, swLat, swLng, neLat, neLng, timestamp=0,
                         oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
         query = (Pokemon
@@ -339,19 +830,13 @@ class Pokemon(BaseModel):
             query = (query
                      .where(((Pokemon.last_modified >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
+                            in_box(Pokemon, swLat, swLng, neLat, neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send spawnpoints in view but exclude those within old boundaries.
             # Only send newly uncovered spawnpoints.
             query = (query
-                     .where((((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))) &
+                     .where(in_box(Pokemon, swLat, swLng, neLat, neLng) &
                             ~((Pokemon.latitude >= oSwLat) &
                               (Pokemon.longitude >= oSwLng) &
                               (Pokemon.latitude <= oNeLat) &
@@ -359,11 +844,7 @@ class Pokemon(BaseModel):
                      .dicts())
         elif swLat and swLng and neLat and neLng:
             query = (query
-                     .where((Pokemon.latitude <= neLat) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.longitude <= neLng)
-                            ))
+                     .where(in_box(Pokemon, swLat, swLng, neLat, neLng)))
 
         query = query.group_by(Pokemon.latitude, Pokemon.longitude,
                                Pokemon.spawnpoint_id, SQL('time'))
@@ -389,6 +870,7 @@ class Pokemon(BaseModel):
         # Helping out the GC.
         for sp in spawnpoints.values():
             del sp['count']
+            sp['spawnpoint_id'] = spawnpoint_id_from_db(sp['spawnpoint_id'])
 
         return list(spawnpoints.values())
 
@@ -436,15 +918,194 @@ class Pokemon(BaseModel):
             # live longer, but you'll _always_ have at least 15 minutes, so it
             # works well enough.
             location['time'] = cls.get_spawn_time(location['time'])
+            location['spawnpoint_id'] = spawnpoint_id_from_db(
+                location['spawnpoint_id'])
 
         return filtered
 
 
+class PokemonHourlyStats(BaseModel):
+    """Pokemon seen per hour of disappear time, rolled up by clean_db_loop.
+
+    pokemon_id 0 holds the totals of the hour, and marks the hour as rolled
+    up even when no Pokemon were seen.
+    """
+    hour = DateTimeField()
+    pokemon_id = SmallIntegerField()
+    count = IntegerField()
+    last_seen = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('hour', 'pokemon_id')
+
+    # Return the start of the first hour that isn't rolled up yet, or None.
+    @classmethod
+    def get_rolled_up_until(cls):
+        latest = (cls
+                  .select(cls.hour)
+                  .order_by(cls.hour.desc())
+                  .first())
+
+        return latest.hour + timedelta(hours=1) if latest else None
+
+    # Return {pokemon_id: seen dict} like Pokemon.get_seen, for the rolled up
+    # hours from start until end.
+    @classmethod
+    def get_seen(cls, start, end):
+        count_query = (cls
+                       .select(cls.pokemon_id,
+                               fn.SUM(cls.count).alias('count'),
+                               fn.MAX(cls.last_seen).alias('lastappeared'))
+                       .where((cls.hour >= start) & (cls.hour < end) &
+                              (cls.pokemon_id > 0))
+                       .group_by(cls.pokemon_id)
+                       .alias('counttable'))
+        query = (cls
+                 .select(cls.pokemon_id,
+                         cls.last_seen.alias('disappear_time'),
+                         cls.latitude,
+                         cls.longitude,
+                         count_query.c.count)
+                 .join(count_query,
+                       on=(cls.pokemon_id == count_query.c.pokemon_id))
+                 .where(cls.last_seen == count_query.c.lastappeared)
+                 .dicts())
+
+        seen = {}
+        for p in query:
+            p['count'] = int(p['count'])
+            seen[p['pokemon_id']] = p
+
+        return seen
+
+    # Rolled up hours that are rolled up again on every pass, for Pokemon
+    # the db updater stored late. Their Pokemon are kept until then.
+    reroll_hours = 2
+
+    # Roll up the Pokemon of hours that have ended, at most max_hours new
+    # hours at a time. Returns the number of new hours rolled up.
+    @classmethod
+    def rollup(cls, max_hours=24):
+        rolled_up_until = cls.get_rolled_up_until()
+        if rolled_up_until:
+            start = rolled_up_until - timedelta(hours=cls.reroll_hours)
+        else:
+            first = (Pokemon
+                     .select(Pokemon.disappear_time)
+                     .order_by(Pokemon.disappear_time.asc())
+                     .first())
+            if not first:
+                return 0
+            start = rolled_up_until = hour_floor(first.disappear_time)
+
+        # Give the db updater a few minutes to store the last Pokemon.
+        end = hour_floor(datetime.utcnow() - timedelta(minutes=5))
+        hours = 0
+        while start < end and hours < max_hours:
+            # Rows are upserted, rolling up an hour again is safe.
+            cls.rollup_hour(start)
+            if start >= rolled_up_until:
+                hours += 1
+            start += timedelta(hours=1)
+
+        return hours
+
+    @classmethod
+    def rollup_hour(cls, hour):
+        query = (Pokemon
+                 .select(Pokemon.pokemon_id,
+                         Pokemon.spawnpoint_id,
+                         fn.COUNT(Pokemon.encounter_id).alias('count'),
+                         fn.MAX(Pokemon.disappear_time).alias('last_seen'),
+                         fn.MAX(Pokemon.latitude).alias('latitude'),
+                         fn.MAX(Pokemon.longitude).alias('longitude'))
+                 .where((Pokemon.disappear_time >= hour) &
+                        (Pokemon.disappear_time <
+                         hour + timedelta(hours=1)))
+                 .group_by(Pokemon.pokemon_id, Pokemon.spawnpoint_id)
+                 .dicts())
+
+        # The totals of the hour are kept as Pokemon 0.
+        pokemon = {0: {'hour': hour, 'pokemon_id': 0, 'count': 0,
+                       'last_seen': hour, 'latitude': 0, 'longitude': 0}}
+        spawnpoints = {}
+        for p in query:
+            p['hour'] = hour
+            spawnpoints[(p['pokemon_id'], p['spawnpoint_id'])] = p
+
+            for pokemon_id in (p['pokemon_id'], 0):
+                total = pokemon.setdefault(pokemon_id, {
+                    'hour': hour, 'pokemon_id': pokemon_id, 'count': 0,
+                    'last_seen': p['last_seen'], 'latitude': p['latitude'],
+                    'longitude': p['longitude']})
+                total['count'] += p['count']
+                if p['last_seen'] > total['last_seen']:
+                    total.update(last_seen=p['last_seen'],
+                                 latitude=p['latitude'],
+                                 longitude=p['longitude'])
+
+        if spawnpoints:
+            bulk_upsert(SpawnpointHourlyStats, spawnpoints, flaskDb.database)
+        bulk_upsert(cls, pokemon, flaskDb.database)
+
+
+class SpawnpointHourlyStats(BaseModel):
+    """Pokemon seen per spawnpoint and hour, rolled up by clean_db_loop."""
+    pokemon_id = SmallIntegerField()
+    spawnpoint_id = BigIntegerField()
+    hour = DateTimeField()
+    count = IntegerField()
+    last_seen = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'spawnpoint_id', 'hour')
+
+    # Return {(spawnpoint_id, latitude, longitude): appearances dict} like
+    # Pokemon.get_appearances, for the rolled up hours from start until end.
+    @classmethod
+    def get_appearances(cls, pokemon_id, start, end):
+        query = (cls
+                 .select(cls.latitude, cls.longitude, cls.pokemon_id,
+                         fn.SUM(cls.count).alias('count'),
+                         cls.spawnpoint_id)
+                 .where((cls.pokemon_id == pokemon_id) &
+                        (cls.hour >= start) & (cls.hour < end))
+                 .group_by(cls.latitude, cls.longitude, cls.pokemon_id,
+                           cls.spawnpoint_id)
+                 .dicts())
+
+        appearances = {}
+        for p in query:
+            p['count'] = int(p['count'])
+            appearances[(p['spawnpoint_id'], p['latitude'],
+                         p['longitude'])] = p
+
+        return appearances
+
+    # Only the last appearance of every hour is kept, which is all of them
+    # unless a spawnpoint spawned the same Pokemon twice in an hour.
+    @classmethod
+    def get_appearances_times(cls, pokemon_id, spawnpoint_id, start, end):
+        query = (cls
+                 .select(cls.last_seen)
+                 .where((cls.pokemon_id == pokemon_id) &
+                        (cls.spawnpoint_id == spawnpoint_id) &
+                        (cls.hour >= start) & (cls.hour < end))
+                 .tuples())
+
+        return list(itertools.chain(*query))
+
+
 class Pokestop(BaseModel):
     pokestop_id = Utf8mb4CharField(primary_key=True, max_length=50)
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     lure_expiration = DateTimeField(null=True, index=True)
     active_fort_modifier = Utf8mb4CharField(max_length=50,
@@ -456,6 +1117,7 @@ class Pokestop(BaseModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
+    @read_replica
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                   oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
 
@@ -471,17 +1133,11 @@ class Pokestop(BaseModel):
             query = (query
                      .where(((Pokestop.last_updated >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
+                            in_box(Pokestop, swLat, swLng, neLat, neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng and lured:
             query = (query
-                     .where((((Pokestop.latitude >= swLat) &
-                              (Pokestop.longitude >= swLng) &
-                              (Pokestop.latitude <= neLat) &
-                              (Pokestop.longitude <= neLng)) &
+                     .where((in_box(Pokestop, swLat, swLng, neLat, neLng) &
                              (Pokestop.active_fort_modifier.is_null(False))) &
                             ~((Pokestop.latitude >= oSwLat) &
                               (Pokestop.longitude >= oSwLng) &
@@ -493,10 +1149,7 @@ class Pokestop(BaseModel):
             # Send stops in view but exclude those within old boundaries. Only
             # send newly uncovered stops.
             query = (query
-                     .where(((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
+                     .where(in_box(Pokestop, swLat, swLng, neLat, neLng) &
                             ~((Pokestop.latitude >= oSwLat) &
                               (Pokestop.longitude >= oSwLng) &
                               (Pokestop.latitude <= oNeLat) &
@@ -506,19 +1159,13 @@ class Pokestop(BaseModel):
             query = (query
                      .where(((Pokestop.last_updated >
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokestop.latitude >= swLat) &
-                             (Pokestop.longitude >= swLng) &
-                             (Pokestop.latitude <= neLat) &
-                             (Pokestop.longitude <= neLng)) &
+                            in_box(Pokestop, swLat, swLng, neLat, neLng) &
                             (Pokestop.active_fort_modifier.is_null(False)))
                      .dicts())
 
         else:
             query = (query
-                     .where((Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
+                     .where(in_box(Pokestop, swLat, swLng, neLat, neLng))
                      .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -547,6 +1194,7 @@ class Gym(BaseModel):
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell = BigIntegerField(null=True, index=True)
     last_modified = DateTimeField(index=True)
     last_scanned = DateTimeField(default=datetime.utcnow, index=True)
 
@@ -554,6 +1202,7 @@ class Gym(BaseModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
+    @read_replica
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                  oSwLng=None, oNeLat=None, oNeLng=None):
         if not (swLat and swLng and neLat and neLng):
@@ -566,20 +1215,14 @@ class Gym(BaseModel):
                        .select()
                        .where(((Gym.last_scanned >
                                 datetime.utcfromtimestamp(timestamp / 1000)) &
-                               (Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)))
+                               in_box(Gym, swLat, swLng, neLat, neLng)))
                        .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send gyms in view but exclude those within old boundaries. Only
             # send newly uncovered gyms.
             results = (Gym
                        .select()
-                       .where(((Gym.latitude >= swLat) &
-                               (Gym.longitude >= swLng) &
-                               (Gym.latitude <= neLat) &
-                               (Gym.longitude <= neLng)) &
+                       .where(in_box(Gym, swLat, swLng, neLat, neLng) &
                               ~((Gym.latitude >= oSwLat) &
                                 (Gym.longitude >= oSwLng) &
                                 (Gym.latitude <= oNeLat) &
@@ -589,10 +1232,7 @@ class Gym(BaseModel):
         else:
             results = (Gym
                        .select()
-                       .where((Gym.latitude >= swLat) &
-                              (Gym.longitude >= swLng) &
-                              (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng))
+                       .where(in_box(Gym, swLat, swLng, neLat, neLng))
                        .dicts())
 
         # Performance:  disable the garbage collector prior to creating a
@@ -735,10 +1375,7 @@ class LocationAltitude(BaseModel):
         # Get all location altitudes in that box.
         query = (cls
                  .select()
-                 .where((cls.latitude <= n) &
-                        (cls.latitude >= s) &
-                        (cls.longitude >= w) &
-                        (cls.longitude <= e))
+                 .where(in_box(cls, s, w, n, e))
                  .dicts())
 
         altitude = None
@@ -794,6 +1431,7 @@ class ScannedLocation(BaseModel):
                        Check('width >= 0'), Check('width <= 130')]
 
     @staticmethod
+    @read_replica
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None,
                    oSwLng=None, oNeLat=None, oNeLng=None):
         activeTime = (datetime.utcnow() - timedelta(minutes=15))
@@ -802,10 +1440,8 @@ class ScannedLocation(BaseModel):
                      .select()
                      .where(((ScannedLocation.last_modified >=
                               datetime.utcfromtimestamp(timestamp / 1000))) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
+                            in_box(ScannedLocation, swLat, swLng,
+                                   neLat, neLng))
                      .dicts())
         elif oSwLat and oSwLng and oNeLat and oNeLng:
             # Send scannedlocations in view but exclude those within old
@@ -813,10 +1449,8 @@ class ScannedLocation(BaseModel):
             query = (ScannedLocation
                      .select()
                      .where((((ScannedLocation.last_modified >= activeTime)) &
-                             (ScannedLocation.latitude >= swLat) &
-                             (ScannedLocation.longitude >= swLng) &
-                             (ScannedLocation.latitude <= neLat) &
-                             (ScannedLocation.longitude <= neLng)) &
+                             in_box(ScannedLocation, swLat, swLng,
+                                    neLat, neLng)) &
                             ~(((ScannedLocation.last_modified >= activeTime)) &
                               (ScannedLocation.latitude >= oSwLat) &
                               (ScannedLocation.longitude >= oSwLng) &
@@ -827,10 +1461,8 @@ class ScannedLocation(BaseModel):
             query = (ScannedLocation
                      .select()
                      .where((ScannedLocation.last_modified >= activeTime) &
-                            (ScannedLocation.latitude >= swLat) &
-                            (ScannedLocation.longitude >= swLng) &
-                            (ScannedLocation.latitude <= neLat) &
-                            (ScannedLocation.longitude <= neLng))
+                            in_box(ScannedLocation, swLat, swLng,
+                                   neLat, neLng))
                      .order_by(ScannedLocation.last_modified.asc())
                      .dicts())
 
@@ -913,7 +1545,7 @@ class ScannedLocation(BaseModel):
                     continue
                 if in_radius((sp['latitude'], sp['longitude']),
                              scan['loc'], distance):
-                    scan_spawn_point[cell + sp['id']] = {
+                    scan_spawn_point[(cell, sp['id'])] = {
                         'spawnpoint': sp['id'],
                         'scannedlocation': cell}
 
@@ -1147,6 +1779,18 @@ class WorkerStatus(BaseModel):
                 'latitude': status.get('latitude', None),
                 'longitude': status.get('longitude', None)}
 
+    # Last known location of every account that has scanned.
+    @staticmethod
+    def get_locations():
+        query = (WorkerStatus
+                 .select(WorkerStatus.username, WorkerStatus.latitude,
+                         WorkerStatus.longitude)
+                 .where(WorkerStatus.latitude.is_null(False))
+                 .dicts())
+
+        return {w['username']: (w['latitude'], w['longitude'], 0)
+                for w in query}
+
     @staticmethod
     def get_recent():
         query = (WorkerStatus
@@ -1196,9 +1840,10 @@ class WorkerStatus(BaseModel):
 
 
 class SpawnPoint(BaseModel):
-    id = Utf8mb4CharField(primary_key=True, max_length=50)
+    id = BigIntegerField(primary_key=True)
     latitude = DoubleField()
     longitude = DoubleField()
+    s2_cell = BigIntegerField(null=True, index=True)
     last_scanned = DateTimeField(index=True)
     # kind gives the four quartiles of the spawn, as 's' for seen
     # or 'h' for hidden.  For example, a 30 minute spawn is 'hhss'.
@@ -1228,6 +1873,16 @@ class SpawnPoint(BaseModel):
     # appearance.
     earliest_unseen = SmallIntegerField()
 
+    # Summary of all sightings of this spawnpoint (JSON), updated with every
+    # sighting so classifying doesn't need to read them back.
+    summary = TextField(null=True)
+
+    # Seconds after the hour the spawnpoint was seen at, and was scanned
+    # without its Pokemon while narrowing down the TTH, as packed 3600 bit
+    # masks in hex.
+    seen_mask = TextField(null=True)
+    unseen_mask = TextField(null=True)
+
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
         constraints = [Check('earliest_unseen >= 0'),
@@ -1251,8 +1906,11 @@ class SpawnPoint(BaseModel):
             'links': '????',
             'missed_count': 0,
             'latest_seen': None,
-            'earliest_unseen': None
-
+            'earliest_unseen': None,
+            's2_cell': None,
+            'summary': None,
+            'seen_mask': None,
+            'unseen_mask': None
         }
 
     # Confirm if tth has been found.
@@ -1394,10 +2052,7 @@ class SpawnPoint(BaseModel):
         # Get all spawns in that box.
         sp = list(cls
                   .select()
-                  .where((cls.latitude <= n) &
-                         (cls.latitude >= s) &
-                         (cls.longitude >= w) &
-                         (cls.longitude <= e))
+                  .where(in_box(cls, s, w, n, e))
                   .dicts())
 
         # For each spawn work out if it is in the hex (clipping the diagonals).
@@ -1438,27 +2093,146 @@ class SpawnpointDetectionData(BaseModel):
     scan_time = DateTimeField()
     tth_secs = SmallIntegerField(null=True)
 
+    # Reset earliest_unseen to 15 minutes after latest_seen, narrowed down to
+    # the first time the spawnpoint was scanned without its Pokemon since.
     @staticmethod
     def set_default_earliest_unseen(sp):
+        start = (sp['latest_seen'] + 1) % 3600
         sp['earliest_unseen'] = (sp['latest_seen'] + 15 * 60) % 3600
 
-    @classmethod
-    def classify(cls, sp, scan_loc, now_secs, sighting=None):
+        window = (hour_mask_range(start, sp['earliest_unseen']) &
+                  hour_mask_from_db(sp.get('unseen_mask')) &
+                  ~hour_mask_from_db(sp.get('seen_mask')))
+        if window:
+            sp['earliest_unseen'] = hour_mask_next(window, start)
 
-        # Get past sightings.
-        query = list(cls.select()
-                        .where(cls.spawnpoint_id == sp['id'])
+    # Return the sightings summary of a spawnpoint. Spawnpoints from before
+    # summaries were kept get theirs built once from the stored sightings.
+    #
+    # count: number of sightings.
+    # seen: hour mask of the seconds after the hour it was seen at.
+    # tth: seconds after the hour of the latest TTH found, or None.
+    # last: [timestamp, encounter id] of the latest sighting.
+    # unions: non-overlapping [start, end] ranges (seconds after the hour)
+    #   during which the same encounter id was there.
+    @classmethod
+    def get_summary(cls, sp):
+        if sp.get('summary'):
+            summary = json.loads(sp['summary'])
+            if isinstance(summary.get('seen'), list):
+                # Summaries from before the seen mask kept a sorted list.
+                summary['seen'] = reduce(lambda mask, secs: mask | 1 << secs,
+                                         summary['seen'], 0)
+            else:
+                summary['seen'] = hour_mask_from_db(sp.get('seen_mask'))
+            return summary
+
+        summary = {'count': 0, 'seen': 0, 'tth': None, 'last': None,
+                   'unions': []}
+        if sp['last_scanned']:
+            query = (cls.select()
+                        .where(cls.spawnpoint_id ==
+                               spawnpoint_id_from_db(sp['id']))
                         .order_by(cls.scan_time.asc())
                         .dicts())
+            for s in query:
+                cls.add_sighting(summary, s)
 
+        return summary
+
+    @staticmethod
+    def save_summary(sp, summary):
+        summary = dict(summary)
+        sp['seen_mask'] = hour_mask_to_db(summary.pop('seen'))
+        sp['summary'] = json.dumps(summary, separators=(',', ':'))
+
+    # Add a sighting to a summary.
+    @classmethod
+    def add_sighting(cls, summary, sighting):
+        scan_time = calendar.timegm(sighting['scan_time'].utctimetuple())
+        secs = scan_time % 3600
+
+        summary['count'] += 1
+        summary['seen'] |= 1 << secs
+
+        if sighting['tth_secs'] is not None:
+            summary['tth'] = (sighting['tth_secs'] - 1) % 3600
+
+        # For 60 minute spawns ('ssss'), the largest gap doesn't give the
+        # earliest spawnpoint because a Pokemon is always there. Keep the
+        # union of all intervals where the same encounter ID was seen. If a
+        # different encounter ID was seen, then the complement of that
+        # interval was the same ID, so union that complement as well.
+        if summary['last']:
+            last_time, last_encounter_id = summary['last']
+            delta = scan_time - last_time
+            if 0 <= delta < 3600:
+                if last_encounter_id == sighting['encounter_id']:
+                    start = last_time % 3600
+                    end = (start + delta) % 3600
+                else:
+                    # Convert diff range to same range by taking the clock
+                    # complement.
+                    start = secs
+                    end = last_time % 3600
+                cls.add_union(summary['unions'], [start, end])
+
+        summary['last'] = [scan_time, sighting['encounter_id']]
+
+    # Merge the range into the list of unions of ranges, accounting for hour
+    # wraparound.
+    @staticmethod
+    def add_union(unions, new):
+        merged = True
+        while merged:
+            merged = False
+            for u in unions:
+                if clock_between(u[0], new[0], u[1]):
+                    first, second = u, new
+                elif clock_between(new[0], u[0], new[1]):
+                    first, second = new, u
+                else:
+                    continue
+
+                # The second range starts inside the first one, so the
+                # union starts with the first one and ends with the one
+                # reaching furthest.
+                if clock_between(second[0], first[0], second[1]):
+                    new = [first[0], (first[0] - 1) % 3600]
+                elif ((second[1] - first[0]) % 3600 >
+                        (first[1] - first[0]) % 3600):
+                    new = [first[0], second[1]]
+                else:
+                    new = list(first)
+                unions.remove(u)
+                merged = True
+                break
+
+        unions.append(new)
+
+    @classmethod
+    def classify(cls, sp, scan_loc, now_secs, sighting=None):
+        spawnpoint_summaries.update(
+            sp, lambda sp: cls._classify(sp, scan_loc, now_secs, sighting),
+            prepare=cls.load_summary)
+
+    # Store the summary of a spawnpoint that doesn't have one yet, built
+    # from its sightings in the database.
+    @classmethod
+    def load_summary(cls, sp):
+        if not sp.get('summary'):
+            cls.save_summary(sp, cls.get_summary(sp))
+
+    @classmethod
+    def _classify(cls, sp, scan_loc, now_secs, sighting):
+        cls.load_summary(sp)
+        summary = cls.get_summary(sp)
         if sighting:
-            query.append(sighting)
+            cls.add_sighting(summary, sighting)
+            cls.save_summary(sp, summary)
 
-        tth_found = False
-        for s in query:
-            if s['tth_secs'] is not None:
-                tth_found = True
-                tth_secs = (s['tth_secs'] - 1) % 3600
+        tth_found = summary['tth'] is not None
+        tth_secs = summary['tth']
 
         # To reduce CPU usage, give an intial reading of 15 minute spawns if
         # not done with initial scan of location.
@@ -1479,19 +2253,17 @@ class SpawnpointDetectionData(BaseModel):
         # Make a record of links, so we can reset earliest_unseen
         # if it changes.
         old_kind = str(sp['kind'])
-        # Make a sorted list of the seconds after the hour.
-        seen_secs = sorted(map(lambda x: date_secs(x['scan_time']), query))
         # Include and entry for the TTH if it found
+        seen = summary['seen']
         if tth_found:
-            seen_secs.append(tth_secs)
-            seen_secs.sort()
-        # Add the first seen_secs to the end as a clock wrap around.
-        if seen_secs:
-            seen_secs.append(seen_secs[0] + 3600)
+            seen |= 1 << tth_secs
+
+        # Make a list of gaps between sightings, wrapping around the hour.
+        first_seen, gap_list = hour_mask_gaps(seen)
 
-        # Make a list of gaps between sightings.
-        gap_list = [seen_secs[i + 1] - seen_secs[i]
-                    for i in range(len(seen_secs) - 1)]
+        # Nothing to classify without sightings.
+        if not gap_list:
+            return
 
         max_gap = max(gap_list)
 
@@ -1502,7 +2274,9 @@ class SpawnpointDetectionData(BaseModel):
 
         # If the second largest gap is larger than 15 minutes, then there are
         # two gaps greater than 15 minutes.  It must be a double spawn.
-        if len(gap_list) > 4 and sorted(gap_list)[-2] > 900:
+        sightings = summary['count'] + (1 if tth_found else 0)
+        if (sightings > 4 and len(gap_list) > 1 and
+                sorted(gap_list)[-2] > 900):
             sp['kind'] = 'hshs'
             sp['links'] = 'h?h?'
 
@@ -1522,7 +2296,8 @@ class SpawnpointDetectionData(BaseModel):
                     not tth_found):
 
                 # New latest_seen will be just before max_gap.
-                sp['latest_seen'] = seen_secs[gap_list.index(max_gap)]
+                sp['latest_seen'] = (first_seen + sum(
+                    gap_list[:gap_list.index(max_gap)])) % 3600
 
                 # if we don't have a earliest_unseen yet or if the kind of
                 # spawn has changed, reset to latest_seen + 14 minutes.
@@ -1536,74 +2311,11 @@ class SpawnpointDetectionData(BaseModel):
         if sp['earliest_unseen'] == sp['latest_seen']:
             return
 
-        # Make a sight_list of dicts:
-        # {date: first seen time,
-        # delta: duration of sighting,
-        # same: whether encounter ID was same or different over that time}
-        #
-        # For 60 minute spawns ('ssss'), the largest gap doesn't give the
-        # earliest spawnpoint because a Pokemon is always there.  Use the union
-        # of all intervals where the same encounter ID was seen to find the
-        # latest_seen.  If a different encounter ID was seen, then the
-        # complement of that interval was the same ID, so union that
-        # complement as well.
-
-        sight_list = [{'date': query[i]['scan_time'],
-                       'delta': query[i + 1]['scan_time'] -
-                       query[i]['scan_time'],
-                       'same': query[i + 1]['encounter_id'] ==
-                       query[i]['encounter_id']
-                       }
-                      for i in range(len(query) - 1)
-                      if query[i + 1]['scan_time'] - query[i]['scan_time'] <
-                      timedelta(hours=1)
-                      ]
-
-        start_end_list = []
-        for s in sight_list:
-            if s['same']:
-                # Get the seconds past the hour for start and end times.
-                start = date_secs(s['date'])
-                end = (start + int(s['delta'].total_seconds())) % 3600
-
-            else:
-                # Convert diff range to same range by taking the clock
-                # complement.
-                start = date_secs(s['date'] + s['delta']) % 3600
-                end = date_secs(s['date'])
-
-            start_end_list.append([start, end])
-
-        # Take the union of all the ranges.
-        while True:
-            # union is list of unions of ranges with the same encounter id.
-            union = []
-            for start, end in start_end_list:
-                if not union:
-                    union.append([start, end])
-                    continue
-                # Cycle through all ranges in union, since it might overlap
-                # with any of them.
-                for u in union:
-                    if clock_between(u[0], start, u[1]):
-                        u[1] = end if not(clock_between(
-                            u[0], end, u[1])) else u[1]
-                    elif clock_between(u[0], end, u[1]):
-                        u[0] = start if not(clock_between(
-                            u[0], start, u[1])) else u[0]
-                    elif union.count([start, end]) == 0:
-                        union.append([start, end])
-
-            # Are no more unions possible?
-            if union == start_end_list:
-                break
-
-            start_end_list = union  # Make another pass looking for unions.
-
         # If more than one disparate union, take the largest as our starting
         # point.
         union = reduce(lambda x, y: x if (x[1] - x[0]) % 3600 >
-                       (y[1] - y[0]) % 3600 else y, union, [0, 3600])
+                       (y[1] - y[0]) % 3600 else y, summary['unions'],
+                       [0, 3600])
         sp['latest_seen'] = union[1]
         sp['earliest_unseen'] = union[0]
         log.info('1x60: appear %d, despawn %d, duration: %d min.',
@@ -1613,7 +2325,11 @@ class SpawnpointDetectionData(BaseModel):
     # wasn't there.  Return true if spawnpoint dict changed.
     @classmethod
     def unseen(cls, sp, now_secs):
+        return spawnpoint_summaries.update(
+            sp, lambda sp: cls._unseen(sp, now_secs))
 
+    @staticmethod
+    def _unseen(sp, now_secs):
         # Return if we already have a tth.
         if sp['latest_seen'] == sp['earliest_unseen']:
             return False
@@ -1624,6 +2340,8 @@ class SpawnpointDetectionData(BaseModel):
             return False
 
         sp['earliest_unseen'] = now_secs
+        sp['unseen_mask'] = hour_mask_to_db(
+            hour_mask_from_db(sp.get('unseen_mask')) | 1 << now_secs)
 
         return True
 
@@ -1777,54 +2495,54 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
     pokestops = {}
     skipped_stops = 0
     gyms = {}
-    forts = []
     forts_count = 0
-    wild_pokemon = []
     wild_pokemon_count = 0
     nearby_pokemon = 0
     spawn_points = {}
     scan_spawn_points = {}
-    sightings = {}
     new_spawn_points = []
     sp_id_list = []
+    encountered_pokemon = set()
+    encountered_pokestops = set()
+    skipped_gyms = 0
+    cached_mons = 0
+    cached_stops = 0
+    prefetch_queries = 0
+    prefetch_secs = 0.0
+    parse_start = default_timer()
+
+    # Take the map cells out of the response, so they (and the inventory)
+    # can be freed as soon as we're done with them.
+    responses = map_dict['responses']
+    cells = responses.pop('GET_MAP_OBJECTS')['map_cells']
+    responses.pop('GET_INVENTORY', None)
+
+    # If we have map responses then use the time from the request.
+    if cells:
+        now_date = datetime.utcfromtimestamp(
+            cells[0]['current_timestamp_ms'] / 1000)
+    now_secs = date_secs(now_date)
 
-    # Consolidate the individual lists in each cell into two lists of Pokemon
-    # and a list of forts.
-    cells = map_dict['responses']['GET_MAP_OBJECTS']['map_cells']
-
-    # Helping out the GC.
-    if 'GET_INVENTORY' in map_dict['responses']:
-        del map_dict['responses']['GET_INVENTORY']
-
-    for i, cell in enumerate(cells):
-        # If we have map responses then use the time from the request
-        if i == 0:
-            now_date = datetime.utcfromtimestamp(
-                cell['current_timestamp_ms'] / 1000)
-
-        nearby_pokemon += len(cell.get('nearby_pokemons', []))
-        # Parse everything for stats (counts).  Future enhancement -- we don't
-        # necessarily need to know *how many* forts/wild/nearby were found but
-        # we'd like to know whether or not *any* were found to help determine
-        # if a scan was actually bad.
-        if config['parse_pokemon']:
-            wild_pokemon += cell.get('wild_pokemons', [])
-
-        if config['parse_pokestops'] or config['parse_gyms']:
-            forts += cell.get('forts', [])
-
-        # Update count regardless of Pokemon parsing or not, we need the count.
-        # Length is O(1).
-        wild_pokemon_count += len(cell.get('wild_pokemons', []))
-        forts_count += len(cell.get('forts', []))
+    # Walk the cells once for the counts and flat lists of the objects we
+    # parse. Count everything for stats, we need to know whether *any*
+    # Pokemon or forts were found to help determine if a scan was actually
+    # bad.
+    parse_forts = config['parse_pokestops'] or config['parse_gyms']
+    wild_pokemon = []
+    forts = []
+    for cell in cells:
+        nearby_pokemon += len(cell.get('nearby_pokemons', ()))
 
-    now_secs = date_secs(now_date)
-    if wild_pokemon:
-        wild_pokemon_count = len(wild_pokemon)
-    if forts:
-        forts_count = len(forts)
+        cell_pokemon = cell.get('wild_pokemons', ())
+        wild_pokemon_count += len(cell_pokemon)
+        if config['parse_pokemon']:
+            wild_pokemon.extend(cell_pokemon)
 
-    del map_dict['responses']['GET_MAP_OBJECTS']
+        cell_forts = cell.get('forts', ())
+        forts_count += len(cell_forts)
+        if parse_forts:
+            forts.extend(cell_forts)
+    del cells
 
     # If there are no wild or nearby Pokemon . . .
     if not wild_pokemon and not nearby_pokemon:
@@ -1843,49 +2561,70 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
     ScannedLocation.update_band(scan_loc, now_date)
     just_completed = not done_already and scan_loc['done']
 
-    if wild_pokemon and config['parse_pokemon']:
-        encounter_ids = [b64encode(str(p['encounter_id']))
+    if wild_pokemon:
+        # Convert every encounter and spawnpoint id to its database integer
+        # once and reuse it below.
+        encounter_ids = [encounter_id_to_db(p['encounter_id'])
                          for p in wild_pokemon]
-        # For all the wild Pokemon we found check if an active Pokemon is in
-        # the database.
-        query = (Pokemon
-                 .select(Pokemon.encounter_id, Pokemon.spawnpoint_id)
-                 .where((Pokemon.disappear_time >= now_date) &
-                        (Pokemon.encounter_id << encounter_ids))
-                 .dicts())
-
-        # Store all encounter_ids and spawnpoint_ids for the Pokemon in query.
-        # All of that is needed to make sure it's unique.
-        encountered_pokemon = [
-            (p['encounter_id'], p['spawnpoint_id']) for p in query]
+        spawnpoint_ids = [spawnpoint_id_to_db(p['spawn_point_id'])
+                          for p in wild_pokemon]
+        # Prefetch stage: Pokemon we know are stored don't need a query.
+        # For the other wild Pokemon we found check if an active Pokemon is
+        # in the database.
+        query_ids = []
+        for encounter_id, spawnpoint_id in itertools.izip(encounter_ids,
+                                                          spawnpoint_ids):
+            if known_pokemon.contains(encounter_id, spawnpoint_id, now_date):
+                encountered_pokemon.add((encounter_id, spawnpoint_id))
+                cached_mons += 1
+            else:
+                query_ids.append(encounter_id)
 
-        for p in wild_pokemon:
+        if query_ids:
+            prefetch_start = default_timer()
+            query = (Pokemon
+                     .select(Pokemon.encounter_id, Pokemon.spawnpoint_id,
+                             Pokemon.disappear_time)
+                     .where((Pokemon.disappear_time >= now_date) &
+                            (Pokemon.encounter_id << query_ids))
+                     .dicts())
 
-            sp = SpawnPoint.get_by_id(p['spawn_point_id'], p[
-                                      'latitude'], p['longitude'])
-            spawn_points[p['spawn_point_id']] = sp
+            # Store all encounter_ids and spawnpoint_ids for the Pokemon in
+            # query. All of that is needed to make sure it's unique.
+            for p in query:
+                encountered_pokemon.add(
+                    (p['encounter_id'], p['spawnpoint_id']))
+                known_pokemon.add(p['encounter_id'], p['spawnpoint_id'],
+                                  p['disappear_time'])
+            prefetch_queries += 1
+            prefetch_secs += default_timer() - prefetch_start
+
+        for encounter_id, spawnpoint_id, p in itertools.izip(
+                encounter_ids, spawnpoint_ids, wild_pokemon):
+            sp = SpawnPoint.get_by_id(spawnpoint_id, p['latitude'],
+                                      p['longitude'])
+            spawn_points[spawnpoint_id] = sp
             sp['missed_count'] = 0
+            last_modified_ms = p['last_modified_timestamp_ms']
 
             sighting = {
-                'id': b64encode(str(p['encounter_id'])) + '_' + str(now_secs),
-                'encounter_id': b64encode(str(p['encounter_id'])),
-                'spawnpoint_id': p['spawn_point_id'],
+                'encounter_id': encounter_id,
                 'scan_time': now_date,
                 'tth_secs': None
             }
 
             # Keep a list of sp_ids to return.
-            sp_id_list.append(p['spawn_point_id'])
+            sp_id_list.append(spawnpoint_id)
 
             # time_till_hidden_ms was overflowing causing a negative integer.
             # It was also returning a value above 3.6M ms.
             if 0 < p['time_till_hidden_ms'] < 3600000:
                 d_t_secs = date_secs(datetime.utcfromtimestamp(
-                    (p['last_modified_timestamp_ms'] +
-                     p['time_till_hidden_ms']) / 1000.0))
+                    (last_modified_ms + p['time_till_hidden_ms']) / 1000.0))
                 if (sp['latest_seen'] != sp['earliest_unseen'] or
                         not sp['last_scanned']):
-                    log.info('TTH found for spawnpoint %s.', sp['id'])
+                    log.info('TTH found for spawnpoint %s.',
+                             p['spawn_point_id'])
                     sighting['tth_secs'] = d_t_secs
 
                     # Only update when TTH is seen for the first time.
@@ -1895,7 +2634,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                     sp['latest_seen'] = d_t_secs
                     sp['earliest_unseen'] = d_t_secs
 
-            scan_spawn_points[scan_loc['cellid'] + sp['id']] = {
+            scan_spawn_points[(scan_loc['cellid'], sp['id'])] = {
                 'spawnpoint': sp['id'],
                 'scannedlocation': scan_loc['cellid']}
             if not sp['last_scanned']:
@@ -1916,20 +2655,20 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                     not scan_loc['done'] or just_completed):
                 SpawnpointDetectionData.classify(sp, scan_loc, now_secs,
                                                  sighting)
-                sightings[p['encounter_id']] = sighting
 
             sp['last_scanned'] = datetime.utcfromtimestamp(
-                p['last_modified_timestamp_ms'] / 1000.0)
+                last_modified_ms / 1000.0)
 
             start_end = SpawnPoint.start_end(sp, 1)
             seconds_until_despawn = (start_end[1] - now_secs) % 3600
             disappear_time = now_date + \
                 timedelta(seconds=seconds_until_despawn)
 
-            pokemon_id = p['pokemon_data']['pokemon_id']
+            pokemon_data = p['pokemon_data']
+            pokemon_id = pokemon_data['pokemon_id']
             pokemon = {
-                'encounter_id': b64encode(str(p['encounter_id'])),
-                'spawnpoint_id': p['spawn_point_id'],
+                'encounter_id': encounter_id,
+                'spawnpoint_id': spawnpoint_id,
                 'pokemon_id': pokemon_id,
                 'latitude': p['latitude'],
                 'longitude': p['longitude'],
@@ -1943,27 +2682,23 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                 'cp_multiplier': None,
                 'height': None,
                 'weight': None,
-                'gender': p['pokemon_data']['pokemon_display']['gender'],
+                'gender': pokemon_data['pokemon_display']['gender'],
                 'form': None
             }
 
             # Check for Unown's alphabetic character.
             if pokemon_id == 201:
-                pokemon['form'] = p['pokemon_data'][
-                    'pokemon_display'].get('form', None)
-
-            # Prepare Pokemon webhook message.
-            webhooks = args.webhooks and (
-                            pokemon_id in args.webhook_whitelist or (
-                                not args.webhook_whitelist and (
-                                    pokemon_id not in args.webhook_blacklist)))
+                pokemon['form'] = pokemon_data['pokemon_display'].get(
+                    'form', None)
 
+            # Prepare Pokemon webhook message. Filtering per webhook is done
+            # by the webhook router.
             wh_data = None
-            if webhooks:
+            if args.webhooks:
                 wh_data = {
                     'disappear_time': calendar.timegm(
                                         disappear_time.timetuple()),
-                    'last_modified_time': p['last_modified_timestamp_ms'],
+                    'last_modified_time': last_modified_ms,
                     'time_until_hidden_ms': p['time_till_hidden_ms'],
                     'verified': SpawnPoint.tth_found(sp),
                     'seconds_until_despawn': seconds_until_despawn,
@@ -1974,8 +2709,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
             if pokemon_id in args.pokemon_catch_list:
                 catch_pokemons[p['encounter_id']] = (pokemon, wh_data)
 
-            if ((b64encode(str(p['encounter_id'])), p['spawn_point_id'])
-                    in encountered_pokemon):
+            # Diff stage.
+            if (encounter_id, spawnpoint_id) in encountered_pokemon:
                 # If Pokemon has been encountered before don't process it.
                 skipped_mons += 1
                 continue
@@ -1988,62 +2723,68 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                 # If we're going to encounter Pokemon, don't process it.
                 continue
 
-            # Process Pokemon data to database.
+            # Emit stage: process Pokemon data to database.
             pokemons[p['encounter_id']] = pokemon
+            known_pokemon.add(encounter_id, spawnpoint_id, disappear_time)
 
-            if webhooks:
+            if args.webhooks:
                 wh_poke = pokemon.copy()
                 wh_poke.update(wh_data)
                 wh_poke['player_level'] = account['level']
                 wh_update_queue.put(('pokemon', wh_poke))
 
-    if forts and (config['parse_pokestops'] or config['parse_gyms']):
+    if forts:
         if config['parse_pokestops']:
-            stop_ids = [f['id'] for f in forts if f.get('type') == 1]
+            # Prefetch stage: pokestops we already know aren't looked up in
+            # the database again.
+            stop_ids = []
+            with known_forts_lock:
+                for f in forts:
+                    if f.get('type') != 1:
+                        continue
+                    known = known_pokestops.get(f['id'])
+                    if known is not None:
+                        encountered_pokestops.add((f['id'], known))
+                        cached_stops += 1
+                    else:
+                        stop_ids.append(f['id'])
+
             if stop_ids:
+                prefetch_start = default_timer()
                 query = (Pokestop
                          .select(Pokestop.pokestop_id, Pokestop.last_modified)
                          .where((Pokestop.pokestop_id << stop_ids))
                          .dicts())
-                encountered_pokestops = [(f['pokestop_id'], int(
+                encountered_pokestops.update((f['pokestop_id'], int(
                     (f['last_modified'] -
-                     datetime(1970, 1, 1)).total_seconds())) for f in query]
+                     datetime(1970, 1, 1)).total_seconds())) for f in query)
+                prefetch_queries += 1
+                prefetch_secs += default_timer() - prefetch_start
 
         for f in forts:
-            if config['parse_pokestops'] and f.get('type') == 1:  # Pokestops.
+            fort_type = f.get('type')
+            last_modified_ms = f['last_modified_timestamp_ms']
+
+            if config['parse_pokestops'] and fort_type == 1:  # Pokestops.
 
                 location = (f['latitude'], f['longitude'])
                 if in_radius(step_location, location, 0.100):
                     log.debug('Enqueued Pokestop #%s for visit.', f['id'])
                     visit_pokestops[f['id']] = f
 
+                last_modified = datetime.utcfromtimestamp(
+                    last_modified_ms / 1000.0)
+                lure_expiration, active_fort_modifier = None, None
                 if 'active_fort_modifier' in f:
-                    lure_expiration = (datetime.utcfromtimestamp(
-                        f['last_modified_timestamp_ms'] / 1000.0) +
-                        timedelta(minutes=args.lure_duration))
+                    lure_expiration = (last_modified +
+                                       timedelta(minutes=args.lure_duration))
                     active_fort_modifier = f['active_fort_modifier']
-                    if args.webhooks and args.webhook_updates_only:
-                        wh_update_queue.put(('pokestop', {
-                            'pokestop_id': b64encode(str(f['id'])),
-                            'enabled': f.get('enabled', False),
-                            'latitude': f['latitude'],
-                            'longitude': f['longitude'],
-                            'last_modified_time': f[
-                                'last_modified_timestamp_ms'],
-                            'lure_expiration': calendar.timegm(
-                                lure_expiration.timetuple()),
-                            'active_fort_modifier': active_fort_modifier
-                        }))
-                else:
-                    lure_expiration, active_fort_modifier = None, None
 
-                # Send all pokestops to webhooks.
-                if args.webhooks and not args.webhook_updates_only:
-                    # Explicitly set 'webhook_data', in case we want to change
-                    # the information pushed to webhooks.  Similar to above and
-                    # previous commits.
+                # Send all pokestops to webhooks, or only lured ones when
+                # only sending updates.
+                if args.webhooks and (lure_expiration is not None or
+                                      not args.webhook_updates_only):
                     l_e = None
-
                     if lure_expiration is not None:
                         l_e = calendar.timegm(lure_expiration.timetuple())
 
@@ -2052,12 +2793,13 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                         'enabled': f.get('enabled', False),
                         'latitude': f['latitude'],
                         'longitude': f['longitude'],
-                        'last_modified_time': f['last_modified_timestamp_ms'],
+                        'last_modified_time': last_modified_ms,
                         'lure_expiration': l_e,
                         'active_fort_modifier': active_fort_modifier
                     }))
 
-                if ((f['id'], int(f['last_modified_timestamp_ms'] / 1000.0))
+                # Diff stage.
+                if ((f['id'], int(last_modified_ms / 1000.0))
                         in encountered_pokestops):
                     # If pokestop has been encountered before and hasn't
                     # changed don't process it.
@@ -2069,31 +2811,14 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                     'enabled': f.get('enabled', False),
                     'latitude': f['latitude'],
                     'longitude': f['longitude'],
-                    'last_modified': datetime.utcfromtimestamp(
-                        f['last_modified_timestamp_ms'] / 1000.0),
+                    'last_modified': last_modified,
                     'lure_expiration': lure_expiration,
                     'active_fort_modifier': active_fort_modifier
                 }
 
             # Currently, there are only stops and gyms.
-            elif config['parse_gyms'] and f.get('type') is None:
-                # Send gyms to webhooks.
-                if args.webhooks and not args.webhook_updates_only:
-                    # Explicitly set 'webhook_data', in case we want to change
-                    # the information pushed to webhooks.  Similar to above
-                    # and previous commits.
-                    wh_update_queue.put(('gym', {
-                        'gym_id': b64encode(str(f['id'])),
-                        'team_id': f.get('owned_by_team', 0),
-                        'guard_pokemon_id': f.get('guard_pokemon_id', 0),
-                        'gym_points': f.get('gym_points', 0),
-                        'enabled': f.get('enabled', False),
-                        'latitude': f['latitude'],
-                        'longitude': f['longitude'],
-                        'last_modified': f['last_modified_timestamp_ms']
-                    }))
-
-                gyms[f['id']] = {
+            elif config['parse_gyms'] and fort_type is None:
+                gym = {
                     'gym_id': f['id'],
                     'team_id': f.get('owned_by_team', 0),
                     'guard_pokemon_id': f.get('guard_pokemon_id', 0),
@@ -2102,11 +2827,37 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                     'latitude': f['latitude'],
                     'longitude': f['longitude'],
                     'last_modified': datetime.utcfromtimestamp(
-                        f['last_modified_timestamp_ms'] / 1000.0),
+                        last_modified_ms / 1000.0),
                 }
+                gyms[f['id']] = gym
 
-        # Helping out the GC.
-        del forts
+                # Send gyms to webhooks. The webhook's cache deduplicates
+                # them, so they're sent even when we skip the upsert.
+                if args.webhooks and not args.webhook_updates_only:
+                    wh_gym = gym.copy()
+                    wh_gym['gym_id'] = b64encode(str(f['id']))
+                    wh_gym['last_modified'] = last_modified_ms
+                    wh_update_queue.put(('gym', wh_gym))
+
+    # Diff stage for gyms: only write gyms whose state changed since we
+    # last stored them. All gyms are still returned for gym info.
+    db_gyms = {}
+    with known_forts_lock:
+        for gym_id, gym in gyms.items():
+            state = (gym['team_id'], gym['guard_pokemon_id'],
+                     gym['gym_points'], gym['enabled'], gym['last_modified'])
+            if known_gyms.get(gym_id) == state:
+                skipped_gyms += 1
+            else:
+                db_gyms[gym_id] = gym
+                known_gyms[gym_id] = state
+
+        for pokestop_id, last_modified in encountered_pokestops:
+            known_pokestops[pokestop_id] = last_modified
+        for pokestop_id, pokestop in pokestops.items():
+            known_pokestops[pokestop_id] = int(
+                (pokestop['last_modified'] -
+                 datetime(1970, 1, 1)).total_seconds())
 
     log.info('Parsing found Pokemon: %d, nearby: %d, pokestops: %d, gyms: %d.',
              len(pokemons) + skipped_mons + len(encounter_pokemons),
@@ -2114,13 +2865,16 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
              len(pokestops) + skipped_stops,
              len(gyms))
 
-    log.debug('Skipped %d Pokemons, %d Pokestops and enqueued %d encounters.',
-              skipped_mons, skipped_stops, len(encounter_pokemons))
+    log.debug('Skipped %d Pokemons (%d without query), %d Pokestops (%d'
+              + ' without query), %d Gyms and enqueued %d encounters.',
+              skipped_mons, cached_mons, skipped_stops, cached_stops,
+              skipped_gyms, len(encounter_pokemons))
 
     # Look for spawnpoints within scan_loc that are not here to see if we
     # can narrow down tth window.
+    sp_ids = set(sp_id_list)
     for sp in ScannedLocation.linked_spawn_points(scan_loc['cellid']):
-        if sp['id'] in sp_id_list:
+        if sp['id'] in sp_ids:
             # Don't overwrite changes from this parse with DB version.
             sp = spawn_points[sp['id']]
         else:
@@ -2138,7 +2892,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                 status['missed'] += 1
                 log.warning('%s kind spawnpoint %s has no Pokemon %d times'
                             ' in a row.',
-                            sp['kind'], sp['id'], sp['missed_count'])
+                            sp['kind'], spawnpoint_id_from_db(sp['id']),
+                            sp['missed_count'])
                 log.info('Possible causes: Still doing initial scan, super'
                          ' rare double spawnpoint during')
                 log.info('hidden period, or Niantic has removed '
@@ -2148,10 +2903,11 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
                 (now_secs - sp['latest_seen'] -
                  args.spawn_delay) % 3600 < 60):
             log.warning('Spawnpoint %s was unable to locate a TTH, with '
-                        'only %ss after Pokemon last seen.', sp['id'],
+                        'only %ss after Pokemon last seen.',
+                        spawnpoint_id_from_db(sp['id']),
                         (now_secs - sp['latest_seen']) % 3600)
             log.info('Restarting current 15 minute search for TTH.')
-            if sp['id'] not in sp_id_list:
+            if sp['id'] not in sp_ids:
                 SpawnpointDetectionData.classify(sp, scan_loc, now_secs)
             sp['latest_seen'] = (sp['latest_seen'] - 60) % 3600
             sp['earliest_unseen'] = (
@@ -2164,13 +2920,25 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
         db_update_queue.put((Pokemon, pokemons))
     if pokestops:
         db_update_queue.put((Pokestop, pokestops))
-    if gyms:
-        db_update_queue.put((Gym, gyms))
+    if db_gyms:
+        db_update_queue.put((Gym, db_gyms))
     if spawn_points:
         db_update_queue.put((SpawnPoint, spawn_points))
         db_update_queue.put((ScanSpawnPoint, scan_spawn_points))
-        if sightings:
-            db_update_queue.put((SpawnpointDetectionData, sightings))
+
+    with parse_stats_lock:
+        parse_stats['scans'] += 1
+        parse_stats['prefetch_queries'] += prefetch_queries
+        parse_stats['prefetch_secs'] += prefetch_secs
+        parse_stats['parse_secs'] += default_timer() - parse_start
+        parse_stats['pokemon_skipped'] += skipped_mons
+        parse_stats['pokestops_skipped'] += skipped_stops
+        parse_stats['pokemon_cached'] += cached_mons
+        parse_stats['pokestops_cached'] += cached_stops
+        parse_stats['gyms_skipped'] += skipped_gyms
+        parse_stats['pokemon_emitted'] += len(pokemons)
+        parse_stats['pokestops_emitted'] += len(pokestops)
+        parse_stats['gyms_emitted'] += len(db_gyms)
 
     if not nearby_pokemon and not wild_pokemon:
         # After parsing the forts, we'll mark this scan as bad due to
@@ -2198,6 +2966,32 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue,
     }
 
 
+def get_parse_stats_message():
+    with parse_stats_lock:
+        stats = dict(parse_stats)
+    scans = max(1, stats['scans'])
+
+    return ('Parsed {} scans ({:.0f}ms avg, {:.0f}ms in {} prefetch ' +
+            'queries) | Skipped Pokemon: {} ({} cached), ' +
+            'Pokestops: {} ({} cached), ' +
+            'Gyms: {} | Written Pokemon: {}, Pokestops: {}, Gyms: {}').format(
+                stats['scans'], 1000 * stats['parse_secs'] / scans,
+                1000 * stats['prefetch_secs'] / scans,
+                stats['prefetch_queries'], stats['pokemon_skipped'],
+                stats['pokemon_cached'], stats['pokestops_skipped'],
+                stats['pokestops_cached'],
+                stats['gyms_skipped'], stats['pokemon_emitted'],
+                stats['pokestops_emitted'], stats['gyms_emitted'])
+
+
+def get_db_pool_stats_message():
+    message = 'DB pool: ' + flaskDb.database.get_stats_message()
+    if replica_db is not None:
+        message += ' | Replica pool: ' + replica_db.get_stats_message()
+
+    return message
+
+
 def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
     gym_details = {}
     gym_members = {}
@@ -2430,21 +3224,14 @@ def clean_db_loop(args):
                             (datetime.now() - timedelta(days=1))))
             query.execute()
 
-            # If desired, clear old Pokemon spawns.
-            if args.purge_data > 0:
-                log.info("Beginning purge of old Pokemon spawns.")
-                start = datetime.utcnow()
-                query = (Pokemon
-                         .delete()
-                         .where((Pokemon.disappear_time <
-                                 (datetime.utcnow() -
-                                  timedelta(hours=args.purge_data)))))
-                rows = query.execute()
-                end = datetime.utcnow()
-                diff = end - start
-                log.info("Completed purge of old Pokemon spawns. "
-                         "%i deleted in %f seconds.",
-                         rows, diff.total_seconds())
+            # Roll up the Pokemon statistics of the past hours before they
+            # can be purged.
+            hours = PokemonHourlyStats.rollup()
+            if hours:
+                log.info('Rolled up Pokemon statistics of %d hours.', hours)
+
+            # Keep the tables with history from growing without bounds.
+            compact_db(args)
 
             log.info('Regular database cleaning complete.')
             time.sleep(60)
@@ -2452,10 +3239,176 @@ def clean_db_loop(args):
             log.exception('Exception in clean_db_loop: %s', repr(e))
 
 
+# Delete the rows matching condition in batches of batch_size primary keys,
+# so writers never wait long for the table. Returns the number of rows
+# deleted and the seconds spent deleting.
+def delete_in_batches(model, condition, batch_size, pause=0.1):
+    pk = model._meta.primary_key
+    rows = 0
+    lock_secs = 0.0
+
+    while True:
+        keys = [key for key, in (model
+                                 .select(pk)
+                                 .where(condition)
+                                 .limit(batch_size)
+                                 .tuples())]
+        if not keys:
+            break
+
+        start = default_timer()
+        rows += (model
+                 .delete()
+                 .where(condition & (pk << keys))
+                 .execute())
+        lock_secs += default_timer() - start
+
+        if len(keys) < batch_size:
+            break
+        time.sleep(pause)
+
+    return rows, lock_secs
+
+
+# Fold the sightings stored before spawnpoints kept a summary into their
+# summaries, then delete them. Returns the number of rows deleted and the
+# seconds spent deleting.
+def compact_detection_data(batch_size, pause=0.1):
+    rows = 0
+    lock_secs = 0.0
+
+    while True:
+        sp_ids = [sp_id for sp_id, in (SpawnpointDetectionData
+                                       .select(SpawnpointDetectionData
+                                               .spawnpoint_id)
+                                       .distinct()
+                                       .limit(batch_size)
+                                       .tuples())]
+        if not sp_ids:
+            break
+
+        # The legacy table still has the spawnpoint ids as tokens.
+        spawn_points = {}
+        for sp in (SpawnPoint
+                   .select()
+                   .where(SpawnPoint.id <<
+                          [spawnpoint_id_to_db(sp_id) for sp_id in sp_ids])
+                   .dicts()):
+            if not sp['summary']:
+                SpawnpointDetectionData.save_summary(
+                    sp, SpawnpointDetectionData.get_summary(sp))
+                spawn_points[sp['id']] = sp
+        if spawn_points:
+            bulk_upsert(SpawnPoint, spawn_points, flaskDb.database)
+
+        start = default_timer()
+        rows += (SpawnpointDetectionData
+                 .delete()
+                 .where(SpawnpointDetectionData.spawnpoint_id << sp_ids)
+                 .execute())
+        lock_secs += default_timer() - start
+
+        if len(sp_ids) < batch_size:
+            break
+        time.sleep(pause)
+
+    return rows, lock_secs
+
+
+# Delete scanned locations that weren't scanned since the cutoff date,
+# together with their links to spawnpoints. Returns the number of rows
+# deleted and the seconds spent deleting.
+def purge_scanned_locations(cutoff, batch_size, pause=0.1):
+    rows = 0
+    lock_secs = 0.0
+
+    while True:
+        cellids = [cellid for cellid, in (ScannedLocation
+                                          .select(ScannedLocation.cellid)
+                                          .where(ScannedLocation
+                                                 .last_modified < cutoff)
+                                          .limit(batch_size)
+                                          .tuples())]
+        if not cellids:
+            break
+
+        start = default_timer()
+        rows += (ScanSpawnPoint
+                 .delete()
+                 .where(ScanSpawnPoint.scannedlocation << cellids)
+                 .execute())
+        rows += (ScannedLocation
+                 .delete()
+                 .where(ScannedLocation.cellid << cellids)
+                 .execute())
+        lock_secs += default_timer() - start
+
+        if len(cellids) < batch_size:
+            break
+        time.sleep(pause)
+
+    return rows, lock_secs
+
+
+def compact_db(args):
+    # SQLite allows at most 999 parameters per query.
+    batch_size = args.clean_batch_size
+    if args.db_type != 'mysql':
+        batch_size = min(batch_size, 900)
+
+    jobs = [('SpawnpointDetectionData',
+             lambda: compact_detection_data(batch_size))]
+    if args.purge_data > 0:
+        # Only purge Pokemon of hours that are rolled up for the last time,
+        # the rollup may still be catching up after an upgrade or downtime.
+        rolled_up_until = PokemonHourlyStats.get_rolled_up_until()
+        if rolled_up_until:
+            pokemon_cutoff = min(
+                datetime.utcnow() - timedelta(hours=args.purge_data),
+                rolled_up_until - timedelta(
+                    hours=PokemonHourlyStats.reroll_hours))
+            jobs.append(('Pokemon', lambda: delete_in_batches(
+                Pokemon, Pokemon.disappear_time < pokemon_cutoff,
+                batch_size)))
+    if args.purge_scanned_locations > 0:
+        location_cutoff = datetime.utcnow() - timedelta(
+            hours=args.purge_scanned_locations)
+        jobs.append(('ScannedLocation', lambda: purge_scanned_locations(
+            location_cutoff, batch_size)))
+
+    for table, job in jobs:
+        start = default_timer()
+        rows, lock_secs = job()
+        if rows:
+            elapsed = default_timer() - start
+            log.info('Compacted %s: %d rows deleted in %.1fs (%d rows/s), '
+                     '%.2fs spent deleting.', table, rows, elapsed,
+                     rows / max(elapsed, 0.001), lock_secs)
+
+
+# Forget the known state of forts whose rows couldn't be stored, so the
+# next parse_map writes them again instead of skipping them.
+def forget_known_forts(cls, fort_ids):
+    known = {Gym: known_gyms, Pokestop: known_pokestops}.get(cls)
+    if known is None:
+        return
+
+    with known_forts_lock:
+        for fort_id in fort_ids:
+            known.pop(fort_id, None)
+
+
 def bulk_upsert(cls, data, db):
     num_rows = len(data.values())
     i = 0
 
+    # Fill in the S2 cell of new rows.
+    if 's2_cell' in cls._meta.fields:
+        for row in data.values():
+            if row.get('s2_cell') is None:
+                row['s2_cell'] = s2_cell_id(row['latitude'],
+                                            row['longitude'])
+
     if args.db_type == 'mysql':
         step = 250
     else:
@@ -2493,6 +3446,8 @@ def bulk_upsert(cls, data, db):
                 if has_unrecoverable:
                     log.warning('%s. Data is:', repr(e))
                     log.warning(data.items())
+                    forget_known_forts(cls, data.keys()[
+                        i:min(i + step, num_rows)])
                 else:
                     log.warning('%s... Retrying...', repr(e))
                     time.sleep(1)
@@ -2501,18 +3456,98 @@ def bulk_upsert(cls, data, db):
             i += step
 
 
+# Tables queried by map box, see in_box().
+spatial_index_tables = [Pokemon, Pokestop, Gym, ScannedLocation, SpawnPoint,
+                        LocationAltitude]
+
+
+# Fill in the S2 cell of the rows stored before the s2_cell column was
+# added. Rows are updated per location, since many Pokemon share the
+# location of their spawnpoint.
+def fill_s2_cells(db, model):
+    locations = list(model
+                     .select(model.latitude, model.longitude)
+                     .where(model.s2_cell.is_null())
+                     .distinct()
+                     .tuples())
+    log.info('Filling in the S2 cells of %d locations of table %s.',
+             len(locations), model._meta.db_table)
+
+    with db.atomic():
+        for latitude, longitude in locations:
+            (model
+             .update(s2_cell=s2_cell_id(latitude, longitude))
+             .where((model.latitude == latitude) &
+                    (model.longitude == longitude))
+             .execute())
+
+
+# Schema version 23 stores encounter and spawnpoint ids as integers instead
+# of base64 and hex strings. The tables with these ids are copied to a
+# temporary table with converted ids, recreated, and copied back.
+def convert_id_columns(db):
+    if args.db_type == 'mysql':
+        encounter_id = 'CAST(CAST(FROM_BASE64({}) AS UNSIGNED) AS SIGNED)'
+        spawnpoint_id = ("CAST(CAST(CONV(RPAD({}, 16, '0'), 16, 10) AS "
+                         "UNSIGNED) AS SIGNED)")
+        db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
+    else:
+        conn = db.get_conn()
+        conn.create_function('encounter_id_to_db', 1, lambda value: (
+            encounter_id_from_base64(value) if value else None))
+        conn.create_function('spawnpoint_id_to_db', 1, lambda value: (
+            spawnpoint_id_to_db(value) if value else None))
+        encounter_id = 'encounter_id_to_db({})'
+        spawnpoint_id = 'spawnpoint_id_to_db({})'
+
+    # ScanSpawnPoint links to SpawnPoint, so it goes first.
+    tables = [
+        (ScanSpawnPoint, {'spawnpoint_id': spawnpoint_id}),
+        (SpawnPoint, {'id': spawnpoint_id}),
+        (Pokemon, {'encounter_id': encounter_id,
+                   'spawnpoint_id': spawnpoint_id}),
+        (SpawnpointHourlyStats, {'spawnpoint_id': spawnpoint_id})
+    ]
+    tables = [(model, converted) for model, converted in tables
+              if model.table_exists()]
+
+    for model, converted in tables:
+        table = model._meta.db_table
+        log.info('Converting the ids of table %s.', table)
+        columns = [f.db_column for f in model._meta.sorted_fields]
+        db.execute_sql('CREATE TABLE {0}_ids AS SELECT {1} FROM {0};'.format(
+            table, ', '.join(converted.get(c, '{}').format(c) + ' AS ' + c
+                             for c in columns)))
+        db.drop_tables([model])
+
+    db.create_tables([model for model, converted in tables])
+    for model, converted in tables:
+        table = model._meta.db_table
+        columns = ', '.join(f.db_column for f in model._meta.sorted_fields)
+        db.execute_sql('INSERT INTO {0} ({1}) SELECT {1} FROM {0}_ids;'.format(
+            table, columns))
+        db.execute_sql('DROP TABLE {}_ids;'.format(table))
+
+    if args.db_type == 'mysql':
+        db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+
+
 def create_tables(db):
     db.connect()
     tables = [Pokemon, Pokestop, Gym, ScannedLocation, GymDetails,
               GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus,
               SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData,
-              Token, LocationAltitude, HashKeys]
+              Token, LocationAltitude, HashKeys, PokemonHourlyStats,
+              SpawnpointHourlyStats]
     for table in tables:
         if not table.table_exists():
             log.info('Creating table: %s', table.__name__)
             db.create_tables([table], safe=True)
         else:
             log.debug('Skipping table %s, it already exists.', table.__name__)
+
+    if args.spatial_index:
+        create_spatial_indexes(db)
     db.close()
 
 
@@ -2521,7 +3556,7 @@ def drop_tables(db):
               GymDetails, GymMember, GymPokemon, Trainer, MainWorker,
               WorkerStatus, SpawnPoint, ScanSpawnPoint,
               SpawnpointDetectionData, LocationAltitude,
-              Token, HashKeys]
+              Token, HashKeys, PokemonHourlyStats, SpawnpointHourlyStats]
     db.connect()
     db.execute_sql('SET FOREIGN_KEY_CHECKS=0;')
     for table in tables:
@@ -2530,9 +3565,99 @@ def drop_tables(db):
             db.drop_tables([table], safe=True)
 
     db.execute_sql('SET FOREIGN_KEY_CHECKS=1;')
+    if args.db_type != 'mysql':
+        for table in spatial_index_tables:
+            db.execute_sql('DROP TABLE IF EXISTS {}_rtree;'.format(
+                table._meta.db_table))
     db.close()
 
 
+# Add a spatial index on the coordinates of the tables queried by map box:
+# an R*Tree table kept up to date by triggers on SQLite, and a POINT column
+# (also filled by triggers) with a SPATIAL index on MySQL. Tables that
+# already have one are skipped, a table whose index couldn't be created
+# keeps using the latitude/longitude index.
+def create_spatial_indexes(db):
+    for table in spatial_index_tables:
+        name = table._meta.db_table
+        try:
+            if args.db_type == 'mysql':
+                created = create_mysql_spatial_index(db, name)
+            else:
+                created = create_sqlite_spatial_index(db, name)
+
+            if created:
+                log.info('Created spatial index on table %s.', name)
+            spatial_tables.add(table)
+        except Exception as e:
+            log.error('Failed to create spatial index on table %s, using ' +
+                      'the latitude/longitude index instead: %s', name, e)
+
+
+def create_sqlite_spatial_index(db, name):
+    db.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS {0}_rtree USING '
+                   'rtree(id, min_lat, max_lat, min_lng, max_lng);'.format(
+                       name))
+
+    triggers = db.execute_sql(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND "
+        "name LIKE '{}_rtree_%';".format(name)).fetchone()[0]
+    if triggers == 3:
+        return False
+
+    # Triggers were dropped with their table (or never created), rebuild
+    # the index from scratch.
+    with db.atomic():
+        for action in ('insert', 'update', 'delete'):
+            db.execute_sql('DROP TRIGGER IF EXISTS {}_rtree_{};'.format(
+                name, action))
+        db.execute_sql('DELETE FROM {}_rtree;'.format(name))
+        db.execute_sql(
+            'INSERT INTO {0}_rtree SELECT rowid, latitude, latitude, '
+            'longitude, longitude FROM {0};'.format(name))
+        db.execute_sql(
+            'CREATE TRIGGER {0}_rtree_insert AFTER INSERT ON {0} BEGIN '
+            'INSERT OR REPLACE INTO {0}_rtree VALUES (new.rowid, '
+            'new.latitude, new.latitude, new.longitude, new.longitude); '
+            'END;'.format(name))
+        db.execute_sql(
+            'CREATE TRIGGER {0}_rtree_update AFTER UPDATE OF latitude, '
+            'longitude ON {0} BEGIN '
+            'INSERT OR REPLACE INTO {0}_rtree VALUES (new.rowid, '
+            'new.latitude, new.latitude, new.longitude, new.longitude); '
+            'END;'.format(name))
+        db.execute_sql(
+            'CREATE TRIGGER {0}_rtree_delete AFTER DELETE ON {0} BEGIN '
+            'DELETE FROM {0}_rtree WHERE id = old.rowid; END;'.format(name))
+
+    return True
+
+
+def create_mysql_spatial_index(db, name):
+    index = '{}_location'.format(name)
+    if index in [i.name for i in db.get_indexes(name)]:
+        return False
+
+    # Add the column, start filling it for new rows, then fill it for the
+    # existing rows before it can be NOT NULL (required by SPATIAL).
+    if 'location' not in [c.name for c in db.get_columns(name)]:
+        db.execute_sql('ALTER TABLE `{}` ADD COLUMN `location` POINT '
+                       'NULL;'.format(name))
+    for action in ('INSERT', 'UPDATE'):
+        db.execute_sql('DROP TRIGGER IF EXISTS `{}_location_{}`;'.format(
+            name, action.lower()))
+        db.execute_sql(
+            'CREATE TRIGGER `{0}_location_{1}` BEFORE {1} ON `{0}` FOR EACH '
+            'ROW SET NEW.location = Point(NEW.longitude, '
+            'NEW.latitude);'.format(name, action.lower()))
+    db.execute_sql('UPDATE `{}` SET `location` = Point(longitude, '
+                   'latitude);'.format(name))
+    db.execute_sql('ALTER TABLE `{}` MODIFY `location` POINT NOT NULL, '
+                   'ADD SPATIAL INDEX `{}` (`location`);'.format(name, index))
+
+    return True
+
+
 def verify_table_encoding(db):
     if args.db_type == 'mysql':
         db.connect()
@@ -2813,5 +3938,30 @@ def database_migrate(db, old_ver):
             migrator.add_column('pokemon', 'cp_multiplier',
                                 FloatField(null=True))
         )
+
+    if old_ver < 20:
+        migrate(
+            migrator.add_column('spawnpoint', 'summary',
+                                TextField(null=True))
+        )
+
+    if old_ver < 21:
+        migrate(
+            migrator.add_column('spawnpoint', 'seen_mask',
+                                TextField(null=True)),
+            migrator.add_column('spawnpoint', 'unseen_mask',
+                                TextField(null=True))
+        )
+
+    if old_ver < 22:
+        for model in (Pokemon, Pokestop, Gym, SpawnPoint):
+            migrate(
+                migrator.add_column(model._meta.db_table, 's2_cell',
+                                    BigIntegerField(null=True, index=True))
+            )
+            fill_s2_cells(db, model)
+
+    if old_ver < 23:
+        convert_id_columns(db)
     # Always log that we're done.
     log.info('Schema upgrade complete.')
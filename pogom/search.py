@@ -25,12 +25,13 @@ import traceback
 import random
 import time
 import copy
+import heapq
 import requests
 import terminalsize
 import timeit
 
 from datetime import datetime
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition
 from queue import Queue, Empty
 from sets import Set
 from collections import deque
@@ -43,15 +44,18 @@ from pgoapi import utilities as util
 from pgoapi.hash_server import (HashServer, BadHashRequestException,
                                 HashingOfflineException)
 from .models import (parse_map, GymDetails, parse_gyms, MainWorker,
-                     WorkerStatus, HashKeys, Pokemon)
+                     WorkerStatus, HashKeys, Pokemon, get_parse_stats_message,
+                     get_db_pool_stats_message, release_db_connection,
+                     known_pokemon)
 from .utils import (now, clear_dict_response, parse_new_timestamp_ms,
-                    calc_pokemon_level)
+                    calc_pokemon_level, spawnpoint_id_from_db)
 from .transform import get_new_coords, jitter_location
 from .account import (setup_api, check_login, reset_account, request_encounter,
                       catch_pokemon, release_pokemons, cleanup_account_stats,
-                      handle_pokestop, AccountSet)
+                      handle_pokestop, AccountSet, AccountQueue,
+                      login_assets)
 from .captcha import (captcha_overseer_thread, handle_captcha,
-                      automatic_captcha_solve)
+                      automatic_captcha_solve, CaptchaSolvers)
 from .proxy import get_new_proxy
 from .schedulers import KeyScheduler, SchedulerFactory
 
@@ -413,48 +417,160 @@ def status_printer(threadStatus, search_items_queue_array, db_updates_queue,
         print '\n'.join(status_text)
 
 
-# The account recycler monitors failed accounts and places them back in the
-#  account queue 2 hours after they failed.
+class AccountFailures(object):
+    """Accounts resting after they failed or were rotated out.
+
+    Behaves like the list it replaces (append, len and iteration), but keeps
+    the accounts in a heap ordered by the time their rest interval ends, so
+    the recycler can sleep until exactly the next account is ready.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.heap = []
+        self.counter = 0
+        self.condition = Condition()
+        self.stats = {
+            'returned': 0,
+            'rest_secs': 0.0,
+            'late_secs': 0.0
+        }
+
+    # How long an account has to rest, depending on why it was put away.
+    def rest_interval(self, reason):
+        rest_interval = self.args.account_rest_interval
+        if 'exception' in reason:
+            rest_interval = rest_interval * 0.1
+        elif 'banned' in reason:
+            rest_interval = rest_interval * 10
+
+        return rest_interval
+
+    def append(self, failure):
+        rest_interval = self.rest_interval(failure['reason'])
+        failure['ready_time'] = failure['last_fail_time'] + rest_interval
+        log.info('Account %s needs to cool off for %d minutes due to %s.',
+                 failure['account']['username'], round(rest_interval / 60),
+                 failure['reason'])
+
+        with self.condition:
+            # The counter keeps equal ready times from comparing the dicts.
+            self.counter += 1
+            heapq.heappush(self.heap,
+                           (failure['ready_time'], self.counter, failure))
+            self.condition.notify()
+
+    def __len__(self):
+        return len(self.heap)
+
+    # Iterate a snapshot, soonest ready first.
+    def __iter__(self):
+        with self.condition:
+            items = sorted(self.heap)
+
+        return iter([failure for ready_time, i, failure in items])
+
+    # Wait until the next account has rested and return it.
+    def pop_ready(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                wait = self.heap[0][0] - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+
+                failure = heapq.heappop(self.heap)[2]
+                now_secs = time.time()
+                self.stats['returned'] += 1
+                self.stats['rest_secs'] += now_secs - failure['last_fail_time']
+                self.stats['late_secs'] += now_secs - failure['ready_time']
+
+                return failure
+
+    def get_stats_message(self):
+        with self.condition:
+            stats = dict(self.stats)
+            reasons = {}
+            for ready_time, i, failure in self.heap:
+                reasons[failure['reason']] = reasons.get(
+                    failure['reason'], 0) + 1
+            next_ready = self.heap[0][0] - time.time() if self.heap else 0
+
+        returned = max(1, stats['returned'])
+        resting = ', '.join('{}: {}'.format(reason, count)
+                            for reason, count in sorted(reasons.items()))
+
+        return ('Accounts resting: {} ({}) | Next ready in {:.0f}s | ' +
+                'Returned: {} (avg rest {:.0f}m, avg {:.1f}s late)').format(
+                    len(self.heap), resting or 'none', max(0, next_ready),
+                    stats['returned'], stats['rest_secs'] / 60 / returned,
+                    stats['late_secs'] / returned)
+
+
+# The account recycler waits on the failed accounts and places each one back
+# in the account queue as soon as its rest interval has passed.
 # This allows accounts that were soft banned to be retried after giving
 # them a chance to cool down.
 def account_recycler(args, accounts_queue, account_failures):
     while True:
-        # Run once a minute.
-        time.sleep(60)
-        log.info('Account recycler running. Checking status of %d accounts.',
-                 len(account_failures))
-
-        # Create a new copy of the failure list to search through, so we can
-        # iterate through it without it changing.
-        failed_temp = list(account_failures)
-
-        # Search through the list for any item that last failed before
-        # -ari/--account-rest-interval seconds.
-        for a in failed_temp:
-            rest_interval = args.account_rest_interval
-            fail_reason = a['reason']
-            if 'exception' in fail_reason:
-                rest_interval = rest_interval * 0.1
-            elif 'banned' in fail_reason:
-                rest_interval = rest_interval * 10
-
-            ok_time = time.time() - rest_interval
-            if a['last_fail_time'] <= ok_time:
-                # Remove the account from the real list, and add to the account
-                # queue.
-                log.info('Account {} returning to active duty.'.format(
-                    a['account']['username']))
-                account_failures.remove(a)
-                accounts_queue.put(a['account'])
-            else:
-                if 'notified' not in a:
-                    log.info((
-                        'Account {} needs to cool off for {} minutes due ' +
-                        'to {}.').format(
-                            a['account']['username'],
-                            round((a['last_fail_time'] - ok_time) / 60, 0),
-                            a['reason']))
-                    a['notified'] = True
+        # Blocks until the account's -ari/--account-rest-interval (depending
+        # on the reason) has passed.
+        failure = account_failures.pop_ready()
+        log.info('Account %s returning to active duty.',
+                 failure['account']['username'])
+        accounts_queue.put(failure['account'])
+
+
+# Logs accounts in ahead of time, so workers of this hive can switch to an
+# account without waiting for the login.
+def account_warmup_thread(args, account_queue, account_failures,
+                          warm_queue, scheduler, key_scheduler):
+    log.debug('Account warm-up thread starting...')
+
+    while True:
+        account = None
+        try:
+            # Only take an account from the queue when there is room for it.
+            while warm_queue.full() or not scheduler.ready:
+                time.sleep(1)
+
+            account = account_queue.get_closest(scheduler.scan_location)
+            location = account['last_location'] or scheduler.scan_location
+            reset_account(account)
+
+            status = {'proxy_url': False, 'proxy_display': 'No'}
+            api = setup_api(args, status, account)
+            api.set_position(*location)
+            if args.hash_key:
+                api.activate_hash_server(key_scheduler.next())
+
+            started = timeit.default_timer()
+            check_login(args, account, api, location, status['proxy_url'])
+            if account['banned']:
+                log.warning('Account %s is marked as banned!',
+                            account['username'])
+                account_failures.append({'account': account,
+                                         'last_fail_time': now(),
+                                         'reason': 'banned'})
+                continue
+
+            account['last_location'] = location
+            log.info('Account %s logged in after %.1fs, ready for a worker.',
+                     account['username'], timeit.default_timer() - started)
+            warm_queue.put((account, api, status))
+
+        except Exception as e:
+            log.exception('Account warm-up failed for account %s: %s.',
+                          account and account['username'], repr(e))
+            if account:
+                account_failures.append({'account': account,
+                                         'last_fail_time': now(),
+                                         'reason': 'login exception'})
+            time.sleep(args.login_delay)
 
 
 def worker_status_db_thread(threads_status, name, db_updates_queue):
@@ -490,7 +606,7 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
 
     search_items_queue_array = []
     scheduler_array = []
-    account_queue = Queue()
+    account_queue = AccountQueue()
     account_sets = AccountSet(args.hlvl_kph)
     threadStatus = {}
     key_scheduler = None
@@ -505,8 +621,12 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
     they can be tried again later, but must wait a bit before doing do so
     to prevent accounts from being cycled through too quickly.
     '''
+    # Remember where accounts last scanned, so workers get an account that
+    # is close to their location.
+    account_locations = WorkerStatus.get_locations()
     for i, account in enumerate(args.accounts):
         reset_account(account)
+        account['last_location'] = account_locations.get(account['username'])
         account_queue.put(account)
 
     '''
@@ -521,7 +641,7 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
     log.info('Added %s accounts to the L30 pool.', len(args.accounts_L30))
 
     # Create a list for failed accounts.
-    account_failures = []
+    account_failures = AccountFailures(args)
     # Create a double-ended queue for captcha'd accounts
     account_captchas = deque()
 
@@ -558,6 +678,21 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
         t.daemon = True
         t.start()
 
+    # Encounters are handed off to a separate pool of threads using the
+    # high-level accounts, so search workers can go back to scanning.
+    encounter_queue = None
+    if args.encounter and args.accounts_L30 and args.encounter_workers > 0:
+        encounter_queue = EncounterQueue()
+        log.info('Starting %d encounter worker threads...',
+                 args.encounter_workers)
+        for i in range(args.encounter_workers):
+            t = Thread(target=encounter_worker_thread,
+                       name='encounter-worker-{}'.format(i),
+                       args=(args, encounter_queue, account_sets,
+                             db_updates_queue, wh_queue, key_scheduler))
+            t.daemon = True
+            t.start()
+
     # Create account recycler thread.
     log.info('Starting account recycler thread...')
     t = Thread(target=account_recycler, name='account-recycler',
@@ -566,11 +701,13 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
     t.start()
 
     # Create captcha overseer thread.
+    captcha_solvers = None
     if args.captcha_solving:
         log.info('Starting captcha overseer thread...')
+        captcha_solvers = CaptchaSolvers()
         t = Thread(target=captcha_overseer_thread, name='captcha-overseer',
                    args=(args, account_queue, account_captchas, key_scheduler,
-                         wh_queue))
+                         wh_queue, captcha_solvers))
         t.daemon = True
         t.start()
 
@@ -598,6 +735,22 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
             scheduler_array.append(scheduler)
             search_items_queue_array.append(search_items_queue)
 
+            # Keep logged in accounts ready for the workers of this hive,
+            # logging in as many at a time as can be kept ready.
+            warm_queue = None
+            if args.warm_accounts > 0:
+                warm_queue = Queue(maxsize=args.warm_accounts)
+                hive_workers = (args.workers_per_hive if args.beehive
+                                else args.workers)
+                for j in range(min(args.warm_accounts, hive_workers)):
+                    t = Thread(target=account_warmup_thread,
+                               name='account-warmup-{}-{}'.format(
+                                   len(scheduler_array) - 1, j),
+                               args=(args, account_queue, account_failures,
+                                     warm_queue, scheduler, key_scheduler))
+                    t.daemon = True
+                    t.start()
+
         # Set proxy for each worker, using round robin.
         proxy_display = 'No'
         proxy_url = False    # Will be assigned inside a search thread.
@@ -624,7 +777,8 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
                          account_failures, account_captchas,
                          search_items_queue, pause_bit,
                          threadStatus[workerId], db_updates_queue,
-                         wh_queue, scheduler, key_scheduler))
+                         wh_queue, scheduler, key_scheduler,
+                         encounter_queue, warm_queue))
         t.daemon = True
         t.start()
 
@@ -723,6 +877,18 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb,
             stats_timer += 1
             if stats_timer == args.stats_log_timer:
                 log.info(get_stats_message(threadStatus))
+                log.info(get_parse_stats_message())
+                log.info(get_db_pool_stats_message())
+                if encounter_queue:
+                    log.info(encounter_queue.get_stats_message())
+                if args.accounts_L30:
+                    log.info(account_sets.get_stats_message('30'))
+                log.info(account_failures.get_stats_message())
+                if captcha_solvers:
+                    log.info(captcha_solvers.get_stats_message(
+                        account_captchas))
+                if args.login_asset_cache:
+                    log.info(login_assets.get_stats_message())
                 stats_timer = 0
 
         # Update Overseer statistics
@@ -900,7 +1066,8 @@ def generate_hive_locations(current_location, step_distance,
 def search_worker_thread(args, account_queue, account_sets,
                          account_failures, account_captchas,
                          search_items_queue, pause_bit, status, dbq, whq,
-                         scheduler, key_scheduler):
+                         scheduler, key_scheduler, encounter_queue,
+                         warm_queue):
 
     log.debug('Search worker thread starting...')
 
@@ -924,10 +1091,21 @@ def search_worker_thread(args, account_queue, account_sets,
                                  'queue...')
             log.info(status['message'])
 
-            # Get an account.
-            account = account_queue.get()
-            # Reset account statistics tracked per loop.
-            reset_account(account)
+            api = None
+            if warm_queue:
+                # Take over an account that is already logged in, or log in
+                # ourselves if none is ready in time.
+                try:
+                    account, api, api_status = warm_queue.get(timeout=30)
+                    status.update(api_status)
+                except Empty:
+                    log.warning('No logged in account ready after 30s, ' +
+                                'logging in a new one.')
+            if not api:
+                # Get the free account closest to our scan location.
+                account = account_queue.get_closest(scheduler.scan_location)
+                # Reset account statistics tracked per loop.
+                reset_account(account)
             status.update(WorkerStatus.get_worker(
                 account['username'], scheduler.scan_location))
             status['message'] = 'Switching to account {}.'.format(
@@ -953,10 +1131,13 @@ def search_worker_thread(args, account_queue, account_sets,
             # for stat purposes.
             consecutive_noitems = 0
 
-            api = setup_api(args, status, account)
+            if not api:
+                api = setup_api(args, status, account)
 
             # The forever loop for the searches.
             while True:
+                # Only hold a database connection while scanning.
+                release_db_connection()
 
                 while pause_bit.is_set():
                     status['message'] = 'Scanning paused.'
@@ -1148,6 +1329,7 @@ def search_worker_thread(args, account_queue, account_sets,
                     parsed = parse_map(args, response_dict, step_location, dbq,
                                        whq, api, status, scan_date, account,
                                        account_sets, key_scheduler)
+                    release_db_connection()
 
                     del response_dict
 
@@ -1184,38 +1366,25 @@ def search_worker_thread(args, account_queue, account_sets,
                 catches_made = 0
                 spins_made = 0
                 if parsed and parsed['encounters']:
-                    hlvl_account = None
-                    hlvl_api = None
-                    use_hlvl_accounts = False
-
+                    # High-level search accounts encounter what they found
+                    # themselves, everything else goes to the encounter
+                    # workers.
                     if account['level'] >= 30:
-                        hlvl_account = account
-                        hlvl_api = api
-                    else:
-                        hash_key = key_scheduler.next()
-                        encounter_ids = parsed['encounters'].keys()
-                        hlvl = init_hlvl_account(
-                            args, status, account_sets, hash_key,
-                            step_location, encounter_ids, whq)
-                        if hlvl:
-                            use_hlvl_accounts = True
-                            hlvl_account = hlvl[0]
-                            hlvl_api = hlvl[1]
-
-                    if hlvl_account and hlvl_api:
-
                         result = process_encounters(
-                            args, status, hlvl_api, hlvl_account, dbq, whq,
+                            args, status, api, account, dbq, whq,
                             parsed['encounters'])
                         if result:
                             encounters_made = result
                             status['message'] = (
                                 'High-level account {} finished processing ' +
-                                'encounters.').format(hlvl_account['username'])
+                                'encounters.').format(account['username'])
                             log.debug(status['message'])
-
-                    if use_hlvl_accounts:
-                        account_sets.release(hlvl_account)
+                    elif encounter_queue:
+                        encounter_queue.put(step_location,
+                                            parsed['encounters'])
+                    else:
+                        log.error('No high-level accounts available, ' +
+                                  'consider adding more.')
 
                 leveling = account['level'] < args.account_max_level
 
@@ -1388,13 +1557,134 @@ def search_worker_thread(args, account_queue, account_sets,
             time.sleep(args.scan_delay)
 
 
+class EncounterQueue(object):
+    """Encounters waiting for a high-level account.
+
+    Search workers put the encounters of a scan in here and go back to
+    scanning. Encounters that are already queued by another worker (from an
+    overlapping step) are dropped, so every Pokemon is encountered once.
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.pending = Set()
+        self.lock = Lock()
+        self.stats = {
+            'queued': 0,
+            'duplicates': 0,
+            'done': 0
+        }
+
+    def put(self, location, encounters):
+        with self.lock:
+            new_encounters = {}
+            for encounter_id, encounter in encounters.iteritems():
+                if encounter_id not in self.pending:
+                    new_encounters[encounter_id] = encounter
+                    self.pending.add(encounter_id)
+
+            self.stats['duplicates'] += len(encounters) - len(new_encounters)
+            self.stats['queued'] += len(new_encounters)
+
+        if new_encounters:
+            self.queue.put((location, new_encounters))
+
+    def get(self):
+        return self.queue.get()
+
+    def task_done(self, encounters):
+        with self.lock:
+            self.pending.difference_update(encounters.keys())
+            self.stats['done'] += len(encounters)
+        self.queue.task_done()
+
+    def get_stats_message(self):
+        with self.lock:
+            stats = dict(self.stats)
+            pending = len(self.pending)
+
+        return ('Encounters queued: {} | Duplicates dropped: {} | ' +
+                'Processed: {} | Pending: {} in {} batches').format(
+                    stats['queued'], stats['duplicates'], stats['done'],
+                    pending, self.queue.qsize())
+
+
+def encounter_worker_thread(args, encounter_queue, account_sets, dbq, whq,
+                            key_scheduler):
+    # Encounter workers don't show up on the status page, but the API
+    # setup needs a status for the proxy.
+    status = {
+        'message': '',
+        'proxy_url': False,
+        'proxy_display': 'No'
+    }
+
+    log.debug('Encounter worker thread starting...')
+
+    while True:
+        location, encounters = encounter_queue.get()
+        try:
+            # Skip Pokemon another worker stored in the meantime.
+            now_date = datetime.utcnow()
+            todo = {}
+            for encounter_id, encounter in encounters.iteritems():
+                p = encounter[0]
+                if p['disappear_time'] <= now_date:
+                    continue
+                if known_pokemon.contains(p['encounter_id'],
+                                          p['spawnpoint_id'], now_date):
+                    continue
+                todo[encounter_id] = encounter
+
+            if todo:
+                # Don't wait longer for an account than the first Pokemon
+                # sticks around.
+                max_wait = min((p['disappear_time'] - now_date).total_seconds()
+                               for p, wh_data in todo.values()) - 30
+                hash_key = key_scheduler.next()
+                hlvl = init_hlvl_account(args, status, account_sets,
+                                         hash_key, location, todo.keys(),
+                                         whq, max_wait)
+                if hlvl:
+                    hlvl_account, hlvl_api = hlvl
+                    try:
+                        if process_encounters(args, status, hlvl_api,
+                                              hlvl_account, dbq, whq, todo):
+                            log.debug('High-level account %s finished ' +
+                                      'processing encounters.',
+                                      hlvl_account['username'])
+                    finally:
+                        account_sets.release(hlvl_account)
+
+        except Exception as e:
+            log.exception('Exception in encounter worker: %s.', repr(e))
+        finally:
+            encounter_queue.task_done(encounters)
+
+
 def init_hlvl_account(args, status, account_sets, hash_key, location,
-                      encounter_ids, whq):
-    account = account_sets.next('30', location)
+                      encounter_ids, whq, max_wait=0):
+    account, wait = account_sets.next('30', location)
+
+    # Wait for an account to cool down if it's worth it. Another thread
+    # can take it first, so try again after waiting.
+    while not account and wait is not None and wait <= max_wait:
+        log.debug('Waiting %.1fs for a high-level account to cool down.',
+                  wait)
+        time.sleep(wait)
+        account, wait = account_sets.next('30', location)
+
     if not account:
-        log.error('No high-level accounts available, consider adding more.')
+        if wait is None:
+            log.error('No high-level accounts available, consider adding '
+                      + 'more.')
+        else:
+            log.warning('No high-level account cooled down for this '
+                        + 'location, first one is ready in %.1fs.', wait)
         return False
 
+    # Accounts that couldn't be set up go back to the pool.
+    initialized = False
     try:
         if args.no_api_store:
             api = setup_api(args, status, account)
@@ -1421,7 +1711,7 @@ def init_hlvl_account(args, status, account_sets, hash_key, location,
         # Verify if the account is at least level 30.
         if account['level'] < 30:
             # Mark the account so we don't try to use it anymore.
-            account['failed'] = True
+            account_sets.fail(account)
             log.error('Account %s is not an high-level account (level %d).',
                       account['username'], account['level'])
             return False
@@ -1447,7 +1737,7 @@ def init_hlvl_account(args, status, account_sets, hash_key, location,
                 response = map_request(api, account, location, args.no_jitter)
             else:
                 # Throw warning and flag account.
-                account['failed'] = True
+                account_sets.fail(account)
                 status['message'] = (
                     'High-level account {} has encountered a reCaptcha.' +
                     'Disabled account.').format(account['username'])
@@ -1490,11 +1780,15 @@ def init_hlvl_account(args, status, account_sets, hash_key, location,
             return False
 
         del response
+        initialized = True
         return (account, api)
 
     except Exception as e:
         log.error('Failed to initialize high-level account %s: %s',
                   account['username'], repr(e))
+    finally:
+        if not initialized:
+            account_sets.release(account)
 
     return False
 
@@ -1508,7 +1802,13 @@ def process_encounters(args, status, api, account, dbq, whq, encounters):
     for encounter_id in encounter_ids:
         p = encounters[encounter_id][0]
         wh_data = encounters[encounter_id][1]
-        pokemon_id = p['pokemon_id']
+
+        # Another worker may have encountered it in the meantime.
+        if known_pokemon.contains(p['encounter_id'], p['spawnpoint_id'],
+                                  datetime.utcnow()):
+            log.debug('Skipping encounter #%s, Pokemon is already stored.',
+                      encounter_id)
+            continue
 
         # Make a Pokemon encounter request.
         time.sleep(random.uniform(2.5, 4))
@@ -1516,7 +1816,7 @@ def process_encounters(args, status, api, account, dbq, whq, encounters):
             api,
             account,
             encounter_id,
-            p['spawnpoint_id'],
+            spawnpoint_id_from_db(p['spawnpoint_id']),
             location,
             args.no_jitter)
 
@@ -1581,9 +1881,7 @@ def process_encounters(args, status, api, account, dbq, whq, encounters):
         })
 
         # Send pokemon data to the webhooks.
-        if args.webhooks and (pokemon_id in args.webhook_whitelist or
-                              (not args.webhook_whitelist and pokemon_id
-                               not in args.webhook_blacklist)):
+        if args.webhooks:
             wh_poke = p.copy()
             wh_poke.update(wh_data)
             wh_poke['pokemon_level'] = calc_pokemon_level(cp_multiplier)
@@ -1591,6 +1889,8 @@ def process_encounters(args, status, api, account, dbq, whq, encounters):
             whq.put(('pokemon', wh_poke))
         # Send Pokemon data to the database.
         dbq.put((Pokemon, {0: p}))
+        known_pokemon.add(p['encounter_id'], p['spawnpoint_id'],
+                          p['disappear_time'])
 
     return len(encounters)
 
@@ -1627,7 +1927,7 @@ def process_pokemons(args, status, api, account, dbq, whq, pokemons):
             api,
             account,
             encounter_id,
-            p['spawnpoint_id'],
+            spawnpoint_id_from_db(p['spawnpoint_id']),
             location,
             args.no_jitter)
 
@@ -1710,9 +2010,7 @@ def process_pokemons(args, status, api, account, dbq, whq, pokemons):
                         caught_pokemon['cp_multiplier'])
 
                 # Send pokemon data to the webhooks.
-                if args.webhooks and (132 in args.webhook_whitelist or
-                                      (not args.webhook_whitelist and
-                                       132 not in args.webhook_blacklist)):
+                if args.webhooks:
                     wh_poke = p.copy()
                     wh_poke.update(wh_data)
                     wh_poke['player_level'] = account['level']
@@ -14,8 +14,9 @@ import struct
 import zipfile
 import requests
 import hashlib
+from base64 import b64encode, b64decode
 
-from s2sphere import CellId, LatLng
+from s2sphere import CellId, LatLng, LatLngRect, RegionCoverer
 from geopy.geocoders import GoogleV3
 
 from . import config
@@ -76,6 +77,10 @@ def get_args():
                         default=7200,
                         help=('Seconds for accounts to rest when they fail ' +
                               'or are switched out.'))
+    parser.add_argument('-wa', '--warm-accounts', type=int, default=0,
+                        help=('Number of logged in accounts to keep ready ' +
+                              'per hive, so workers switching accounts ' +
+                              'do not wait for the login. 0 to disable.'))
     parser.add_argument('-ac', '--accountcsv',
                         help=('Load accounts from CSV file containing ' +
                               '"auth_service,username,passwd" lines.'))
@@ -128,6 +133,11 @@ def get_args():
     parser.add_argument('-enc', '--encounter',
                         help='Start an encounter to gather IVs and moves.',
                         action='store_true', default=False)
+    parser.add_argument('-encw', '--encounter-workers',
+                        help=('Number of threads encountering Pokemon with ' +
+                              'high-level accounts. Defaults to the number ' +
+                              'of high-level accounts.'),
+                        type=int, default=None)
     parser.add_argument('-cs', '--captcha-solving',
                         help='Enables captcha solving.',
                         action='store_true', default=False)
@@ -147,6 +157,10 @@ def get_args():
                         'captcha solving. On timeout, if enabled, 2Captcha ' +
                         'will be used to solve captcha. Default is 0.',
                         type=int, default=0)
+    parser.add_argument('-csw', '--captcha-solvers',
+                        help=('Number of threads verifying captcha tokens ' +
+                              'for captcha\'d accounts.'),
+                        type=int, default=5)
     parser.add_argument('-prt', '--pokestop-refresh-time',
                         help='Time until Pokestops can be used again.',
                         type=int, default=300)
@@ -212,6 +226,11 @@ def get_args():
                         help=('Mimick real app login flow. Requires up to ' +
                               '25 extra requests to be made during login.'),
                         action='store_true', default=False)
+    parser.add_argument('-lac', '--login-asset-cache',
+                        help=('File to remember the asset digest and item ' +
+                              'templates downloaded during login, so other ' +
+                              'accounts skip downloading them again.'),
+                        default=None)
     parser.add_argument('-mf', '--max-failures',
                         help=('Maximum number of failures to parse ' +
                               'locations before an account will go into a ' +
@@ -328,6 +347,22 @@ def get_args():
                         help=('Clear Pokemon from database this many hours ' +
                               'after they disappear (0 to disable).'),
                         type=int, default=0)
+    parser.add_argument('-psl', '--purge-scanned-locations',
+                        help=('Clear scanned locations from database this ' +
+                              'many hours after they were last scanned ' +
+                              '(0 to disable).'),
+                        type=int, default=0)
+    parser.add_argument('-cbs', '--clean-batch-size',
+                        help=('Number of rows deleted at once when cleaning ' +
+                              'the database, smaller batches block other ' +
+                              'queries for a shorter time.'),
+                        type=int, default=500)
+    parser.add_argument('-sct', '--stats-cache-ttl',
+                        help=('Maximum number of seconds the results of ' +
+                              'the statistics page are cached. Shorter ' +
+                              'periods are cached shorter, down to a ' +
+                              'minute.'),
+                        type=int, default=1800)
     parser.add_argument('-px', '--proxy',
                         help='Proxy url (e.g. socks5://127.0.0.1:9050)',
                         action='append')
@@ -362,9 +397,34 @@ def get_args():
     parser.add_argument('--db-host', help='IP or hostname for the database.')
     parser.add_argument(
         '--db-port', help='Port for the database.', type=int, default=3306)
+    parser.add_argument('--db-replica-host',
+                        help=('IP or hostname of a MySQL read replica. The ' +
+                              'map reads from it, the scanner keeps using ' +
+                              'the database host.'))
+    parser.add_argument('--db-replica-port',
+                        help='Port for the read replica.', type=int,
+                        default=3306)
+    parser.add_argument('--db-replica-max-connections',
+                        help='Max connections for the read replica.',
+                        type=int, default=20)
     parser.add_argument('--db-max_connections',
-                        help='Max connections (per thread) for the database.',
-                        type=int, default=5)
+                        help=('Connections shared by the web server and the ' +
+                              'search workers, on top of one for each db ' +
+                              'thread, the scheduler and the db cleaner.'),
+                        type=int, default=10)
+    parser.add_argument('--db-stale-timeout',
+                        help=('Seconds after which a database connection ' +
+                              'is closed and reopened.'),
+                        type=int, default=300)
+    parser.add_argument('--db-checkout-timeout',
+                        help=('Seconds to wait for a free database ' +
+                              'connection when all are in use.'),
+                        type=int, default=30)
+    parser.add_argument('-si', '--spatial-index',
+                        help=('Add a spatial index on the coordinates of ' +
+                              'the tables queried by map area (MySQL 5.7+ ' +
+                              'or SQLite with R*Tree support).'),
+                        action='store_true', default=False)
     parser.add_argument('--db-threads',
                         help=('Number of db threads; increase if the db ' +
                               'queue falls behind.'),
@@ -386,8 +446,22 @@ def get_args():
                               'webhook queue falls behind.'),
                         type=int, default=1)
     parser.add_argument('-whc', '--wh-concurrency',
-                        help=('Async requests pool size.'), type=int,
+                        help=('Number of concurrent requests (sender ' +
+                              'threads) per webhook endpoint.'), type=int,
                         default=25)
+    parser.add_argument('-whq', '--wh-endpoint-queue',
+                        help=('Maximum number of frames queued per webhook ' +
+                              'endpoint. The oldest frames are dropped ' +
+                              'when an endpoint falls behind.'),
+                        type=int, default=1000)
+    parser.add_argument('-whcb', '--wh-circuit-breaker',
+                        help=('Pause a webhook endpoint after this many ' +
+                              'failed requests in a row. 0 to disable.'),
+                        type=int, default=5)
+    parser.add_argument('-whcbt', '--wh-circuit-breaker-timeout',
+                        help=('Seconds to pause a failing webhook ' +
+                              'endpoint for.'),
+                        type=int, default=30)
     parser.add_argument('-whr', '--wh-retries',
                         help=('Number of times to retry sending webhook ' +
                               'data on failure.'),
@@ -402,6 +476,26 @@ def get_args():
     parser.add_argument('-whlfu', '--wh-lfu-size',
                         help='Webhook LFU cache max size.', type=int,
                         default=2500)
+    parser.add_argument('-whlfus', '--wh-lfu-shards',
+                        help=('Number of shards the webhook LFU cache is ' +
+                              'split into; each shard has its own lock.'),
+                        type=int, default=16)
+    parser.add_argument('-whfi', '--wh-frame-interval',
+                        help=('Collect webhook messages for this many ' +
+                              'milliseconds and send them to each ' +
+                              'endpoint as one JSON array. 0 to send ' +
+                              'every message on its own.'),
+                        type=int, default=0)
+    parser.add_argument('-whfs', '--wh-frame-size',
+                        help=('Maximum number of messages in a webhook ' +
+                              'frame (use with -whfi).'),
+                        type=int, default=100)
+    parser.add_argument('-whf', '--wh-filter-file',
+                        help=('JSON file with filter rules (message types, ' +
+                              'Pokemon IDs, minimum IV/CP and geofence) ' +
+                              'per webhook URL. Webhooks without rules use ' +
+                              'the webhook whitelist/blacklist.'),
+                        default='')
     parser.add_argument('-whsu', '--webhook-scheduler-updates',
                         help=('Send webhook updates with scheduler status ' +
                               '(use with -wh).'),
@@ -468,6 +562,11 @@ def get_args():
 
     args = parser.parse_args()
 
+    # SQLite allows a single writer at a time.
+    if args.db_type == 'sqlite' and args.db_threads > 1:
+        print(sys.argv[0] + ': Warning: SQLite only uses one db thread.')
+        args.db_threads = 1
+
     if args.only_server:
         if args.location is None:
             parser.print_usage()
@@ -686,6 +785,9 @@ def get_args():
 
                     args.accounts_L30.append(hlvl_account)
 
+        if args.encounter_workers is None:
+            args.encounter_workers = len(args.accounts_L30)
+
         # Make max workers equal number of accounts if unspecified, and disable
         # account switching.
         if args.workers is None:
@@ -748,6 +850,12 @@ def get_args():
         if args.webhooks is None:
             args.webhook_scheduler_updates = False
 
+    # The webhook senders also run with -os/--only-server.
+    args.webhook_filters = {}
+    if args.wh_filter_file:
+        with open(args.wh_filter_file) as f:
+            args.webhook_filters = json.load(f)
+
     return args
 
 
@@ -766,6 +874,11 @@ def date_secs(d):
     return d.minute * 60 + d.second
 
 
+# Gets the start of the hour of a given date.
+def hour_floor(d):
+    return d.replace(minute=0, second=0, microsecond=0)
+
+
 # Checks to see if test is between start and end accounting for hour
 # wraparound.
 def clock_between(start, test, end):
@@ -773,11 +886,116 @@ def clock_between(start, test, end):
             (not (end <= test <= start) and start > end))
 
 
+# Hour masks are 3600 bit integers, bit n set for n seconds after the hour.
+HOUR_MASK = (1 << 3600) - 1
+
+
+# Return the hour mask with the seconds from start to end (inclusive) set,
+# accounting for hour wraparound.
+def hour_mask_range(start, end):
+    if start <= end:
+        return ((1 << (end - start + 1)) - 1) << start
+    # The range wraps around the hour, so it's everything but the part from
+    # end to start.
+    if end + 1 > start - 1:
+        return HOUR_MASK
+    return HOUR_MASK ^ hour_mask_range(end + 1, start - 1)
+
+
+# Return the first second set in the hour mask at or after secs, accounting
+# for hour wraparound. None if the mask is empty.
+def hour_mask_next(mask, secs):
+    rotated = ((mask >> secs) | (mask << (3600 - secs))) & HOUR_MASK
+    if not rotated:
+        return None
+    return (secs + (rotated & -rotated).bit_length() - 1) % 3600
+
+
+# Return the first second set in the hour mask and the gaps (in seconds)
+# from each second set to the next one. The last gap wraps around the hour.
+def hour_mask_gaps(mask):
+    if not mask:
+        return None, []
+    runs = format(mask, '03600b')[::-1].split('1')
+    gaps = [len(r) + 1 for r in runs[1:-1]]
+    gaps.append(len(runs[-1]) + len(runs[0]) + 1)
+    return len(runs[0]), gaps
+
+
+# Store an hour mask as 900 hex digits, and back.
+def hour_mask_to_db(mask):
+    return '{:0900x}'.format(mask)
+
+
+def hour_mask_from_db(value):
+    return int(value, 16) if value else 0
+
+
 # Return the s2sphere cellid token from a location.
 def cellid(loc):
     return CellId.from_lat_lng(LatLng.from_degrees(loc[0], loc[1])).to_token()
 
 
+# Level of the S2 cells stored with the locations of Pokemon, Pokestops,
+# Gyms and spawnpoints (cells of about 300m).
+S2_CELL_LEVEL = 15
+
+
+# Return the S2 cell of a location as stored in the s2_cell columns. Cell
+# ids are unsigned 64 bits, they're shifted to fit a signed BIGINT column
+# (which keeps their order).
+def s2_cell_id(lat, lng):
+    cell = CellId.from_lat_lng(LatLng.from_degrees(lat, lng))
+    return cell.parent(S2_CELL_LEVEL).id() >> 1
+
+
+# Return the (min, max) ranges of s2_cell values of the S2 cells covering a
+# box, at most max_cells ranges.
+def s2_cell_ranges(swLat, swLng, neLat, neLng, max_cells=16):
+    coverer = RegionCoverer()
+    coverer.max_level = S2_CELL_LEVEL
+    coverer.max_cells = max_cells
+    rect = LatLngRect.from_point_pair(LatLng.from_degrees(swLat, swLng),
+                                      LatLng.from_degrees(neLat, neLng))
+
+    return [(cell.range_min().id() >> 1, cell.range_max().id() >> 1)
+            for cell in coverer.get_covering(rect)]
+
+
+# Encounter and spawnpoint ids are unsigned 64 bit integers. They're stored
+# as signed BIGINTs (two's complement), since SQLite has no unsigned ones.
+def int64_to_db(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def int64_from_db(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+# Encounter ids are shown on the map and sent to webhooks base64 encoded,
+# like they were stored before schema version 23.
+def encounter_id_to_db(encounter_id):
+    return int64_to_db(int(encounter_id))
+
+
+def encounter_id_from_db(value):
+    return b64encode(str(int64_from_db(value)))
+
+
+def encounter_id_from_base64(encounter_id):
+    return encounter_id_to_db(b64decode(encounter_id))
+
+
+# Spawnpoint ids are S2 cell tokens: the cell id in hex without its
+# trailing zeros.
+def spawnpoint_id_to_db(spawnpoint_id):
+    return int64_to_db(int(spawnpoint_id.ljust(16, '0'), 16))
+
+
+def spawnpoint_id_from_db(value):
+    return '{:016x}'.format(int64_from_db(value)).rstrip('0')
+
+
 # Return equirectangular approximation distance in km.
 def equi_rect_distance(loc1, loc2):
     R = 6371  # Radius of the earth in km.
@@ -794,6 +1012,25 @@ def in_radius(loc1, loc2, distance):
     return equi_rect_distance(loc1, loc2) < distance
 
 
+# Return True if loc is inside the polygon, a list of (lat, lng) points.
+# Uses ray casting, which is fine for the small areas we're dealing with.
+def in_polygon(loc, polygon):
+    lat, lng = loc
+    inside = False
+
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+        if ((lng_i > lng) != (lng_j > lng)) and (
+                lat < float(lat_j - lat_i) * (lng - lng_i) /
+                (lng_j - lng_i) + lat_i):
+            inside = not inside
+        j = i
+
+    return inside
+
+
 def i8ln(word):
     if config['LOCALE'] == "en":
         return word
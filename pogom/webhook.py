@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 import requests
 from datetime import datetime
+from queue import Queue, Empty, Full
 from cachetools import LFUCache
-from requests_futures.sessions import FuturesSession
 import threading
-from .utils import get_args
+from .utils import (get_args, in_polygon, encounter_id_from_db,
+                    spawnpoint_id_from_db)
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
@@ -18,105 +20,462 @@ wh_warning_threshold = 100
 # How long can it be over the threshold, in seconds?
 # Default: 5 seconds per 100 in threshold.
 wh_threshold_lifetime = int(5 * (wh_warning_threshold / 100.0))
-wh_lock = threading.Lock()
+
+# How often to log webhook cache stats, in seconds.
+wh_stats_interval = 300
+
+# Extract the proper identifier. This list also controls which message
+# types are getting cached.
+wh_ident_fields = {
+    'pokestop': 'pokestop_id',
+    'pokemon': 'encounter_id',
+    'gym': 'gym_id',
+    'gym_details': 'id'
+}
 
 args = get_args()
 
 
-def send_to_webhook(session, message_type, message):
-    if not args.webhooks:
+# Hand a frame of (targets, {'type': ..., 'message': ...}) tuples to the
+# endpoints. Every endpoint only gets the messages it was routed. The
+# endpoints' sender threads do the actual requests.
+def send_to_webhook(endpoints, frame):
+    if not endpoints:
         # What are you even doing here...
         log.warning('Called send_to_webhook() without webhooks.')
         return
 
-    req_timeout = args.wh_timeout
+    for endpoint in endpoints:
+        endpoint_frame = [item for targets, item in frame
+                          if endpoint in targets]
+        if endpoint_frame:
+            endpoint.put(endpoint_frame)
+
+
+# Return the endpoints whose filter accepts the message.
+def route_webhook(endpoints, whtype, message):
+    targets = []
+    for endpoint in endpoints:
+        if endpoint.filter.matches(whtype, message):
+            targets.append(endpoint)
+        else:
+            endpoint.filtered()
+
+    return targets
+
+
+# Build the filter for a webhook URL. Webhooks without their own rules in
+# --wh-filter-file get the global webhook whitelist/blacklist.
+def get_webhook_filter(args, url):
+    rules = args.webhook_filters.get(url)
+    if rules is None:
+        rules = {
+            'pokemon_ids': list(args.webhook_whitelist),
+            'pokemon_blacklist': list(args.webhook_blacklist)
+        }
+
+    return WebhookFilter(rules)
+
+
+class WebhookFilter(object):
+    """Filter rules of a single webhook endpoint.
+
+    Rules are compiled to sets and numbers once, so checking a message is a
+    couple of lookups. Empty or missing rules accept everything. Pokemon
+    rules only apply to pokemon messages and the geofence only applies to
+    messages with a location.
+    """
+
+    def __init__(self, rules):
+        types = rules.get('types')
+        self.types = frozenset(types) if types else None
+        self.pokemon_ids = frozenset(
+            [int(i) for i in rules.get('pokemon_ids', [])])
+        self.pokemon_blacklist = frozenset(
+            [int(i) for i in rules.get('pokemon_blacklist', [])])
+        self.min_iv = float(rules.get('min_iv', 0))
+        self.min_cp = int(rules.get('min_cp', 0))
+        self.geofence = [(float(lat), float(lng))
+                         for lat, lng in rules.get('geofence', [])]
+
+    def matches(self, whtype, message):
+        if self.types is not None and whtype not in self.types:
+            return False
 
-    data = {
-        'type': message_type,
-        'message': message
-    }
+        if whtype == 'pokemon':
+            pokemon_id = message.get('pokemon_id')
+            if self.pokemon_ids and pokemon_id not in self.pokemon_ids:
+                return False
+            if pokemon_id in self.pokemon_blacklist:
+                return False
+
+            # Pokemon that haven't been encountered have no IV/CP.
+            if self.min_iv:
+                attack = message.get('individual_attack')
+                if attack is None:
+                    return False
+                iv = (attack + message['individual_defense'] +
+                      message['individual_stamina']) * 100 / 45.0
+                if iv < self.min_iv:
+                    return False
+            if self.min_cp and (message.get('cp') or 0) < self.min_cp:
+                return False
+
+        if self.geofence and message.get('latitude') is not None:
+            if not in_polygon((message['latitude'], message['longitude']),
+                              self.geofence):
+                return False
+
+        return True
 
-    for w in args.webhooks:
+
+class WebhookEndpoint(object):
+    """Delivery state of a single webhook endpoint.
+
+    Every endpoint has its own bounded queue of frames and its own sender
+    threads, so a slow or dead receiver can't delay the others. When the
+    queue is full the oldest frame is shed, and after too many failed
+    requests in a row the circuit opens: frames are dropped without trying
+    until the circuit breaker timeout has passed.
+    """
+
+    def __init__(self, url, wh_filter, queue_size, cb_failures, cb_timeout):
+        self.url = url
+        self.filter = wh_filter
+        self.queue = Queue(maxsize=queue_size)
+        self.cb_failures = cb_failures
+        self.cb_timeout = cb_timeout
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.stats = {
+            'requests': 0,
+            'messages': 0,
+            'failed': 0,
+            'dropped': 0,
+            'shed': 0,
+            'filtered': 0,
+            'circuit_opened': 0,
+            'latency': 0.0,
+            'max_latency': 0.0,
+            'lag': 0.0,
+            'max_lag': 0.0,
+            'max_frame': 0
+        }
+
+    def circuit_open(self):
+        return self.open_until > time.time()
+
+    # Queue a frame, shedding the oldest frame if the queue is full.
+    def put(self, frame):
+        if self.circuit_open():
+            self.shed(len(frame))
+            return
+
+        item = (time.time(), frame)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    queued, old_frame = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.shed(len(old_frame))
+                except Empty:
+                    pass
+
+    # Count a message the endpoint's filter didn't want.
+    def filtered(self):
+        with self.lock:
+            self.stats['filtered'] += 1
+
+    def shed(self, frame_size):
+        with self.lock:
+            self.stats['shed'] += frame_size
+
+    # Record a finished request. Failed requests have already been retried
+    # with backoff by urllib3, so their messages are dropped.
+    def completed(self, frame_size, lag, latency, success):
+        with self.lock:
+            stats = self.stats
+            stats['requests'] += 1
+            stats['latency'] += latency
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['lag'] += lag
+            stats['max_lag'] = max(stats['max_lag'], lag)
+            stats['max_frame'] = max(stats['max_frame'], frame_size)
+
+            if success:
+                stats['messages'] += frame_size
+                self.consecutive_failures = 0
+                return
+
+            stats['failed'] += 1
+            stats['dropped'] += frame_size
+            self.consecutive_failures += 1
+
+            # A failure right after the circuit closes again opens it
+            # immediately, since the failure count isn't reset.
+            if (self.cb_failures and
+                    self.consecutive_failures >= self.cb_failures and
+                    not self.circuit_open()):
+                self.open_until = time.time() + self.cb_timeout
+                stats['circuit_opened'] += 1
+                log.warning('Webhook endpoint %s failed %d times in a row,'
+                            + ' pausing it for %d seconds.', self.url,
+                            self.consecutive_failures, self.cb_timeout)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['queue'] = self.queue.qsize()
+        stats['circuit_open'] = self.circuit_open()
+
+        return stats
+
+
+def wh_endpoint_sender(args, endpoint):
+    # Every sender thread has its own session, so requests to the endpoint
+    # reuse the underlying TCP connection.
+    session = __get_requests_session(args)
+    req_timeout = args.wh_timeout
+
+    while True:
         try:
-            session.post(w, json=data, timeout=(None, req_timeout),
-                         background_callback=__wh_completed)
-        except requests.exceptions.ReadTimeout:
-            log.exception('Response timeout on webhook endpoint %s.', w)
-        except requests.exceptions.RequestException as e:
-            log.exception(repr(e))
+            queued, frame = endpoint.queue.get()
+
+            if endpoint.circuit_open():
+                endpoint.shed(len(frame))
+            else:
+                # With frames disabled every frame holds a single message,
+                # which is sent as a plain object so older receivers keep
+                # working.
+                if args.wh_frame_interval > 0:
+                    data = frame
+                else:
+                    data = frame[0]
+
+                start = time.time()
+                success = False
+                try:
+                    response = session.post(endpoint.url, json=data,
+                                            timeout=(None, req_timeout))
+                    success = response.status_code < 400
+                    if not success:
+                        log.debug('Webhook endpoint %s returned status %d.',
+                                  endpoint.url, response.status_code)
+                except requests.exceptions.ReadTimeout:
+                    log.warning('Response timeout on webhook endpoint %s.',
+                                endpoint.url)
+                except requests.exceptions.RequestException as e:
+                    log.warning('Error sending to webhook endpoint %s: %s.',
+                                endpoint.url, repr(e))
+
+                endpoint.completed(len(frame), start - queued,
+                                   time.time() - start, success)
 
+            # Helping out the GC.
+            del frame
 
-def wh_updater(args, queue, key_caches):
+            endpoint.queue.task_done()
+        except Exception as e:
+            log.exception('Exception in wh_endpoint_sender: %s.', repr(e))
+
+
+class WebhookKeyCache(object):
+    """Sharded LFU caches used to deduplicate webhook messages.
+
+    Every shard owns one LFUCache per message type and its own lock, so
+    webhook threads only contend when their identifiers hash to the same
+    shard. The lock is held just long enough to read or swap a cache entry.
+    """
+
+    def __init__(self, maxsize, shards):
+        self.num_shards = max(1, shards)
+        # Split the configured size over the shards.
+        shard_size = max(1, maxsize // self.num_shards)
+
+        # We separate the caches by ident_field types, because different
+        # ident_field (message) types can use the same name for their
+        # ident field.
+        self.shards = []
+        for i in range(self.num_shards):
+            self.shards.append({
+                'lock': threading.Lock(),
+                'caches': {whtype: LFUCache(maxsize=shard_size)
+                           for whtype in wh_ident_fields},
+                'hits': 0,
+                'misses': 0,
+                'updates': 0,
+                'acquires': 0,
+                'contended': 0
+            })
+
+    # Get the unique identifier of a message, None if its type isn't cached.
+    def ident(self, whtype, message):
+        field = wh_ident_fields.get(whtype)
+        if field is None:
+            return None
+
+        return message.get(field, None)
+
+    def _shard(self, whtype, ident):
+        return self.shards[hash((whtype, ident)) % self.num_shards]
+
+    # Acquire a shard lock, counting how often we had to wait for it.
+    def _acquire(self, shard):
+        lock = shard['lock']
+        if not lock.acquire(False):
+            lock.acquire()
+            shard['contended'] += 1
+        shard['acquires'] += 1
+
+    def get(self, whtype, ident):
+        shard = self._shard(whtype, ident)
+        self._acquire(shard)
+        try:
+            # cachetools in Python2.7 isn't thread safe, so only touch the
+            # cache while holding the shard lock. Using get() also updates
+            # the LFU usage count.
+            return shard['caches'][whtype].get(ident)
+        finally:
+            shard['lock'].release()
+
+    # Store new as the cached message if the cache still holds old (which is
+    # None for unseen identifiers). Returns False if another thread stored a
+    # message in the meantime, in which case it has already been sent.
+    def swap(self, whtype, ident, old, new):
+        shard = self._shard(whtype, ident)
+        self._acquire(shard)
+        try:
+            key_cache = shard['caches'][whtype]
+            if key_cache.get(ident) is not old:
+                shard['hits'] += 1
+                return False
+
+            key_cache[ident] = new
+            if old is None:
+                shard['misses'] += 1
+            else:
+                shard['updates'] += 1
+            return True
+        finally:
+            shard['lock'].release()
+
+    # Count a message that was found in the cache and didn't change.
+    def hit(self, whtype, ident):
+        shard = self._shard(whtype, ident)
+        self._acquire(shard)
+        shard['hits'] += 1
+        shard['lock'].release()
+
+    def stats(self):
+        hits = sum(s['hits'] for s in self.shards)
+        misses = sum(s['misses'] for s in self.shards)
+        updates = sum(s['updates'] for s in self.shards)
+        acquires = sum(s['acquires'] for s in self.shards)
+        lookups = hits + misses + updates
+
+        return {
+            'lookups': lookups,
+            'hits': hits,
+            'misses': misses,
+            'updates': updates,
+            'hit_rate': 100.0 * hits / lookups if lookups else 0.0,
+            'contention': [100.0 * s['contended'] / s['acquires']
+                           if s['acquires'] else 0.0 for s in self.shards],
+            'acquires': acquires
+        }
+
+
+def wh_updater(args, queue, key_caches, endpoints):
     wh_threshold_timer = datetime.now()
     wh_over_threshold = False
+    wh_stats_timer = datetime.now()
 
-    # Set up one session to use for all requests.
-    # Requests to the same host will reuse the underlying TCP
-    # connection, giving a performance increase.
-    session = __get_requests_session(args)
-
-    # Extract the proper identifier. This list also controls which message
-    # types are getting cached.
-    ident_fields = {
-        'pokestop': 'pokestop_id',
-        'pokemon': 'encounter_id',
-        'gym': 'gym_id',
-        'gym_details': 'id'
-    }
-
-    # Instantiate WH LFU caches for all cached types. We separate the caches
-    # by ident_field types, because different ident_field (message) types can
-    # use the same name for their ident field.
-    for key in ident_fields:
-        key_caches[key] = LFUCache(maxsize=args.wh_lfu_size)
+    # Messages are collected in frames of up to --wh-frame-size items and
+    # sent together once the frame is --wh-frame-interval ms old.
+    frame_interval = args.wh_frame_interval / 1000.0
+    frame = []
+    frame_started = 0
 
     # The forever loop.
     while True:
         try:
-            # Loop the queue.
-            whtype, message = queue.get()
-
-            # Get the proper cache if this type has one.
-            key_cache = None
-
-            if whtype in key_caches:
-                key_cache = key_caches[whtype]
+            # Loop the queue, but don't wait longer than the current frame
+            # is allowed to live.
+            timeout = None
+            if frame:
+                timeout = max(0, frame_started + frame_interval - time.time())
+
+            try:
+                whtype, message = queue.get(timeout=timeout)
+            except Empty:
+                send_to_webhook(endpoints, frame)
+                frame = []
+                continue
+
+            if not frame:
+                frame_started = time.time()
+
+            # Pokemon are stored with integer ids, webhooks keep getting the
+            # encounter id base64 encoded and the spawnpoint id as token.
+            if whtype == 'pokemon':
+                message['encounter_id'] = encounter_id_from_db(
+                    message['encounter_id'])
+                message['spawnpoint_id'] = spawnpoint_id_from_db(
+                    message['spawnpoint_id'])
+
+            # Decide once which endpoints want this message.
+            targets = route_webhook(endpoints, whtype, message)
 
             # Get the unique identifier to check our cache, if it has one.
-            ident = message.get(ident_fields.get(whtype), None)
-
-            # cachetools in Python2.7 isn't thread safe, so we add a lock.
-            with wh_lock:
-                # Only send if identifier isn't already in cache.
-                if ident is None or key_cache is None:
-                    # We don't know what it is, or it doesn't have a cache,
-                    # so let's just log and send as-is.
-                    log.debug(
-                        'Sending webhook item of uncached type: %s.', whtype)
-                    send_to_webhook(session, whtype, message)
-                elif ident not in key_cache:
-                    key_cache[ident] = message
-                    log.debug('Sending %s to webhook: %s.', whtype, ident)
-                    send_to_webhook(session, whtype, message)
-                else:
-                    # Make sure to call key_cache[ident] in all branches so it
-                    # updates the LFU usage count.
-
-                    # If the object has changed in an important way, send new
-                    # data to webhooks.
-                    if __wh_object_changed(whtype, key_cache[ident], message):
-                        key_cache[ident] = message
-                        send_to_webhook(session, whtype, message)
+            ident = key_caches.ident(whtype, message)
+
+            if not targets:
+                log.debug('Not sending %s, no webhook wants it.', whtype)
+            elif ident is None:
+                # We don't know what it is, or it doesn't have a cache,
+                # so let's just log and send as-is.
+                log.debug(
+                    'Sending webhook item of uncached type: %s.', whtype)
+                frame.append(
+                    (targets, {'type': whtype, 'message': message}))
+            else:
+                # Compare outside of the shard lock, then only store (and
+                # send) if no other thread beat us to it.
+                cached = key_caches.get(whtype, ident)
+
+                if cached is None:
+                    if key_caches.swap(whtype, ident, None, message):
+                        log.debug('Sending %s to webhook: %s.', whtype, ident)
+                        frame.append((targets, {'type': whtype,
+                                                'message': message}))
+                elif __wh_object_changed(whtype, cached, message):
+                    # If the object has changed in an important way, send
+                    # new data to webhooks.
+                    if key_caches.swap(whtype, ident, cached, message):
                         log.debug('Sending updated %s to webhook: %s.',
                                   whtype, ident)
-                    else:
-                        log.debug('Not resending %s to webhook: %s.',
-                                  whtype, ident)
+                        frame.append((targets, {'type': whtype,
+                                                'message': message}))
+                else:
+                    key_caches.hit(whtype, ident)
+                    log.debug('Not resending %s to webhook: %s.',
+                              whtype, ident)
 
             # Helping out the GC.
             del whtype
             del message
             del ident
+            del targets
+
+            # Send the frame once it's full or old enough.
+            if frame and (len(frame) >= args.wh_frame_size or
+                          time.time() - frame_started >= frame_interval):
+                send_to_webhook(endpoints, frame)
+                frame = []
 
             # Webhook queue moving too slow.
             if (not wh_over_threshold) and (
@@ -132,12 +491,18 @@ def wh_updater(args, queue, key_caches):
                     if timediff.total_seconds() > wh_threshold_lifetime:
                         log.warning('Webhook queue has been > %d (@%d);'
                                     + ' for over %d seconds,'
-                                    + ' try increasing --wh-concurrency'
-                                    + ' or --wh-threads.',
+                                    + ' try increasing --wh-threads.',
                                     wh_warning_threshold,
                                     queue.qsize(),
                                     wh_threshold_lifetime)
 
+            # Only the first webhook thread reports the stats.
+            timediff = datetime.now() - wh_stats_timer
+            if (timediff.total_seconds() > wh_stats_interval and
+                    threading.current_thread().name == 'wh-updater-0'):
+                wh_stats_timer = datetime.now()
+                __log_stats(key_caches, endpoints)
+
             queue.task_done()
         except Exception as e:
             log.exception('Exception in wh_updater: %s.', repr(e))
@@ -145,29 +510,57 @@ def wh_updater(args, queue, key_caches):
 
 # Helpers
 
-# Background handler for completed webhook requests.
-# Currently doesn't do anything.
-def __wh_completed():
-    pass
+def __log_stats(key_caches, endpoints):
+    stats = key_caches.stats()
+    contention = stats['contention']
+    log.info('Webhook cache: %d lookups, %.1f%% hit rate (%d new, %d'
+             + ' updated), %d shards with %.1f%% max / %.1f%% avg lock'
+             + ' contention.',
+             stats['lookups'], stats['hit_rate'], stats['misses'],
+             stats['updates'], len(contention), max(contention),
+             sum(contention) / len(contention))
+
+    for endpoint in endpoints:
+        stats = endpoint.get_stats()
+        requests_done = max(1, stats['requests'])
+        log.info('Webhook %s: %d messages in %d requests (avg %.1f,'
+                 + ' max %d per request), %.0fms avg / %.0fms max'
+                 + ' latency, %.0fms avg / %.0fms max lag, %d queued.',
+                 endpoint.url, stats['messages'], stats['requests'],
+                 float(stats['messages'] + stats['dropped']) /
+                 requests_done, stats['max_frame'],
+                 1000 * stats['latency'] / requests_done,
+                 1000 * stats['max_latency'],
+                 1000 * stats['lag'] / requests_done,
+                 1000 * stats['max_lag'], stats['queue'])
+        log.info('Webhook %s: %d messages filtered, %d failed requests,'
+                 + ' %d messages dropped, %d messages shed, circuit opened'
+                 + ' %d times (%s).',
+                 endpoint.url, stats['filtered'], stats['failed'],
+                 stats['dropped'], stats['shed'], stats['circuit_opened'],
+                 'open' if stats['circuit_open'] else 'closed')
 
 
 def __get_requests_session(args):
     # Config / arg parser
     num_retries = args.wh_retries
     backoff_factor = args.wh_backoff_factor
-    pool_size = args.wh_concurrency
+    # Each sender thread only has one request in flight.
+    pool_size = 1
 
     # Use requests & urllib3 to auto-retry.
     # If the backoff_factor is 0.1, then sleep() will sleep for [0.1s, 0.2s,
     # 0.4s, ...] between retries. It will also force a retry if the status
     # code returned is 500, 502, 503 or 504.
-    session = FuturesSession(max_workers=pool_size)
+    session = requests.Session()
 
     # If any regular response is generated, no retry is done. Without using
     # the status_forcelist, even a response with status 500 will not be
-    # retried.
+    # retried. Frames are POSTed, which urllib3 doesn't retry on a status or
+    # read error unless the method whitelist is disabled.
     retries = Retry(total=num_retries, backoff_factor=backoff_factor,
-                    status_forcelist=[500, 502, 503, 504])
+                    status_forcelist=[500, 502, 503, 504],
+                    method_whitelist=False)
 
     # Mount handler on both HTTP & HTTPS.
     session.mount('http://', HTTPAdapter(max_retries=retries,
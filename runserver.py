@@ -25,9 +25,11 @@ from pogom.search import search_overseer_thread
 from pogom.models import (init_database, create_tables, drop_tables,
                           Pokemon, db_updater, clean_db_loop,
                           verify_table_encoding, verify_database_schema)
-from pogom.webhook import wh_updater
+from pogom.webhook import (wh_updater, wh_endpoint_sender, get_webhook_filter,
+                           WebhookKeyCache, WebhookEndpoint)
 
 from pogom.proxy import check_proxies, proxies_refresher
+from pogom.account import login_assets
 
 # Currently supported pgoapi.
 pgoapi_version = "1.1.7"
@@ -276,16 +278,34 @@ def main():
 
     # WH updates queue & WH unique key LFU caches.
     # The LFU caches will stop the server from resending the same data an
-    # infinite number of times. The caches will be instantiated in the
-    # webhook's startup code.
+    # infinite number of times. The caches are sharded by identifier so the
+    # webhook threads don't serialize on a single lock.
     wh_updates_queue = Queue()
-    wh_key_cache = {}
+    wh_key_cache = WebhookKeyCache(args.wh_lfu_size, args.wh_lfu_shards)
+
+    # Every webhook endpoint gets its own queue and sender threads, so a
+    # slow endpoint doesn't hold up the others.
+    wh_endpoints = []
+    for i, url in enumerate(args.webhooks or []):
+        endpoint = WebhookEndpoint(url, get_webhook_filter(args, url),
+                                   args.wh_endpoint_queue,
+                                   args.wh_circuit_breaker,
+                                   args.wh_circuit_breaker_timeout)
+        wh_endpoints.append(endpoint)
+
+        for j in range(args.wh_concurrency):
+            log.debug('Starting wh-sender thread %d for %s', j, url)
+            t = Thread(target=wh_endpoint_sender,
+                       name='wh-sender-{}-{}'.format(i, j),
+                       args=(args, endpoint))
+            t.daemon = True
+            t.start()
 
     # Thread to process webhook updates.
     for i in range(args.wh_threads):
         log.debug('Starting wh-updater worker thread %d', i)
         t = Thread(target=wh_updater, name='wh-updater-{}'.format(i),
-                   args=(args, wh_updates_queue, wh_key_cache))
+                   args=(args, wh_updates_queue, wh_key_cache, wh_endpoints))
         t.daemon = True
         t.start()
 
@@ -303,6 +323,10 @@ def main():
         # args.proxy with new working list)
         args.proxy = check_proxies(args)
 
+        # Accounts share the assets downloaded during login.
+        if args.login_asset_cache:
+            login_assets.load(args.login_asset_cache)
+
         # Run periodical proxy refresh thread
         if (args.proxy_file is not None) and (args.proxy_refresh > 0):
             t = Thread(target=proxies_refresher,
@@ -0,0 +1,332 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+from datetime import datetime, timedelta
+from threading import Event, Thread, Timer
+
+from flask import Flask
+
+# The models parse the command line and define their fields when imported,
+# before the database is set up.
+argv = sys.argv
+sys.argv = ['runserver.py', '-os', '-l', '0,0', '-k', 'key']
+try:
+    from pogom import models, utils
+finally:
+    sys.argv = argv
+
+
+class ModelsTest(unittest.TestCase):
+    def test_import(self):
+        self.assertTrue(issubclass(models.SpawnPoint, models.BaseModel))
+
+    def test_link_spawn_points(self):
+        # Rows as read from the database: cell ids are unicode tokens and
+        # spawnpoint ids signed integers.
+        cell = u'89c25a3197'
+        scans = {cell: {'loc': (40.7, -74.0)}}
+        initial = {cell: {'done': False}}
+        spawn_points = [
+            {'id': -8470431391402754048, 'latitude': 40.7002,
+             'longitude': -74.0002},
+            {'id': 1234567, 'latitude': 40.71, 'longitude': -74.0}]
+        scan_spawn_point = {}
+
+        models.ScannedLocation.link_spawn_points(
+            scans, initial, spawn_points, 0.070, scan_spawn_point)
+
+        self.assertEqual({
+            (cell, -8470431391402754048): {
+                'spawnpoint': -8470431391402754048,
+                'scannedlocation': cell}
+        }, scan_spawn_point)
+
+    def test_spawnpoint_summaries(self):
+        # Workers classifying stale copies of a spawnpoint keep each other's
+        # sightings.
+        sp = {'id': 1357, 'last_scanned': None, 'kind': 'hhhs',
+              'links': 'hhh?', 'latest_seen': None, 'earliest_unseen': None}
+        scan_loc = {'done': False}
+        for i, minute in enumerate((3, 7)):
+            models.SpawnpointDetectionData.classify(
+                dict(sp), scan_loc, 100,
+                {'scan_time': datetime(2017, 1, 1, 0, minute),
+                 'tth_secs': None, 'encounter_id': i})
+
+        models.SpawnpointDetectionData.classify(sp, scan_loc, 100)
+        summary = models.SpawnpointDetectionData.get_summary(sp)
+        self.assertEqual(2, summary['count'])
+        self.assertEqual((1 << 180) | (1 << 420), summary['seen'])
+
+
+class DatabaseTest(unittest.TestCase):
+    # A temporary SQLite file rather than :memory:, every connection of the
+    # pool would get its own in-memory database.
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        models.args.db = os.path.join(self.tmp_dir, 'pogom.db')
+        self.db = models.init_database(Flask(__name__))
+        models.verify_database_schema(self.db)
+        models.create_tables(self.db)
+        # Cached statistics of the previous test's database.
+        models.stats_cache.entries.clear()
+
+    def tearDown(self):
+        models.spatial_tables.clear()
+        models.known_gyms.clear()
+        models.release_db_connection()
+        self.db.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def add_pokemon(self, encounter_id, disappear_time, pokemon_id=16,
+                    spawnpoint_id=1, latitude=40.7, longitude=-74.0):
+        models.Pokemon.create(
+            encounter_id=encounter_id, spawnpoint_id=spawnpoint_id,
+            pokemon_id=pokemon_id, latitude=latitude, longitude=longitude,
+            disappear_time=disappear_time)
+
+    def test_delete_in_batches(self):
+        now = datetime.utcnow()
+        for i in range(5):
+            self.add_pokemon(i, now - timedelta(hours=i))
+
+        rows, lock_secs = models.delete_in_batches(
+            models.Pokemon,
+            models.Pokemon.disappear_time < now - timedelta(minutes=90),
+            2, pause=0)
+        self.assertEqual(3, rows)
+        self.assertEqual([0, 1], sorted(
+            p.encounter_id for p in models.Pokemon.select()))
+
+    def test_compact_db(self):
+        now = datetime.utcnow()
+        self.add_pokemon(1, now - timedelta(hours=10))
+        self.add_pokemon(2, now - timedelta(minutes=30))
+        models.SpawnPoint.create(id=models.spawnpoint_id_to_db('89c25a'),
+                                 latitude=40.7, longitude=-74.0,
+                                 last_scanned=now, latest_seen=0,
+                                 earliest_unseen=0)
+        for i, minute in enumerate((3, 7)):
+            models.SpawnpointDetectionData.create(
+                id=str(i), encounter_id=str(i), spawnpoint_id='89c25a',
+                scan_time=datetime(2017, 1, 1, 0, minute), tth_secs=None)
+
+        args = Namespace(db_type='sqlite', clean_batch_size=100,
+                         purge_data=1, purge_scanned_locations=0)
+
+        # Legacy sightings are folded into the spawnpoint summary. Pokemon
+        # that aren't rolled up yet aren't purged.
+        models.compact_db(args)
+        self.assertEqual(0, models.SpawnpointDetectionData.select().count())
+        sp = models.SpawnPoint.select().dicts().get()
+        self.assertEqual(
+            2, models.SpawnpointDetectionData.get_summary(sp)['count'])
+        self.assertEqual(2, models.Pokemon.select().count())
+
+        models.PokemonHourlyStats.rollup()
+        models.compact_db(args)
+        self.assertEqual([2], [p.encounter_id
+                               for p in models.Pokemon.select()])
+
+    def test_bulk_upsert_forgets_known_forts(self):
+        models.known_gyms['a'] = (1,)
+        models.known_gyms['b'] = (1,)
+
+        # The gym is missing its columns, the batch is dropped and has to
+        # be written again by the next scan.
+        models.bulk_upsert(models.Gym, {'a': {'gym_id': 'a', 'latitude': 1,
+                                              'longitude': 2}}, self.db)
+        self.assertEqual(0, models.Gym.select().count())
+        self.assertNotIn('a', models.known_gyms)
+        self.assertIn('b', models.known_gyms)
+
+    def test_rollup(self):
+        rolled_until = utils.hour_floor(
+            datetime.utcnow() - timedelta(minutes=5))
+        self.add_pokemon(1, rolled_until - timedelta(hours=5))
+        self.add_pokemon(2, rolled_until - timedelta(minutes=90))
+        self.add_pokemon(3, rolled_until - timedelta(minutes=90),
+                         spawnpoint_id=2, latitude=40.8)
+        self.add_pokemon(4, rolled_until - timedelta(minutes=90),
+                         pokemon_id=19)
+        # Not rolled up yet, read from the Pokemon table.
+        self.add_pokemon(5, rolled_until + timedelta(minutes=10))
+
+        self.assertEqual(5, models.PokemonHourlyStats.rollup())
+        self.assertEqual(rolled_until,
+                         models.PokemonHourlyStats.get_rolled_up_until())
+        totals = models.PokemonHourlyStats.get(
+            hour=rolled_until - timedelta(hours=2), pokemon_id=0)
+        self.assertEqual(3, totals.count)
+
+        raw, rolled = models.Pokemon.get_stats_ranges(None)
+        self.assertEqual(rolled_until, rolled[1])
+
+        def appearances():
+            models.stats_cache.entries.clear()
+            return dict((p['spawnpoint_id'], p['count'])
+                        for p in models.Pokemon.get_appearances(16, None))
+
+        first, second = map(utils.spawnpoint_id_from_db, (1, 2))
+        self.assertEqual({first: 3, second: 1}, appearances())
+
+        # Pokemon stored late are counted when the hour is rolled up again.
+        self.add_pokemon(6, rolled_until - timedelta(minutes=80))
+        self.assertEqual(0, models.PokemonHourlyStats.rollup())
+        self.assertEqual({first: 4, second: 1}, appearances())
+
+    def test_stats_cache(self):
+        cache = models.StatsCache(60, min_ttl=1)
+        self.assertEqual(60, cache.ttl(None))
+        self.assertEqual(1, cache.ttl(timedelta(minutes=1)))
+        self.assertEqual(50, cache.ttl(timedelta(seconds=50 * 288)))
+
+        calls = []
+        started = Event()
+        finish = Event()
+
+        def query(cls, timediff):
+            calls.append(timediff)
+            started.set()
+            finish.wait(5)
+            return len(calls)
+
+        # Concurrent misses wait for the running query.
+        results = []
+        threads = [Thread(target=lambda: results.append(
+            cache.get(('query', None), query, None, (None,))))
+            for i in range(3)]
+        for t in threads:
+            t.start()
+        started.wait(5)
+        time.sleep(0.05)
+        finish.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual([1, 1, 1], results)
+        self.assertEqual(1, len(calls))
+
+        # Results are served until they expire.
+        cache = models.StatsCache(0.1, min_ttl=0.1, refresh=0)
+        calls = []
+        self.assertEqual(1, cache.get(('query', 0), query, None, (0,)))
+        self.assertEqual(1, cache.get(('query', 0), query, None, (0,)))
+        time.sleep(0.15)
+        self.assertEqual(2, cache.get(('query', 0), query, None, (0,)))
+
+        # A result about to expire is still served while it's refreshed in
+        # the background.
+        cache = models.StatsCache(1, refresh=0.9)
+        calls = []
+        self.assertEqual(1, cache.get(('query', 0), query, None, (0,)))
+        time.sleep(0.15)
+        self.assertEqual(1, cache.get(('query', 0), query, None, (0,)))
+        refreshing = cache.running.get(('query', 0))
+        if refreshing:
+            refreshing.wait(5)
+        self.assertEqual(2, cache.get(('query', 0), query, None, (0,)))
+
+    def test_sqlite_spatial_index(self):
+        models.create_spatial_indexes(self.db)
+        self.assertIn(models.Gym, models.spatial_tables)
+
+        def gym(latitude):
+            return {'gym_id': 'a', 'team_id': 1, 'guard_pokemon_id': 1,
+                    'gym_points': 0, 'enabled': True, 'latitude': latitude,
+                    'longitude': -74.0, 'last_modified': datetime.utcnow()}
+
+        def gyms_in_box(swLat, neLat):
+            return [g.gym_id for g in models.Gym.select().where(
+                models.in_box(models.Gym, swLat, -74.1, neLat, -73.9))]
+
+        def rtree():
+            return self.db.execute_sql(
+                'SELECT id, min_lat FROM gym_rtree;').fetchall()
+
+        # Upserts REPLACE the row, the delete trigger has to drop the old
+        # entry of the index.
+        models.bulk_upsert(models.Gym, {'a': gym(40.7)}, self.db)
+        models.bulk_upsert(models.Gym, {'a': gym(40.8)}, self.db)
+        self.assertEqual(1, len(rtree()))
+        # The R*Tree keeps 32 bit floats.
+        self.assertAlmostEqual(40.8, rtree()[0][1], places=4)
+        self.assertEqual([], gyms_in_box(40.6, 40.75))
+        self.assertEqual(['a'], gyms_in_box(40.75, 40.85))
+
+        models.Gym.update(latitude=40.9).execute()
+        self.assertEqual(['a'], gyms_in_box(40.85, 40.95))
+
+        models.Gym.delete().execute()
+        self.assertEqual([], rtree())
+
+    def test_read_replica(self):
+        replica = models.MySqliteDB(os.path.join(self.tmp_dir, 'replica.db'),
+                                    max_connections=2,
+                                    check_same_thread=False)
+        sql, = self.db.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE name = 'pokemon';"
+        ).fetchone()
+        replica.execute_sql(sql)
+        replica.close()
+
+        self.add_pokemon(1, datetime.utcnow())
+        models.replica_db = replica
+        try:
+            # Decorated reads go to the (empty) replica and return its
+            # connection, everything else to the primary database.
+            self.assertEqual([], models.Pokemon.get_all())
+            self.assertTrue(replica.is_closed())
+            self.assertEqual(1, models.Pokemon.select().count())
+        finally:
+            models.replica_db = None
+            replica.close_all()
+
+        self.assertEqual(1, len(models.Pokemon.get_all()))
+
+    def test_monitored_pool(self):
+        pool = models.MySqliteDB(os.path.join(self.tmp_dir, 'pool.db'),
+                                 max_connections=1, checkout_timeout=0.3,
+                                 check_same_thread=False)
+        try:
+            # Connections of threads that ended without closing them are
+            # taken back.
+            t = Thread(target=pool.connect)
+            t.start()
+            t.join()
+            pool.connect()
+            pool.close()
+            self.assertEqual(1, pool.stats['reclaimed'])
+
+            connected = Event()
+            close = Event()
+
+            def hold():
+                pool.connect()
+                connected.set()
+                close.wait(5)
+                pool.close()
+
+            t = Thread(target=hold)
+            t.start()
+            connected.wait(5)
+
+            # Checkouts time out while the connection is in use, and get
+            # it as soon as it's closed.
+            self.assertRaises(ValueError, pool.connect)
+            Timer(0.1, close.set).start()
+            pool.connect()
+            pool.close()
+            t.join(5)
+
+            self.assertEqual(4, pool.stats['checkouts'])
+            self.assertEqual(1, pool.stats['waits'])
+            self.assertEqual(1, pool.stats['exhausted'])
+            self.assertEqual({}, pool.holders)
+            self.assertTrue(pool.get_stats_message().startswith(
+                '0/1 connections in use'))
+        finally:
+            pool.close_all()
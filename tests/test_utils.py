@@ -1,6 +1,23 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
 import unittest
+from argparse import Namespace
+from queue import Queue
+from threading import Thread
+from timeit import default_timer
 from pogom import utils
 
+# These modules parse the command line when imported.
+argv = sys.argv
+sys.argv = ['runserver.py', '-os', '-l', '0,0', '-k', 'key']
+try:
+    from pogom import account, captcha, search, webhook
+finally:
+    sys.argv = argv
+
 
 class UtilsTest(unittest.TestCase):
     def test_get_pokemon_id(self):
@@ -16,3 +33,429 @@ class UtilsTest(unittest.TestCase):
 
         # Unknown ID raises KeyError
         self.assertRaises(KeyError, utils.get_pokemon_name, 12367)
+
+    def test_in_polygon(self):
+        square = [(0, 0), (0, 1), (1, 1), (1, 0)]
+        self.assertTrue(utils.in_polygon((0.5, 0.5), square))
+        self.assertFalse(utils.in_polygon((1.5, 0.5), square))
+        self.assertFalse(utils.in_polygon((0.5, -0.5), square))
+
+        # Concave polygon, the notch is outside.
+        notched = [(0, 0), (0, 2), (2, 2), (1, 1), (2, 0)]
+        self.assertTrue(utils.in_polygon((0.5, 1), notched))
+        self.assertFalse(utils.in_polygon((1.8, 1), notched))
+
+    def test_hour_mask(self):
+        mask = utils.hour_mask_range(3590, 9)
+        self.assertEqual(20, bin(mask).count('1'))
+        self.assertEqual(3590, utils.hour_mask_next(mask, 100))
+        self.assertEqual(5, utils.hour_mask_next(mask, 5))
+        self.assertIsNone(utils.hour_mask_next(0, 5))
+
+        # Seen at 100, 400 and 3500 seconds after the hour.
+        seen = (1 << 100) | (1 << 400) | (1 << 3500)
+        self.assertEqual((100, [300, 3100, 200]), utils.hour_mask_gaps(seen))
+
+        value = utils.hour_mask_to_db(seen)
+        self.assertEqual(900, len(value))
+        self.assertEqual(seen, utils.hour_mask_from_db(value))
+        self.assertEqual(0, utils.hour_mask_from_db(None))
+
+    def test_s2_cell_ranges(self):
+        ranges = utils.s2_cell_ranges(40.7, -74.02, 40.73, -73.98)
+        self.assertTrue(0 < len(ranges) <= 16)
+
+        def covered(lat, lng):
+            cell = utils.s2_cell_id(lat, lng)
+            return any(low <= cell <= high for low, high in ranges)
+
+        self.assertTrue(covered(40.7, -74.02))
+        self.assertTrue(covered(40.715, -74.0))
+        self.assertTrue(covered(40.73, -73.98))
+        self.assertFalse(covered(41.0, -74.0))
+
+    def test_db_ids(self):
+        # Encounter ids above 2^63 are stored as negative numbers.
+        encounter_id = 17004445424327460733
+        value = utils.encounter_id_to_db(encounter_id)
+        self.assertTrue(value < 0)
+        self.assertEqual('MTcwMDQ0NDU0MjQzMjc0NjA3MzM=',
+                         utils.encounter_id_from_db(value))
+        self.assertEqual(value, utils.encounter_id_from_base64(
+            'MTcwMDQ0NDU0MjQzMjc0NjA3MzM='))
+        self.assertEqual(5, utils.encounter_id_to_db(5))
+        self.assertEqual('NQ==', utils.encounter_id_from_db(5))
+
+        for spawnpoint_id in ('808f9f1601d', '89c25a4fb1b', 'c'):
+            value = utils.spawnpoint_id_to_db(spawnpoint_id)
+            self.assertEqual(spawnpoint_id,
+                             utils.spawnpoint_id_from_db(value))
+
+    def test_webhook_key_cache(self):
+        key_caches = webhook.WebhookKeyCache(100, 4)
+        message = {'encounter_id': 'MTIz', 'pokemon_id': 1}
+        ident = key_caches.ident('pokemon', message)
+        self.assertEqual('MTIz', ident)
+        self.assertIsNone(key_caches.ident('captcha', message))
+
+        # Only the first thread storing an unseen message sends it.
+        self.assertIsNone(key_caches.get('pokemon', ident))
+        self.assertTrue(key_caches.swap('pokemon', ident, None, message))
+        self.assertFalse(key_caches.swap('pokemon', ident, None,
+                                         dict(message)))
+        self.assertIs(message, key_caches.get('pokemon', ident))
+
+        # Updates only replace the message they were compared with.
+        changed = dict(message, pokemon_id=2)
+        self.assertTrue(key_caches.swap('pokemon', ident, message, changed))
+        self.assertFalse(key_caches.swap('pokemon', ident, message,
+                                         dict(message)))
+        self.assertIs(changed, key_caches.get('pokemon', ident))
+
+        # Message types are cached separately.
+        self.assertIsNone(key_caches.get('gym', ident))
+
+        stats = key_caches.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['updates'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(4, len(stats['contention']))
+
+    def test_send_to_webhook(self):
+        first = webhook.WebhookEndpoint(
+            'http://first', webhook.WebhookFilter({}), 10, 0, 0)
+        second = webhook.WebhookEndpoint(
+            'http://second', webhook.WebhookFilter({}), 10, 0, 0)
+        gym = {'type': 'gym', 'message': {'gym_id': 'a'}}
+        pokestop = {'type': 'pokestop', 'message': {'pokestop_id': 'b'}}
+
+        # Every endpoint gets one frame with the messages routed to it.
+        webhook.send_to_webhook([first, second], [((first, second), gym),
+                                                  ((second,), pokestop)])
+        self.assertEqual([gym], first.queue.get_nowait()[1])
+        self.assertEqual([gym, pokestop], second.queue.get_nowait()[1])
+
+        webhook.send_to_webhook([first, second], [((second,), pokestop)])
+        self.assertTrue(first.queue.empty())
+        self.assertEqual([pokestop], second.queue.get_nowait()[1])
+
+    def test_wh_updater(self):
+        args = Namespace(wh_frame_size=2, wh_frame_interval=50)
+        endpoint = webhook.WebhookEndpoint(
+            'http://frames', webhook.WebhookFilter({}), 10, 0, 0)
+        queue = Queue()
+        t = Thread(target=webhook.wh_updater,
+                   args=(args, queue, webhook.WebhookKeyCache(100, 2),
+                         [endpoint]))
+        t.daemon = True
+        t.start()
+
+        gym = {'gym_id': 'a', 'team_id': 1}
+        changed = dict(gym, team_id=2)
+        pokestop = {'pokestop_id': 'b', 'enabled': True}
+        for message in (('gym', gym), ('gym', dict(gym)), ('gym', changed),
+                        ('pokestop', pokestop)):
+            queue.put(message)
+
+        # A full frame is sent right away, unchanged messages are dropped.
+        queued, frame = endpoint.queue.get(timeout=5)
+        self.assertEqual([{'type': 'gym', 'message': gym},
+                          {'type': 'gym', 'message': changed}], frame)
+
+        # The rest is sent once the frame interval has passed.
+        queued, frame = endpoint.queue.get(timeout=5)
+        self.assertEqual([{'type': 'pokestop', 'message': pokestop}], frame)
+
+    def test_webhook_endpoint(self):
+        endpoint = webhook.WebhookEndpoint(
+            'http://slow', webhook.WebhookFilter({}), 2, 2, 60)
+
+        # The oldest frame is shed when the queue is full.
+        for i in range(3):
+            endpoint.put([i])
+        self.assertEqual([1], endpoint.queue.get_nowait()[1])
+        self.assertEqual([2], endpoint.queue.get_nowait()[1])
+        self.assertEqual(1, endpoint.get_stats()['shed'])
+
+        # The circuit opens after cb_failures failed requests in a row,
+        # then frames are shed without queueing them.
+        endpoint.completed(3, 0, 0.1, False)
+        endpoint.completed(1, 0, 0.1, True)
+        endpoint.completed(3, 0, 0.1, False)
+        self.assertFalse(endpoint.circuit_open())
+        endpoint.completed(3, 0, 0.1, False)
+        self.assertTrue(endpoint.circuit_open())
+        endpoint.put([3, 4])
+        self.assertTrue(endpoint.queue.empty())
+
+        stats = endpoint.get_stats()
+        self.assertEqual(4, stats['requests'])
+        self.assertEqual(1, stats['messages'])
+        self.assertEqual(3, stats['failed'])
+        self.assertEqual(9, stats['dropped'])
+        self.assertEqual(3, stats['shed'])
+        self.assertEqual(1, stats['circuit_opened'])
+
+    def test_webhook_filter(self):
+        wh_filter = webhook.WebhookFilter({
+            'types': ['pokemon', 'gym'],
+            'pokemon_ids': ['1', '2'],
+            'pokemon_blacklist': [2],
+            'min_iv': 50,
+            'geofence': [[0, 0], [0, 1], [1, 1], [1, 0]]
+        })
+        pokemon = {'pokemon_id': 1, 'latitude': 0.5, 'longitude': 0.5,
+                   'individual_attack': 15, 'individual_defense': 15,
+                   'individual_stamina': 0}
+        self.assertTrue(wh_filter.matches('pokemon', pokemon))
+        self.assertFalse(wh_filter.matches(
+            'pokemon', dict(pokemon, pokemon_id=2)))
+        self.assertFalse(wh_filter.matches(
+            'pokemon', dict(pokemon, pokemon_id=3)))
+        self.assertFalse(wh_filter.matches(
+            'pokemon', dict(pokemon, individual_defense=0)))
+        self.assertFalse(wh_filter.matches(
+            'pokemon', dict(pokemon, individual_attack=None)))
+        self.assertFalse(wh_filter.matches(
+            'pokemon', dict(pokemon, latitude=1.5)))
+
+        # Pokemon rules don't apply to other types, the geofence only
+        # applies to messages with a location.
+        self.assertTrue(wh_filter.matches('gym', {'latitude': 0.5,
+                                                  'longitude': 0.5}))
+        self.assertFalse(wh_filter.matches('gym', {'latitude': 1.5,
+                                                   'longitude': 0.5}))
+        self.assertTrue(wh_filter.matches('gym', {}))
+        self.assertFalse(wh_filter.matches('pokestop', {}))
+
+    def test_route_webhook(self):
+        # Webhooks without their own rules get the global lists.
+        args = Namespace(webhook_filters={'http://gyms': {'types': ['gym']}},
+                         webhook_whitelist=[], webhook_blacklist=[16])
+        endpoints = [webhook.WebhookEndpoint(
+            url, webhook.get_webhook_filter(args, url), 10, 0, 0)
+            for url in ('http://all', 'http://gyms')]
+        everything, gyms = endpoints
+
+        self.assertEqual(endpoints, webhook.route_webhook(
+            endpoints, 'gym', {'gym_id': 'a'}))
+        self.assertEqual([everything], webhook.route_webhook(
+            endpoints, 'pokemon', {'pokemon_id': 1}))
+        self.assertEqual([], webhook.route_webhook(
+            endpoints, 'pokemon', {'pokemon_id': 16}))
+
+        self.assertEqual(1, everything.get_stats()['filtered'])
+        self.assertEqual(2, gyms.get_stats()['filtered'])
+
+    def test_encounter_queue(self):
+        encounter_queue = search.EncounterQueue()
+        encounter_queue.put((1, 2), {'a': 1, 'b': 2})
+
+        # Encounters queued from an overlapping step are dropped.
+        encounter_queue.put((1, 3), {'b': 2, 'c': 3})
+        encounter_queue.put((1, 4), {'a': 1})
+
+        location, encounters = encounter_queue.get()
+        self.assertEqual(((1, 2), {'a': 1, 'b': 2}), (location, encounters))
+        encounter_queue.task_done(encounters)
+        self.assertEqual(((1, 3), {'c': 3}), encounter_queue.get())
+
+        # Processed encounters can be queued again.
+        encounter_queue.put((1, 5), {'a': 1})
+        self.assertEqual(((1, 5), {'a': 1}), encounter_queue.get())
+
+        self.assertEqual({'queued': 4, 'duplicates': 2, 'done': 2},
+                         encounter_queue.stats)
+
+    def test_account_set(self):
+        location = (40.7, -74.0)
+        rested = default_timer() - 3600
+        near = {'username': 'near', 'last_scanned': rested,
+                'last_coords': (40.71, -74.0)}
+        far = {'username': 'far', 'last_scanned': rested,
+               'last_coords': (40.8, -74.0)}
+        fresh = {'username': 'fresh'}
+        busy = {'username': 'busy', 'last_scanned': default_timer(),
+                'last_coords': (40.9, -74.0)}
+        account_sets = account.AccountSet(35)
+        account_sets.create_set('30', [far, fresh, near, busy])
+
+        # Closest cooled down account first, accounts that haven't scanned
+        # yet when none has cooled down.
+        self.assertEqual((near, None), account_sets.next('30', location))
+        self.assertEqual((far, None), account_sets.next('30', location))
+        self.assertEqual((fresh, None), account_sets.next('30', location))
+
+        # Then the time until the first account has cooled down.
+        result, wait = account_sets.next('30', location)
+        self.assertIsNone(result)
+        self.assertAlmostEqual(
+            utils.equi_rect_distance(busy['last_coords'], location) /
+            35 * 3600, wait, delta=5)
+
+        # Failed accounts leave the set, released ones are used again.
+        account_sets.fail(near)
+        account_sets.release(near)
+        account_sets.release(far)
+        self.assertEqual((far, None), account_sets.next('30', location))
+        account_sets.release(far)
+        account_sets.fail(busy)
+        self.assertTrue(account_sets.get_stats_message('30').startswith(
+            'L30 accounts: 1 in use, 1 free, 2 failed'))
+
+        # Nothing left once every account is in use or failed.
+        self.assertEqual((far, None), account_sets.next('30', location))
+        self.assertEqual((None, None), account_sets.next('30', location))
+
+    def test_account_failures(self):
+        account_failures = search.AccountFailures(
+            Namespace(account_rest_interval=100))
+        now = time.time()
+
+        # Accounts rest longer when banned, shorter after an exception.
+        banned = {'account': {'username': 'banned'}, 'last_fail_time': now,
+                  'reason': 'banned'}
+        captcha = {'account': {'username': 'captcha'},
+                   'last_fail_time': now - 150, 'reason': 'captcha'}
+        exception = {'account': {'username': 'exception'},
+                     'last_fail_time': now - 100, 'reason': 'exception'}
+        for failure in (banned, captcha, exception):
+            account_failures.append(failure)
+
+        self.assertAlmostEqual(now + 1000, banned['ready_time'])
+        self.assertAlmostEqual(now - 90, exception['ready_time'])
+        self.assertEqual([exception, captcha, banned], list(account_failures))
+
+        # Accounts come back soonest ready first.
+        self.assertIs(exception, account_failures.pop_ready())
+        self.assertIs(captcha, account_failures.pop_ready())
+        self.assertEqual(1, len(account_failures))
+        self.assertEqual(2, account_failures.stats['returned'])
+
+    def test_account_queue(self):
+        account_queue = account.AccountQueue()
+        far = {'username': 'far', 'last_location': (40.8, -74.0)}
+        near = {'username': 'near', 'last_location': (40.71, -74.0)}
+        new = {'username': 'new', 'last_location': None}
+        for a in (far, near, new, dict(near)):
+            account_queue.put(a)
+
+        # Accounts without a location are as good as it gets, then the
+        # closest one.
+        self.assertIs(new, account_queue.get_closest((40.7, -74.0)))
+        self.assertIs(near, account_queue.get_closest((40.7, -74.0)))
+        self.assertIs(far, account_queue.get_closest((40.9, -74.0)))
+        self.assertEqual(1, account_queue.qsize())
+
+    def test_account_warmup_thread(self):
+        class FakeApi(object):
+            def set_position(self, *location):
+                self.location = location
+
+        def check_login(args, account, api, location, proxy_url):
+            account['banned'] = account['username'] == 'banned'
+
+        args = Namespace(hash_key=None, login_delay=0,
+                         account_rest_interval=60)
+        account_queue = account.AccountQueue()
+        for username in ('banned', 'good'):
+            account_queue.put({'username': username, 'last_location': None})
+        account_failures = search.AccountFailures(args)
+        warm_queue = Queue(maxsize=1)
+        scheduler = Namespace(ready=True, scan_location=(40.7, -74.0, 0))
+
+        # Log in without the API. The thread blocks on the empty account
+        # queue once the good account is handed over.
+        setup_api = search.setup_api
+        check = search.check_login
+        search.setup_api = lambda args, status, account: FakeApi()
+        search.check_login = check_login
+        try:
+            t = Thread(target=search.account_warmup_thread,
+                       args=(args, account_queue, account_failures,
+                             warm_queue, scheduler, None))
+            t.daemon = True
+            t.start()
+            warm_account, api, status = warm_queue.get(timeout=5)
+        finally:
+            search.setup_api = setup_api
+            search.check_login = check
+
+        self.assertEqual('good', warm_account['username'])
+        self.assertEqual(scheduler.scan_location, api.location)
+        self.assertEqual(scheduler.scan_location,
+                         warm_account['last_location'])
+        self.assertEqual(['banned'], [f['account']['username']
+                                      for f in account_failures])
+
+    def test_login_asset_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'login_assets.json')
+
+            # Without a file nothing is cached.
+            assets = account.LoginAssetCache()
+            self.assertFalse(assets.is_current('0.69.0', 'asset_time', 10))
+            assets.update('0.69.0', 'asset_time', 10, 3)
+            self.assertFalse(os.path.exists(path))
+
+            assets.load(path)
+            assets.update('0.69.0', 'asset_time', 10, 3)
+            self.assertTrue(assets.is_current('0.69.0', 'asset_time', 10))
+            self.assertFalse(assets.is_current('0.69.0', 'asset_time', 11))
+            self.assertFalse(assets.is_current('0.71.0', 'asset_time', 10))
+
+            # Versions survive a restart.
+            reloaded = account.LoginAssetCache()
+            reloaded.load(path)
+            self.assertTrue(reloaded.is_current('0.69.0', 'asset_time', 10))
+            self.assertEqual(3, reloaded.versions['0.69.0']['asset_pages'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_captcha_solvers(self):
+        solvers = captcha.CaptchaSolvers()
+        jobs = Queue()
+        for i in range(2):
+            t = Thread(target=lambda: jobs.put(solvers.get()))
+            t.daemon = True
+            t.start()
+
+        deadline = time.time() + 5
+        while solvers.available() < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, solvers.available())
+
+        # Queued captchas count as taken before a solver picks them up.
+        solvers.put('captcha', 'token')
+        self.assertEqual(1, solvers.available())
+        self.assertEqual(('captcha', 'token'), jobs.get(timeout=5))
+        self.assertEqual(1, solvers.available())
+
+        solvers.done(True, 2.0)
+        solvers.done(False, 4.0)
+        self.assertTrue(solvers.get_stats_message({}).endswith(
+            'Solved 1, failed 1, accounts held 3.0s on average (4.0s max).'))
+
+    def test_captcha_tokens(self):
+        tokens = captcha.CaptchaTokens()
+
+        # Tokens only stay in-process while accounts wait for them.
+        self.assertFalse(tokens.offer('a'))
+        tokens.set_waiting(2)
+        self.assertTrue(tokens.offer('a'))
+        self.assertTrue(tokens.offer('b'))
+        self.assertFalse(tokens.offer('c'))
+        self.assertTrue(tokens.event.is_set())
+
+        self.assertEqual(['a'], tokens.get_valid(1))
+        self.assertEqual(1, tokens.waiting)
+        self.assertEqual(['b'], tokens.get_valid(5))
+        self.assertEqual(0, tokens.waiting)
+
+        # Expired tokens are dropped.
+        tokens.set_waiting(1)
+        self.assertTrue(tokens.offer('old'))
+        tokens.tokens[0] = (utils.now() - tokens.max_age - 1, 'old')
+        self.assertEqual([], tokens.get_valid(1))
+        self.assertEqual(1, tokens.waiting)